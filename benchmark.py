@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of each processing stage over the samples and scaled copies of them
+
+Every folder in samples/ is a workload. Scaled workloads repeat it 10x, 100x, ...: the report
+file is repeated as is, and the capture is rewritten as a pcap file with all its frames repeated,
+each repetition following on from the previous one in time. Each stage of each workload runs in
+a fresh process, timed as the best of --repeat runs, with the peak resident set size of that
+process.
+
+Results are written as JSON. With --compare, they are checked against a baseline from an
+earlier run, and stages that got slower by more than --threshold are flagged as regressions.
+'''
+import argparse
+import fnmatch
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+import warnings
+
+from collections import deque
+from contextlib import redirect_stdout
+from pathlib import Path
+from pcap_reader import read_capture
+
+
+CAPTURE_STAGES = ('pcap_read', 'urb_parse', 'get_devices', 'extract_hid_data')
+DEVICE_STAGES = {
+    'keyboard': ('decode_keypresses', 'decode_keypresses_numpy', 'simulate_keypresses'),
+    'mouse': ('decode_mouse_data', 'decode_mouse_data_numpy', 'draw_movement', 'render_png'),
+    'tablet': ('decode_tablet_data', 'decode_tablet_data_numpy', 'draw_movement', 'render_png'),
+}
+STAGES = CAPTURE_STAGES + tuple(dict.fromkeys(stage for stages in DEVICE_STAGES.values() for stage in stages))
+SCALES = (1, 10, 100, 1000)
+MAX_REPORTS = 2_000_000  # Larger scaled workloads are skipped
+THRESHOLD = 0.2  # Relative slowdown flagged as a regression
+MIN_SECONDS = 0.005  # Smaller differences are noise
+
+
+def sample_args(path: Path) -> dict:
+    '''
+    Decoder options of a sample, from its args.txt or draw.sh
+    '''
+    words = []
+    for name in ('args.txt', 'draw.sh'):
+        if (path / name).exists():
+            words += (path / name).read_text().split()
+
+    def value(option, default):
+        return int(words[words.index(option) + 1]) if option in words else default
+
+    bit_lengths = [int(n) for n in words[words.index('--bit-lengths') + 1:][:3]] if '--bit-lengths' in words else [8, 8, 8]
+    return {
+        'offset': value('--offset', 0),
+        'reserved': '--no-reserved' not in words,
+        'bit_lengths': bit_lengths,
+        'absolute': '--absolute' in words or '-a' in words,
+        'mode': value('--mode', 1),
+        'clicks': '--clicks' in words or '-c' in words,
+    }
+
+
+def find_workloads(samples: str, patterns: list[str] = None) -> list[dict]:
+    workloads = []
+    for path in sorted(Path(samples).glob('*/*')):
+        name = f'{path.parent.name}/{path.name}'
+        if not (path / 'usbdata.txt').exists() or patterns and not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+        captures = sorted(path.glob('capture.*'))
+        workloads.append({
+            'name': name,
+            'device': path.parent.name,
+            'reports': str(path / 'usbdata.txt'),
+            'capture': str(captures[0]) if captures else None,
+            'args': sample_args(path),
+        })
+    return workloads
+
+
+def scale_reports(source: str, target: str, scale: int):
+    data = Path(source).read_bytes()
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+    with open(target, 'wb') as f:
+        for _ in range(scale):
+            f.write(data)
+
+
+def scale_capture(source: str, target: str, scale: int) -> bool:
+    '''
+    Rewrite a capture as pcap with its frames repeated scale times, False if its frames have
+    several link types (which pcap cannot hold)
+    '''
+    frames = [(linktype, ts, bytes(frame)) for linktype, ts, frame in read_capture(source)]
+    linktypes = {linktype for linktype, _, _ in frames}
+    if len(linktypes) != 1:
+        return False
+
+    first, last = frames[0][1] or 0, frames[-1][1] or 0
+    duration = last - first + 1
+    with open(target, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 0x40000, linktypes.pop()))
+        for i in range(scale):
+            for _, ts, frame in frames:
+                seconds, microseconds = divmod(round(((ts or 0) + i * duration) * 1e6), 1_000_000)
+                f.write(struct.pack('<IIII', seconds, microseconds, len(frame), len(frame)))
+                f.write(frame)
+    return True
+
+
+def stage_function(stage: str, workload: dict):
+    '''
+    The function timed for a stage, after loading its inputs
+    '''
+    if stage in CAPTURE_STAGES:
+        from extract_hid_data import DeviceTracker, extract_hid_data, get_devices, read_packets
+
+        capture = workload['capture']
+        if stage == 'pcap_read':
+            return lambda: deque(read_capture(capture), maxlen=0)
+        if stage == 'urb_parse':
+            frames = [(linktype, ts, bytes(frame)) for linktype, ts, frame in read_capture(capture)]
+            return lambda: deque(read_packets(frames), maxlen=0)
+        if stage == 'get_devices':
+            return lambda: get_devices(read_packets(read_capture(capture)))
+        return lambda: deque(extract_hid_data(read_packets(read_capture(capture)), DeviceTracker()), maxlen=0)
+
+    # The decoders import NumPy on first use, which is not what is measured
+    import numpy
+
+    raw_data = Path(workload['reports']).read_text()
+    args = workload['args']
+    if workload['device'] == 'keyboard':
+        from keyboard_decode import decode_keypresses, decode_keypresses_numpy, simulate_keypresses
+
+        if stage == 'decode_keypresses':
+            return lambda: decode_keypresses(raw_data, args['offset'], args['reserved'])
+        if stage == 'decode_keypresses_numpy':
+            return lambda: decode_keypresses_numpy(raw_data, args['offset'], args['reserved'])
+        keypresses = decode_keypresses_numpy(raw_data, args['offset'], args['reserved'])
+        return lambda: simulate_keypresses(keypresses)
+
+    if workload['device'] == 'mouse':
+        from mouse_decode import decode_mouse_data, decode_mouse_data_numpy
+
+        if stage == 'decode_mouse_data':
+            return lambda: decode_mouse_data(raw_data, args['bit_lengths'], args['offset'], args['absolute'])
+        decode = lambda: decode_mouse_data_numpy(raw_data, args['bit_lengths'], args['offset'], args['absolute'])
+    else:
+        from tablet_decode import decode_tablet_data, decode_tablet_data_numpy
+
+        if stage == 'decode_tablet_data':
+            return lambda: decode_tablet_data(raw_data, args['offset'])
+        decode = lambda: decode_tablet_data_numpy(raw_data, args['offset'])[:3]
+
+    if stage.endswith('_numpy'):
+        return decode
+    movement = decode()
+    if stage == 'render_png':
+        from raster import render_png
+        return lambda: render_png(os.devnull, *movement, draw_mode=args['mode'], draw_clicks=args['clicks'])
+
+    import matplotlib.pyplot as plt
+    from draw import draw_movement
+
+    def draw():
+        # Agg does not show anything, so the figure is drawn explicitly
+        draw_movement(*movement, draw_mode=args['mode'], draw_clicks=args['clicks'])
+        plt.gcf().canvas.draw()
+        plt.close('all')
+    return draw
+
+
+def peak_rss() -> float | None:
+    '''
+    Peak resident set size of this process in MiB
+    '''
+    try:
+        import resource
+    except ModuleNotFoundError:
+        return None
+    # Bytes on macOS, kilobytes elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+def measure(stage: str, workload: dict, repeat: int) -> tuple[float, float | None]:
+    '''
+    Best time in seconds of repeat runs of a stage, and the peak RSS of the process in MiB
+    '''
+    with redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        run = stage_function(stage, workload)
+        best = math.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+    return best, peak_rss()
+
+
+def run_benchmarks(workloads: list[dict], scales=SCALES, stages=STAGES, repeat=3, max_reports=MAX_REPORTS) -> list[dict]:
+    results = []
+    # A fresh process per measurement, so the peak RSS is the stage's own
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool, tempfile.TemporaryDirectory() as tmp:
+        for workload in workloads:
+            count = sum(1 for line in open(workload['reports']) if line.strip())
+            device_stages = [s for s in DEVICE_STAGES.get(workload['device'], ()) if s in stages]
+            capture_stages = [s for s in stages if s in CAPTURE_STAGES] if workload['capture'] else []
+
+            for scale in scales:
+                if count * scale > max_reports:
+                    print(f'{workload["name"]:<60} {scale:>5}x  skipped, over {max_reports} reports')
+                    continue
+
+                scaled = dict(workload)
+                scaled_stages = capture_stages
+                if scale > 1:
+                    scaled['reports'] = os.path.join(tmp, 'usbdata.txt')
+                    scale_reports(workload['reports'], scaled['reports'], scale)
+                    if capture_stages:
+                        scaled['capture'] = os.path.join(tmp, 'capture.pcap')
+                        if not scale_capture(workload['capture'], scaled['capture'], scale):
+                            scaled_stages = []
+                            print(f'{workload["name"]:<60} {scale:>5}x  skipped {", ".join(capture_stages)}, capture has several link types')
+
+                for stage in scaled_stages + device_stages:
+                    result = {'workload': workload['name'], 'scale': scale, 'stage': stage, 'reports': count * scale}
+                    try:
+                        result['seconds'], result['peak_rss_mb'] = pool.apply(measure, (stage, scaled, repeat))
+                        print(f'{workload["name"]:<60} {scale:>5}x  {stage:<24} {result["seconds"] * 1000:10.1f} ms {result["peak_rss_mb"] or 0:8.1f} MiB')
+                    except Exception as e:
+                        result['error'] = repr(e)
+                        print(f'{workload["name"]:<60} {scale:>5}x  {stage:<24} failed: {e!r}')
+                    results.append(result)
+    return results
+
+
+def compare(baseline: dict, current: dict, threshold=THRESHOLD, min_seconds=MIN_SECONDS) -> list[dict]:
+    '''
+    Print the change of every measurement also in the baseline, returns the regressions
+    '''
+    base = {(r['workload'], r['scale'], r['stage']): r for r in baseline['results'] if 'seconds' in r}
+    regressions = []
+    for result in current['results']:
+        before = base.get((result['workload'], result['scale'], result['stage']))
+        if before is None or 'seconds' not in result:
+            continue
+        ratio = result['seconds'] / before['seconds'] if before['seconds'] else math.inf
+        regressed = ratio > 1 + threshold and result['seconds'] - before['seconds'] > min_seconds
+        if regressed:
+            regressions.append(result)
+        print(
+            f'{result["workload"]:<60} {result["scale"]:>5}x  {result["stage"]:<24} '
+            f'{before["seconds"] * 1000:10.1f} -> {result["seconds"] * 1000:10.1f} ms  {ratio:6.2f}x{"  REGRESSION" if regressed else ""}'
+        )
+    print(f'{len(regressions)} regressions over {threshold:.0%} slower')
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark extraction, decoding and drawing over the samples and scaled copies of them',
+        epilog='Example:\n  python benchmark.py -o baseline.json\n  python benchmark.py -o current.json --compare baseline.json',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--samples', default='samples', help='samples folder (default: %(default)s)')
+    parser.add_argument('-k', '--filter', action='append', metavar='PATTERN', help='only workloads matching a glob pattern, e.g. \'mouse/*\'')
+    parser.add_argument('-s', '--scales', type=int, nargs='+', default=list(SCALES), help='workload scale factors (default: %(default)s)')
+    parser.add_argument('--max-reports', type=int, default=MAX_REPORTS, help='skip scaled workloads with more reports (default: %(default)s)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), metavar='STAGE', help=f'stages to run (default: all)\n{", ".join(STAGES)}')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per measurement, the best is kept (default: %(default)s)')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='results file (default: %(default)s)')
+    parser.add_argument('-c', '--compare', nargs='+', metavar=('BASELINE', 'RESULTS'), help='flag regressions against a baseline results file,\nof a stored results file instead of a new run if given')
+    parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD, help='relative slowdown flagged as a regression (default: %(default)s)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare and len(args.compare) > 2:
+        print('--compare takes a baseline and at most one results file')
+        exit()
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+    else:
+        os.environ.setdefault('MPLBACKEND', 'Agg')  # Inherited by the measuring processes
+        workloads = find_workloads(args.samples, args.filter)
+        if not workloads:
+            print('No workloads found, exiting...')
+            exit()
+        current = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': args.repeat,
+            'results': run_benchmarks(workloads, args.scales, args.stages, args.repeat, args.max_reports),
+        }
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+        print(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        if compare(baseline, current, args.threshold):
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+'''
+On-disk cache of parsed reports, decoded results, and extracted captures
+
+Entries are keyed by the SHA-256 of the input file's content together with the parameters of
+the step, so a renamed or copied file still hits and a modified one misses. Keys also include a
+digest of the source files that produce the results, so any change to the code invalidates them. Parsed hex reports
+are stored as a uint8 matrix with their timestamps, decoded results as pickles, and extractions
+as a folder of the written report files. The least recently used entries (by modification time,
+refreshed on every hit) are evicted once the cache grows past CACHE_SIZE bytes.
+
+The cache lives in $XDG_CACHE_HOME/usb-hid-decoders (~/.cache by default), or HID_CACHE_DIR.
+Bump CACHE_VERSION when the format of the entries changes.
+'''
+import functools
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+from pathlib import Path
+
+
+CACHE_VERSION = 1
+CACHE_SIZE = 1 << 30  # Bytes
+CACHE_DIR = os.environ.get('HID_CACHE_DIR') or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'usb-hid-decoders')
+# Source files behind every entry (parsed hex reports), callers add the ones behind their results
+SOURCES = ('cache.py', 'hid_reports.py')
+
+
+def file_digest(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.cache
+def source_digest(sources: tuple[str, ...]) -> str:
+    '''
+    SHA-256 of source files next to this one
+    '''
+    digest = hashlib.sha256()
+    for name in sources:
+        digest.update(Path(__file__).with_name(name).read_bytes())
+    return digest.hexdigest()
+
+
+class Cache:
+    '''
+    Cache for the results of one input file, a no-op when disabled or the input is not a regular file (e.g. stdin).
+    sources are the files (besides SOURCES) of the code producing the cached results.
+    '''
+    def __init__(self, path, enabled=True, directory=CACHE_DIR, max_size=CACHE_SIZE, sources=()):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.digest = file_digest(path) if enabled and path is not None and os.path.isfile(path) else None
+        self.version = source_digest(SOURCES + tuple(sources)) if self.enabled else None
+
+    @property
+    def enabled(self):
+        return self.digest is not None
+
+    def key(self, *params) -> str:
+        return hashlib.sha256(repr((CACHE_VERSION, self.version, self.digest) + params).encode()).hexdigest()
+
+    def get(self, *params):
+        '''
+        Cached value for params, None on a miss
+        '''
+        if not self.enabled:
+            return None
+        path = self.directory / f'{self.key(*params)}.pickle'
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        touch(path)
+        return value
+
+    def put(self, value, *params):
+        if not self.enabled:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Written to a temporary file first, so concurrent runs never read a partial entry
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, self.directory / f'{self.key(*params)}.pickle')
+        self.evict()
+
+    def cached(self, compute, *params):
+        '''
+        Cached value for params, computed and stored on a miss
+        '''
+        value = self.get(*params)
+        if value is None:
+            value = compute()
+            self.put(value, *params)
+        return value
+
+    def get_files(self, output_folder, *params):
+        '''
+        Copy the files cached for params into output_folder, returns the value stored with them or None on a miss
+        '''
+        if not self.enabled:
+            return None
+        entry = self.directory / self.key(*params)
+        try:
+            with open(entry / 'value.pickle', 'rb') as f:
+                value = pickle.load(f)
+            Path(output_folder).mkdir(parents=True, exist_ok=True)
+            for path in entry.iterdir():
+                if path.name != 'value.pickle':
+                    shutil.copyfile(path, Path(output_folder) / path.name)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        touch(entry)
+        return value
+
+    def put_files(self, paths, value, *params):
+        '''
+        Store copies of files together with a value for params, unless they alone would fill the cache
+        '''
+        if not self.enabled or sum(os.path.getsize(path) for path in paths) > self.max_size:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(dir=self.directory, suffix='.tmp'))
+        for path in paths:
+            shutil.copyfile(path, staging / Path(path).name)
+        with open(staging / 'value.pickle', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        entry = self.directory / self.key(*params)
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            staging.rename(entry)
+        except OSError:
+            # Stored by a concurrent run in the meantime
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in max_size bytes
+        '''
+        entries = []
+        for path in self.directory.iterdir():
+            try:
+                if path.suffix == '.tmp':
+                    continue
+                size = sum(p.stat().st_size for p in path.iterdir()) if path.is_dir() else path.stat().st_size
+                entries.append((path.stat().st_mtime, size, path))
+            except OSError:
+                continue  # Evicted by a concurrent run
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+            total -= size
+
+    def reports(self, file):
+        '''
+        read_reports with timestamps, hex reports come back from the cache as a uint8 report matrix
+        '''
+        from hid_reports import is_binary, read_reports, report_array
+
+        if not self.enabled or is_binary(file.name):
+            # Binary report files are memory-mapped without parsing already
+            return read_reports(file, timestamps=True)
+
+        def parse():
+            raw_data, timestamps = read_reports(file, timestamps=True)
+            return report_array(raw_data), timestamps
+
+        try:
+            return self.cached(parse, 'reports')
+        except ModuleNotFoundError:
+            return read_reports(file, timestamps=True)
+
+
+def touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
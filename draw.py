@@ -1,82 +1,291 @@
 #!/usr/bin/env python3
-import matplotlib.pyplot as plt
+import functools
 import os
 import signal
+import time
 
+from contextlib import nullcontext
+from playback import Playback, has_timestamps
+from raster import click_color
+from simplify import TOLERANCE, cell_size, simplify_movement
 
-signal.signal(signal.SIGINT, lambda signum, frame: os._exit(0))
-listen_keypress = False
 
-try:
-    import keyboard
+# Backends that render to files only, no window to interact with
+HEADLESS_BACKENDS = ('agg', 'cairo', 'pdf', 'pgf', 'ps', 'svg', 'template')
 
-    # Check for non-root access on Linux
-    keyboard.unhook_all()
+# Set by keyboard callbacks, which run on their own thread, and handled between frames
+PAUSE = False
+CLEAR = False
 
-    listen_keypress = True
-except ModuleNotFoundError:
-    print('Module \'keyboard\' not found, keypresses ignored')
-except ImportError:
-    print('Keyboard module requires root access, keypresses ignored')
-except AssertionError:
-    print('Keyboard module failed to create a device file (maybe you are running in WSL?), keypresses ignores')
 
+@functools.cache
+def hook_keyboard():
+    '''
+    Quit on q and sigint (e.g. Ctrl+C), pause on <SPACE>, clear on c. Set up once, on the first drawing shown in a window
+    rather than on import, since the keyboard module scans input devices.
+    Returns the keyboard module, or None if keypresses are ignored.
+    '''
+    signal.signal(signal.SIGINT, lambda signum, frame: os._exit(0))
 
-if listen_keypress:
-    # Force quit on q and sigint (e.g. Ctrl+C)
-    keyboard.on_press_key('q', lambda _: os._exit(0))
+    try:
+        import keyboard
+
+        # Check for non-root access on Linux
+        keyboard.unhook_all()
+    except ModuleNotFoundError:
+        print('Module \'keyboard\' not found, keypresses ignored')
+        return None
+    except ImportError:
+        print('Keyboard module requires root access, keypresses ignored')
+        return None
+    except AssertionError:
+        print('Keyboard module failed to create a device file (maybe you are running in WSL?), keypresses ignored')
+        return None
 
-    # Pause on <SPACE>
-    PAUSE = False
     def pause(_):
         global PAUSE
         PAUSE = True
+
+    def clear(_):
+        global CLEAR
+        CLEAR = True
+
+    keyboard.on_press_key('q', lambda _: os._exit(0))
     keyboard.on_press_key('space', pause)
+    keyboard.on_press_key('c', clear)
+    return keyboard
 
 
-def draw_movement(clicks, xs, ys, draw_mode=1, draw_clicks=False, speed=0):
-    cur_x, cur_y = xs[0], ys[0]
-    mousedown = False
+def shows_window() -> bool:
+    import matplotlib
 
-    # Clear plot on c
-    def clear_screen():
-        plt.cla()
-        plt.axis((min(xs) - 50, max(xs) + 50, min(ys) - 50, max(ys) + 50))
-    if listen_keypress:
-        keyboard.on_press_key('c', lambda _: clear_screen())
+    return matplotlib.get_backend().lower() not in HEADLESS_BACKENDS
+
+
+def movement_artists(ax, clicks, xs, ys, start=0, end=None, draw_mode=1, draw_clicks=False, pressures=None, pressure_style='width', max_pressure=1):
+    '''
+    Add steps start to end of the movement to ax as one LineCollection per button state and one
+    scatter for all clicks, returns the added artists. Each run of movement with the same buttons
+    held is a single polyline, unless pressure varies along it. Arrays are expected as NumPy arrays.
+    '''
+    import numpy as np
+    from matplotlib import rcParams
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import to_rgba
+
+    end = len(clicks) if end is None else end
+    if start >= end:
+        return []
+
+    # Step i moves from point i - 1 to point i, the first one starts and ends at the first point
+    points = np.column_stack((xs[max(start - 1, 0):end], ys[max(start - 1, 0):end]))
+    if start == 0:
+        points = np.concatenate((points[:1], points))
+    chunk = clicks[start:end]
+    previous = clicks[start - 1] if start > 0 else 0
+    style = {'capstyle': rcParams['lines.solid_capstyle'], 'joinstyle': rcParams['lines.solid_joinstyle'], 'zorder': 0}
+    artists = []
+
+    if draw_mode:
+        # Runs of consecutive steps with the same buttons held, relative to the chunk
+        changes = np.flatnonzero(np.diff(chunk)) + 1
+        starts, ends = np.concatenate(([0], changes)), np.concatenate((changes, [len(chunk)]))
+        runs = {}
+        for run_start, run_end in zip(starts.tolist(), ends.tolist()):
+            if draw_mode == 2 or chunk[run_start]:
+                runs.setdefault(int(chunk[run_start]), []).append((run_start, run_end))
+
+        for click, click_runs in runs.items():
+            color = to_rgba(click_color(click))
+            if pressures is not None and click:
+                # Scale width or opacity of each clicked step by pressure
+                steps = np.concatenate([np.arange(run_start, run_end) for run_start, run_end in click_runs])
+                segments = np.stack((points[steps], points[steps + 1]), axis=1)
+                level = np.maximum(np.asarray(pressures[start:end])[steps], 0) / max_pressure
+                colors = np.tile(color, (len(steps), 1))
+                linewidths = np.full(len(steps), 2.0)
+                if pressure_style == 'alpha':
+                    colors[:, 3] = 0.1 + 0.9 * level
+                else:
+                    linewidths = 0.2 + 4 * level
+                artists.append(ax.add_collection(LineCollection(segments, colors=colors, linewidths=linewidths, **style), autolim=False))
+            else:
+                polylines = [points[run_start:run_end + 1] for run_start, run_end in click_runs]
+                artists.append(ax.add_collection(LineCollection(polylines, colors=[color], linewidths=2 if click else 1, **style), autolim=False))
+
+    if draw_clicks:
+        # Clicks are marked where a button is first pressed
+        pressed = (chunk != 0) & (np.concatenate(([previous], chunk[:-1])) == 0)
+        if pressed.any():
+            colors = [click_color(int(click)) for click in chunk[pressed]]
+            offsets = points[1:][pressed]
+            artists.append(ax.scatter(offsets[:, 0], offsets[:, 1], s=64, c=colors, marker='+', linewidths=1, zorder=1))
+
+    return artists
+
+
+def visible_points(ax, clicks, xs, ys, pressures=None, tolerance=TOLERANCE):
+    '''
+    Indices of the points further apart than tolerance pixels at the current size and limits of ax
+    '''
+    bbox = ax.get_window_extent()
+    (left, right), (bottom, top) = ax.get_xlim(), ax.get_ylim()
+    return simplify_movement(clicks, xs, ys, cell_size((right - left, top - bottom), (bbox.width, bbox.height), tolerance), pressures)
 
-    clear_screen()
-    for step, (click, x, y) in enumerate(zip(clicks, xs, ys)):
-        if listen_keypress:
-            # Handle pause, resume on <SPACE>
-            global PAUSE
-            if PAUSE:
-                keyboard.wait('space')
-                PAUSE = False
 
-        left, right, middle = click & 0b1, (click & 0b10) >> 1, (click & 0b100) >> 2
-        color = (left * 0.8, middle * 0.8, right * 0.8) if click else 'lightgray'
+def draw_static(clicks, xs, ys, draw_mode=1, draw_clicks=False, pressures=None, pressure_style='width', tolerance=TOLERANCE):
+    '''
+    Plot all movement at once, as a single set of artists
+    '''
+    import matplotlib.pyplot as plt
+    import numpy as np
 
-        draw_click = draw_clicks and click and not mousedown
-        draw_move = draw_mode == 2 or (draw_mode == 1 and click)
+    clicks, xs, ys = np.asarray(clicks), np.asarray(xs), np.asarray(ys)
+    ax = plt.gca()
+    if len(clicks) == 0:
+        return
+    ax.axis((xs.min() - 50, xs.max() + 50, ys.min() - 50, ys.max() + 50))
+    max_pressure = max(np.max(pressures), 1) if pressures is not None else 1
+    if tolerance:
+        keep = visible_points(ax, clicks, xs, ys, pressures, tolerance)
+        clicks, xs, ys = clicks[keep], xs[keep], ys[keep]
+        pressures = None if pressures is None else np.asarray(pressures)[keep]
+    movement_artists(ax, clicks, xs, ys, 0, None, draw_mode, draw_clicks, pressures, pressure_style, max_pressure)
 
-        if draw_click:
-            plt.plot(x, y, '+', color=color, markersize=8, zorder=1)
 
-        if draw_move:
-            plt.plot((cur_x, x), (cur_y, y), '-', color=color, linewidth=2 if click else 1, zorder=0)
+class Animator:
+    '''
+    Draws movement incrementally by blitting. New artists are drawn onto a cached background of
+    everything drawn so far, which is then cached again, so every frame costs the same however
+    long the drawing gets. The full drawing is only redrawn when the canvas is (e.g. resized).
+    '''
+    def __init__(self, ax):
+        import matplotlib.pyplot as plt
+
+        self.ax = ax
+        self.canvas = ax.figure.canvas
+        self.artists = []
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        plt.show(block=False)
+        self.canvas.draw()
+
+    def on_draw(self, event):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+
+    def add(self, artists):
+        '''Draw new artists on top of the current frame'''
+        if not artists:
+            return
+        self.canvas.restore_region(self.background)
+        for artist in artists:
+            # Animated artists are skipped by full redraws, on_draw draws them instead
+            artist.set_animated(True)
+            self.ax.draw_artist(artist)
+        self.artists += artists
+        self.canvas.blit(self.ax.bbox)
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+
+    def clear(self):
+        for artist in self.artists:
+            artist.remove()
+        self.artists = []
+        self.canvas.draw()
+        self.canvas.blit(self.ax.bbox)
+
+    def wait(self, seconds):
+        '''Keep the window responsive without redrawing it'''
+        self.canvas.flush_events()
+        if seconds > 0:
+            self.canvas.start_event_loop(seconds)
+
+    def finish(self):
+        # Hand the artists back to regular drawing for the final interactive plot
+        for artist in self.artists:
+            artist.set_animated(False)
+
+
+def draw_movement(clicks, xs, ys, draw_mode=1, draw_clicks=False, speed=0, timestamps=None, realtime=None, fps=30, pressures=None, pressure_style='width', tolerance=TOLERANCE):
+    '''
+    Plot movement, animated by speed (0 for a static plot), or at the captured pace
+    given timestamps and a realtime speed factor.
+    Pen pressures scale the 'width' or 'alpha' of clicked lines.
+    Points closer than tolerance pixels to the previous drawn one are skipped (0 to draw every point).
+    '''
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    keyboard = hook_keyboard() if shows_window() else None
+    realtime = realtime if has_timestamps(timestamps) else None
+    if speed == 0 and not realtime:
+        draw_static(clicks, xs, ys, draw_mode, draw_clicks, pressures, pressure_style, tolerance)
+        plt.show()
+        return
+
+    clicks, xs, ys = np.asarray(clicks), np.asarray(xs), np.asarray(ys)
+    if len(clicks) == 0:
+        return
+    max_pressure = max(np.max(pressures), 1) if pressures is not None else 1
+    ax = plt.gca()
+    ax.axis((xs.min() - 50, xs.max() + 50, ys.min() - 50, ys.max() + 50))
+    # Animation speed counts all drawn steps, including the ones skipped
+    drawn = clicks != 0 if draw_mode == 1 else np.full(len(clicks), draw_mode == 2)
+    drawn_count = np.cumsum(drawn)
+    if tolerance:
+        keep = visible_points(ax, clicks, xs, ys, pressures, tolerance)
+        clicks, xs, ys, drawn_count = clicks[keep], xs[keep], ys[keep], drawn_count[keep]
+        pressures = None if pressures is None else np.asarray(pressures)[keep]
+        timestamps = np.asarray(timestamps)[keep] if realtime else timestamps
+    animator = Animator(ax)
+
+    # Ignore c pressed before the animation started
+    global CLEAR
+    CLEAR = False
+
+    def draw_frame(start, end):
+        global CLEAR, PAUSE
+        if CLEAR:
+            animator.clear()
+            CLEAR = False
+        animator.add(movement_artists(ax, clicks, xs, ys, start, end, draw_mode, draw_clicks, pressures, pressure_style, max_pressure))
+
+        # Handle pause, resume on <SPACE>
+        if keyboard and PAUSE:
+            with playback.paused() if realtime else nullcontext():
+                keyboard.wait('space')
+            PAUSE = False
+
+    if realtime:
+        # Render fixed-rate frames of the steps due by then, frames that are late are dropped
+        playback = Playback(timestamps, realtime, sleep=animator.wait)
+        for start, end in playback.frames(fps):
+            draw_frame(start, end)
+    else:
+        # Frames at a fixed rate with a number of drawn steps each depending on speed,
+        # holding the frame on new clicks for a delay depending on speed
+        interval = 1 / fps
+        steps_per_frame = 2 ** (speed - 1) * interval / 0.01
+        pressed = (clicks != 0) & (np.concatenate(([0], clicks[:-1])) == 0) if draw_clicks else np.zeros(len(clicks), dtype=bool)
+        new_clicks = np.flatnonzero(pressed).tolist()
 
-        # Animate using small plot pauses
-        if speed > 0:
-            # Pause on all new clicks, delay depends on speed
-            if draw_click:
-                plt.pause(2 ** (3 - speed))
+        start = 0
+        next_frame = time.perf_counter()
+        while start < len(clicks):
+            # Frame ends after enough drawn steps, or right after the next click
+            end = int(np.searchsorted(drawn_count, (drawn_count[start - 1] if start else 0) + steps_per_frame, side='right'))
+            while new_clicks and new_clicks[0] < start:
+                new_clicks.pop(0)
+            click = new_clicks and new_clicks[0] < end
+            end = max(start + 1, new_clicks[0] + 1 if click else end)
 
-            # Tiny pause on drawn mouse movement, skips some pauses depending on speed
-            elif draw_move and step % 2**(speed - 1) == 0:
-                plt.pause(0.01)
+            draw_frame(start, end)
+            start = end
 
-        cur_x, cur_y = x, y
-        mousedown = click
+            next_frame += 2 ** (3 - speed) if click else interval
+            animator.wait(next_frame - time.perf_counter())
+            next_frame = max(next_frame, time.perf_counter())  # Drop frames that fell behind
 
+    animator.finish()
     plt.show()
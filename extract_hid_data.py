@@ -1,12 +1,36 @@
 import argparse
+import bisect
+import glob
+import json
+import math
+import os
 import struct
-
-from enum import Enum
+import time
+
+from array import array
+from cache import Cache
+from collections import OrderedDict, deque
+from collections.abc import Iterable, Iterator
+from enum import IntEnum
+from itertools import islice
+from hid_descriptor import device_kind
+from hid_reports import DESCRIPTOR_EXTENSION, BinaryReportWriter, HexReportWriter, write_descriptor
 from pathlib import Path
-from scapy.all import *
-
-
-class DESCRIPTOR_TYPE(Enum):
+from pcap_reader import (
+    LINKTYPE_BLUETOOTH_HCI_H4,
+    LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR,
+    LINKTYPE_USB_LINUX,
+    LINKTYPE_USB_LINUX_MMAPPED,
+    LINKTYPE_USBPCAP,
+    SHARD_SIZE,
+    CaptureFormatError,
+    Shard,
+    read_capture,
+    shard_capture
+)
+
+
+class DESCRIPTOR_TYPE(IntEnum):
     DEVICE = 0x01
     CONFIGURATION = 0x02
     STRING = 0x03
@@ -22,7 +46,7 @@ class DESCRIPTOR_TYPE(Enum):
     SUPER_SPEED_ENDPOINT_COMPANION = 0x30
 
 
-class INTERFACE_PROTOCOL(Enum):
+class INTERFACE_PROTOCOL(IntEnum):
     UNKNOWN = 0x00
     KEYBOARD = 0x01
     MOUSE = 0x02
@@ -30,25 +54,25 @@ class INTERFACE_PROTOCOL(Enum):
     UNKNOWN_2 = 0xff
 
 
-class TRANSFER_TYPE(Enum):
+class TRANSFER_TYPE(IntEnum):
     ISOCHRONOUS = 0x00
     INTERRUPT = 0x01
     CONTROL = 0x02
     BULK = 0x03
 
 
-class EVENT_TYPE(Enum):
+class EVENT_TYPE(IntEnum):
     SUBMIT = ord('S')  # Transfer begins
     COMPLETE = ord('C')  # Transfer completes
     ERROR = ord('E')
 
 
-class DIRECTION(Enum):
+class DIRECTION(IntEnum):
     OUT = 0x00
     IN = 0x01
 
 
-class REQUEST_TYPE(Enum):
+class REQUEST_TYPE(IntEnum):
     GET_STATUS = 0x00
     CLEAR_FEATURE = 0x01
     SET_FEATURE = 0x03
@@ -60,101 +84,176 @@ class REQUEST_TYPE(Enum):
     SET_INTERFACE = 0x0B
 
 
+# Bluetooth HCI/L2CAP constants
+HCI_ACL_PACKET = 0x02
+L2CAP_CID_ATT = 0x0004
+L2CAP_CID_DYNAMIC = 0x0040
+ATT_HANDLE_VALUE_NOTIFICATION = 0x1B
+HIDP_DATA_INPUT = 0xA1
+
+# Files picked up when a folder is given in batch mode
+CAPTURE_EXTENSIONS = {'.pcap', '.pcapng', '.cap', '.btsnoop'}
+
+# Control packets after which an unanswered descriptor request is dropped
+REQUEST_WINDOW = 1024
+
+# Larger captures are not cached, hashing them is a full extra read and their results would crowd out the cache
+CACHED_CAPTURE_SIZE = 256 << 20  # Bytes
+
+
 class USB_URB:
-    def __init__(self, urb_id, transfer_type, endpoint_address, device_address, bus_id, data_len, direction, extra_data):
-        self.id = urb_id
-        self.transfer_type = TRANSFER_TYPE(transfer_type)
-        self.endpoint_number = endpoint_address & 0x7F
-        self.device_address = device_address
-        self.bus_id = bus_id
-        self.data_len = data_len
-        self.direction = direction
-        self.extra_data = extra_data
-    
+    '''
+    Compact view of a captured URB. Only the fields needed to route a packet are
+    decoded up front, the rest are read from the underlying buffer when accessed.
+    '''
+    __slots__ = ('packet', 'ts', 'id', 'transfer_type', 'endpoint_address', 'device_address', 'bus_id', 'data_len', 'direction')
+
+    @property
+    def endpoint_number(self):
+        return self.endpoint_address & 0x7F
+
     def has_hid_data(self):
         return (self.data_len > 0 and
                 self.transfer_type == TRANSFER_TYPE.INTERRUPT and
                 self.direction == DIRECTION.IN)
 
     def get_address(self):
-        return f'{self.bus_id}.{self.device_address}.{self.endpoint_number}'
+        return f'{self.bus_id}.{self.device_address}.{self.endpoint_address & 0x7F}'
 
 
 class USB_URB_1(USB_URB):
+    '''
+    USBPcap packet (LINKTYPE_USBPCAP)
+    Direction is the IRP direction, i.e. OUT for requests and IN for completions
+    '''
+    __slots__ = ('header_len',)
+    header = struct.Struct('<HQ4x2xBHHBBI')
+
     def __init__(self, packet):
+        self.packet = packet
         (self.header_len,
-        self.irp_id,
-        self.usbd_status,
-        self.function,
-        self.irp_info,
+        self.id,
+        irp_info,
         self.bus_id,
         self.device_address,
         self.endpoint_address,
         self.transfer_type,
-        self.data_len) = struct.unpack('<HQIHBHHBBI', packet[:27])
-        if self.header_len == 28:
-            self.control_stage = packet[27]
+        self.data_len) = self.header.unpack_from(packet)
+        self.direction = irp_info & 0x01
 
-        self.direction = DIRECTION(self.irp_info & 0x01)
-        self.setup_data = packet[self.header_len:]
+    @property
+    def irp_id(self):
+        return self.id
 
-        super().__init__(
-            self.irp_id,
-            self.transfer_type,
-            self.endpoint_address,
-            self.device_address,
-            self.bus_id,
-            self.data_len,
-            self.direction,
-            packet[self.header_len:]
-        )
+    @property
+    def usbd_status(self):
+        return struct.unpack_from('<I', self.packet, 10)[0]
+
+    @property
+    def function(self):
+        return struct.unpack_from('<H', self.packet, 14)[0]
+
+    @property
+    def irp_info(self):
+        return self.packet[16]
+
+    @property
+    def control_stage(self):
+        return self.packet[27] if self.header_len >= 28 else None
+
+    @property
+    def setup_data(self):
+        return self.packet[self.header_len:]
+
+    @property
+    def extra_data(self):
+        return self.packet[self.header_len:]
 
 
 class USB_URB_2(USB_URB):
+    '''
+    Linux usbmon packet with the 64 byte header (LINKTYPE_USB_LINUX_MMAPPED)
+    Direction follows the event type like USBPcap, OUT for submissions and IN for completions
+    '''
+    __slots__ = ('urb_type', 'setup_flag')
+    header = struct.Struct('<QBBBBHB21xI')
+    header_len = 64
+
     def __init__(self, packet):
-        (self.urb_id,
+        self.packet = packet
+        (self.id,
         self.urb_type,
         self.transfer_type,
         self.endpoint_address,
         self.device_address,
         self.bus_id,
         self.setup_flag,
-        self.data_flag,
-        self.urb_ts_sec,
-        self.urb_ts_usec,
-        self.urb_status,
-        self.urb_len,
-        self.data_len,
-        self.setup_data,
-        self.interval,
-        self.start_frame,
-        self.copy_of_transfer_flags,
-        self.iso_numdesc) = struct.unpack('<QBBBBHBBQIIIIQIIII', packet[:64])
-
-        self.direction = DIRECTION(self.endpoint_address & 0x80 >> 7)
-        self.urb_type = EVENT_TYPE(self.urb_type)
-        self.setup_data_relevant = self.setup_flag == 0
-        self.data_present = self.data_flag == 0
-        self.setup_data = struct.pack('<Q', self.setup_data)
-
-        super().__init__(
-            self.urb_id,
-            self.transfer_type,
-            self.endpoint_address,
-            self.device_address,
-            self.bus_id,
-            self.data_len,
-            self.direction,
-            packet[64:]
-        )
+        self.data_len) = self.header.unpack_from(packet)
+        self.direction = DIRECTION.OUT if self.urb_type == EVENT_TYPE.SUBMIT else DIRECTION.IN
+
+    @property
+    def urb_id(self):
+        return self.id
+
+    @property
+    def setup_data_relevant(self):
+        return self.setup_flag == 0
+
+    @property
+    def data_flag(self):
+        return self.packet[15]
+
+    @property
+    def data_present(self):
+        return self.data_flag == 0
+
+    @property
+    def urb_ts_sec(self):
+        return struct.unpack_from('<q', self.packet, 16)[0]
+
+    @property
+    def urb_ts_usec(self):
+        return struct.unpack_from('<i', self.packet, 24)[0]
+
+    @property
+    def urb_status(self):
+        return struct.unpack_from('<i', self.packet, 28)[0]
+
+    @property
+    def urb_len(self):
+        return struct.unpack_from('<I', self.packet, 32)[0]
+
+    @property
+    def setup_data(self):
+        return self.packet[40:48] if self.setup_flag == 0 else b''
+
+    @property
+    def interval(self):
+        return struct.unpack_from('<i', self.packet, 48)[0]
+
+    @property
+    def start_frame(self):
+        return struct.unpack_from('<i', self.packet, 52)[0]
+
+    @property
+    def copy_of_transfer_flags(self):
+        return struct.unpack_from('<I', self.packet, 56)[0]
+
+    @property
+    def iso_numdesc(self):
+        return struct.unpack_from('<I', self.packet, 60)[0]
+
+    @property
+    def extra_data(self):
+        return self.packet[self.header_len:]
 
     def __str__(self):
         out = ''
         out += f'URB id: {hex(self.urb_id)}\n'
-        out += f'URB type: {self.urb_type}\n'
-        out += f'URB transfer type: {self.transfer_type}\n'
+        out += f'URB type: {EVENT_TYPE(self.urb_type).name}\n'
+        out += f'URB transfer type: {TRANSFER_TYPE(self.transfer_type).name}\n'
         out += f'Endpoint: {self.endpoint_address}\n'
-        out += f'\tDirection: {self.direction}\n'
+        out += f'\tDirection: {DIRECTION(self.direction).name}\n'
         out += f'\tEndpoint number: {self.endpoint_number}\n'
         out += f'Device: {self.device_address}\n'
         out += f'URB bus id: {self.bus_id}\n'
@@ -166,127 +265,505 @@ class USB_URB_2(USB_URB):
         out += f'Data length: {self.data_len}\n'
         if not self.setup_data_relevant:
             out += f'Unused Setup Header\n'
-        out += f'Interval: {self.interval}\n'
-        out += f'Start frame: {self.start_frame}\n'
-        out += f'Copy of transfer flags: {"0x" + hex(self.copy_of_transfer_flags)[2:].zfill(8)}\n'
-        out += f'Number of ISO descriptors: {self.iso_numdesc}\n'
+        if self.header_len == 64:
+            out += f'Interval: {self.interval}\n'
+            out += f'Start frame: {self.start_frame}\n'
+            out += f'Copy of transfer flags: {"0x" + hex(self.copy_of_transfer_flags)[2:].zfill(8)}\n'
+            out += f'Number of ISO descriptors: {self.iso_numdesc}\n'
         if self.data_len > 0:
             out += f'Extra data: {self.extra_data.hex()}\n'
         return out
 
 
-def get_devices(packets: [USB_URB]) -> dict:
-    devices = {}
-    descriptor_requests = []
-    for packet in packets:
-        if packet.transfer_type != TRANSFER_TYPE.CONTROL:
-            continue
-        
+class USB_URB_2_LEGACY(USB_URB_2):
+    '''
+    Linux usbmon packet with the original 48 byte header (LINKTYPE_USB_LINUX)
+    '''
+    __slots__ = ()
+    header_len = 48
+
+
+class HCI_ACL(USB_URB):
+    '''
+    HID report carried over Bluetooth, either as an ATT notification (BLE HID over GATT)
+    or on a classic L2CAP HID interrupt channel. The address is bt.<connection>.<handle/channel>.
+    '''
+    __slots__ = ('connection', 'channel', 'extra_data')
+    header = struct.Struct('<HHHH')
+
+    def __init__(self, connection, channel, report):
+        self.packet = report
+        self.id = 0
+        self.transfer_type = TRANSFER_TYPE.INTERRUPT
+        self.endpoint_address = 0
+        self.device_address = 0
+        self.bus_id = 'bt'
+        self.data_len = len(report)
+        self.direction = DIRECTION.IN
+        self.connection = connection
+        self.channel = channel
+        self.extra_data = report
+
+    def get_address(self):
+        return f'bt.{self.connection:#x}.{self.channel:#x}'
+
+    @classmethod
+    def from_h4(cls, packet):
+        if len(packet) < 10 or packet[0] != HCI_ACL_PACKET:
+            return None
+
+        handle, acl_len, l2cap_len, cid = cls.header.unpack_from(packet, 1)
+        if handle & 0x3000 == 0x1000 or l2cap_len > len(packet) - 9:
+            return None  # Continuation fragment or fragmented L2CAP frame
+        payload = packet[9:9 + l2cap_len]
+
+        if cid == L2CAP_CID_ATT:
+            if len(payload) < 3 or payload[0] != ATT_HANDLE_VALUE_NOTIFICATION:
+                return None
+            return cls(handle & 0x0FFF, payload[1] | payload[2] << 8, payload[3:])
+
+        if cid >= L2CAP_CID_DYNAMIC and len(payload) > 1 and payload[0] == HIDP_DATA_INPUT:
+            return cls(handle & 0x0FFF, cid, payload[1:])
+
+        return None
+
+    @classmethod
+    def from_h4_with_phdr(cls, packet):
+        return cls.from_h4(packet[4:])
+
+    def __str__(self):
+        return f'HID report on {self.get_address()}: {self.extra_data.hex()}\n'
+
+
+PARSERS = {
+    LINKTYPE_USBPCAP: USB_URB_1,
+    LINKTYPE_USB_LINUX_MMAPPED: USB_URB_2,
+    LINKTYPE_USB_LINUX: USB_URB_2_LEGACY,
+    LINKTYPE_BLUETOOTH_HCI_H4: HCI_ACL.from_h4,
+    LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR: HCI_ACL.from_h4_with_phdr,
+}
+
+
+class DeviceTracker:
+    '''
+    Resolves HID endpoints to device types from GET_DESCRIPTOR(CONFIGURATION) transfers,
+    and collects their report descriptors from GET_DESCRIPTOR(HID_REPORT) transfers.
+
+    Requests are matched to responses by (bus, device, URB id) and expire after
+    request_window control packets without a response. When an address is assigned
+    again (SET_ADDRESS) after the device at that address has sent reports, e.g. when
+    re-plugged, it gets a new version and its endpoints are addressed as
+    <bus>.<device>.<endpoint>_<version> from then on.
+    '''
+    def __init__(self, request_window=REQUEST_WINDOW):
+        self.request_window = request_window
+        self.requests = OrderedDict()  # (bus, device, URB id) -> (control packet sequence number, descriptor type, interface)
+        self.sequence = 0
+        self.devices = {}  # Versioned address -> device type
+        self.descriptors = {}  # Versioned address -> HID report descriptor
+        self.interfaces = {}  # (bus.device, interface) -> versioned addresses of its IN endpoints
+        self.addresses = {}  # Raw address -> versioned address, for devices with reports in their current version
+        self.versions = {}  # bus.device -> current version
+
+    def update(self, packet: USB_URB):
+        self.sequence += 1
+        key = (packet.bus_id, packet.device_address, packet.id)
+
         if packet.direction == DIRECTION.OUT:
-            # Get descriptor requests
-            bRequest = REQUEST_TYPE(packet.setup_data[1])
-            if bRequest != REQUEST_TYPE.GET_DESCRIPTOR:
-                continue
-            
-            try:
-                bDescriptorType = DESCRIPTOR_TYPE(packet.setup_data[3])
-            except ValueError:
-                continue
-
-            if bDescriptorType != DESCRIPTOR_TYPE.CONFIGURATION:
-                continue
-            descriptor_requests.append(packet.id)
-            continue
+            setup = packet.setup_data
+            if len(setup) < 8:
+                return
+
+            # Device (re-)enumeration
+            if setup[0] == 0x00 and setup[1] == REQUEST_TYPE.SET_ADDRESS:
+                self.new_version(f'{packet.bus_id}.{setup[2] | setup[3] << 8}')
+                return
+
+            # Get descriptor requests, report descriptors are requested per interface (wIndex)
+            if setup[1] != REQUEST_TYPE.GET_DESCRIPTOR or setup[3] not in (DESCRIPTOR_TYPE.CONFIGURATION, DESCRIPTOR_TYPE.HID_REPORT):
+                return
+            self.requests.pop(key, None)
+            self.requests[key] = (self.sequence, setup[3], setup[4])
+            self.expire_requests()
+            return
 
         # Get descriptor responses
-        if packet.id not in descriptor_requests:
-            continue
-        descriptor_requests.remove(packet.id)
-
+        request = self.requests.pop(key, None)
+        if request is None:
+            return
+        _, descriptor_type, interface = request
+        device = f'{packet.bus_id}.{packet.device_address}'
+        if descriptor_type == DESCRIPTOR_TYPE.CONFIGURATION:
+            self.add_configuration(device, packet.extra_data)
+        else:
+            self.add_report_descriptor(device, interface, packet.extra_data)
+
+    def expire_requests(self):
+        while self.requests:
+            key, (sequence, _, _) = next(iter(self.requests.items()))
+            if self.sequence - sequence <= self.request_window:
+                break
+            self.requests.popitem(last=False)
+
+    def new_version(self, device: str):
+        # Only start a new version if the current one has sent reports
+        stale = [raw for raw in self.addresses if raw.rsplit('.', 1)[0] == device]
+        if stale:
+            self.versions[device] = self.versions.get(device, 0) + 1
+            for raw in stale:
+                del self.addresses[raw]
+
+    def add_configuration(self, device: str, data: bytes):
         i = 0
-        current_device = None
-        while i < packet.data_len:
-            bLength = packet.extra_data[i]
-            bDescriptorType = DESCRIPTOR_TYPE(packet.extra_data[i + 1])
-
-            if bDescriptorType == DESCRIPTOR_TYPE.INTERFACE:
-                current_device = INTERFACE_PROTOCOL(packet.extra_data[i + 7])
-            elif bDescriptorType == DESCRIPTOR_TYPE.ENDPOINT:
-                bEndpointNumber = packet.extra_data[i + 2] & 0x7F
-                addr = f'{packet.bus_id}.{packet.device_address}.{bEndpointNumber}'
-                devices[addr] = {
-                    'device': current_device.name.lower(),
-                    'data': []
-                }
+        current_device = 'unknown'
+        current_interface = None
+        while i + 1 < len(data):
+            bLength = data[i]
+            bDescriptorType = data[i + 1]
+            if bLength == 0 or i + bLength > len(data):
+                break
+
+            if bDescriptorType == DESCRIPTOR_TYPE.INTERFACE and bLength >= 9:
+                current_interface = data[i + 2]
+                self.interfaces[(device, current_interface)] = []
+                try:
+                    current_device = INTERFACE_PROTOCOL(data[i + 7]).name.lower()
+                except ValueError:
+                    current_device = 'unknown'
+            elif bDescriptorType == DESCRIPTOR_TYPE.ENDPOINT and bLength >= 7 and data[i + 2] & 0x80:
+                # Only IN endpoints carry HID reports, OUT endpoints may share the endpoint number
+                bEndpointNumber = data[i + 2] & 0x7F
+                addr = self.versioned(f'{device}.{bEndpointNumber}')
+                self.devices[addr] = current_device
+                if current_interface is not None:
+                    self.interfaces[(device, current_interface)].append(addr)
             i += bLength
 
-    return devices
+    def add_report_descriptor(self, device: str, interface: int, data: bytes):
+        addresses = self.interfaces.get((device, interface), [])
+        described = [self.descriptors[addr] for addr in addresses if addr in self.descriptors]
+        if bytes(data) in described:
+            return
+        if described:
+            # USBPcap requests report descriptors with wIndex 0 for every interface,
+            # they come in interface order so this one belongs to the next interface without one
+            pending = [
+                addrs for (dev, _), addrs in sorted(self.interfaces.items())
+                if dev == device and addrs and not any(addr in self.descriptors for addr in addrs)
+            ]
+            addresses = pending[0] if pending else addresses
+        for addr in addresses:
+            self.descriptors[addr] = bytes(data)
+            if self.devices.get(addr) == 'unknown':
+                # Only boot keyboards and mice have an interface protocol, e.g. tablets have none
+                self.devices[addr] = device_kind(data) or 'unknown'
+
+    def versioned(self, raw: str) -> str:
+        version = self.versions.get(raw.rsplit('.', 1)[0], 0)
+        return raw if version == 0 else f'{raw}_{version}'
+
+    def resolve(self, raw: str) -> str:
+        addr = self.addresses.get(raw)
+        if addr is None:
+            addr = self.addresses[raw] = self.versioned(raw)
+            self.devices.setdefault(addr, 'unknown')
+        return addr
+
+
+def get_devices(packets: Iterable[USB_URB]) -> dict:
+    tracker = DeviceTracker()
+    for packet in packets:
+        if packet.transfer_type == TRANSFER_TYPE.CONTROL:
+            tracker.update(packet)
+
+    return tracker.devices
 
 
-def extract_hid_data(packets: [USB_URB], devices: dict) -> dict:
+def extract_hid_data(packets: Iterable[USB_URB], tracker: DeviceTracker) -> Iterator[tuple[str, float, bytes]]:
+    '''
+    Single pass over the packets, resolving devices from descriptors as they appear.
+    Yields (address, timestamp, data) for each HID report, tracker.devices is updated in place.
+    '''
     for packet in packets:
+        if packet.transfer_type == TRANSFER_TYPE.CONTROL:
+            tracker.update(packet)
+            continue
+
+        if not packet.has_hid_data():
+            continue
+
+        yield tracker.resolve(packet.get_address()), packet.ts, packet.extra_data
+
+
+def extract_shard(filename: str, shard: Shard) -> tuple[list, dict]:
+    '''
+    Sharded extraction worker. Returns the control packets of the shard, to be replayed
+    through a DeviceTracker when merging, and the HID reports per raw endpoint address.
+    Both are tagged with the packet index in the shard to restore their relative order.
+    '''
+    controls = []
+    reports = {}  # Raw address -> (packet indices, timestamps, report end offsets, concatenated reports)
+    for index, packet in enumerate(read_packets(read_capture(filename, shard))):
+        if packet.transfer_type == TRANSFER_TYPE.CONTROL:
+            controls.append((index, type(packet), bytes(packet.packet)))
+            continue
+
         if not packet.has_hid_data():
             continue
 
         addr = packet.get_address()
-        if addr not in devices:
-            devices[addr] = {
-                'device': 'unknown',
-                'data': []
-            }
-        devices[addr]['data'].append(packet.extra_data)
+        if addr not in reports:
+            reports[addr] = (array('Q'), array('d'), array('Q'), bytearray())
+        indices, timestamps, offsets, data = reports[addr]
+        data += packet.extra_data
+        indices.append(index)
+        timestamps.append(math.nan if packet.ts is None else packet.ts)
+        offsets.append(len(data))
+
+    return controls, reports
+
+
+def merge_shards(shard_results: Iterable[tuple[list, dict]], tracker: DeviceTracker) -> Iterator[tuple[str, float, bytes]]:
+    '''
+    Merge shard results in capture order. Reports between two control packets are
+    resolved with the tracker state at that point, exactly like the serial path.
+    '''
+    for controls, reports in shard_results:
+        positions = dict.fromkeys(reports, 0)
+        for index, parser, frame in controls + [(math.inf, None, None)]:
+            for raw, (indices, timestamps, offsets, data) in reports.items():
+                start = positions[raw]
+                end = bisect.bisect_left(indices, index, start)
+                if end == start:
+                    continue
+
+                addr = tracker.resolve(raw)
+                view = memoryview(data)
+                offset = offsets[start - 1] if start > 0 else 0
+                for i in range(start, end):
+                    yield addr, timestamps[i], view[offset:offsets[i]]
+                    offset = offsets[i]
+                positions[raw] = end
+
+            if parser is not None:
+                tracker.update(parser(frame))
+
+
+def extract_sharded(filename: str, shards: list[Shard], tracker: DeviceTracker, jobs: int) -> Iterator[tuple[str, float, bytes]]:
+    '''
+    Parse shards in parallel, at most 2 * jobs of them ahead of the merge, so the shard
+    results held in memory are bounded whatever the size of the capture
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    def results(executor):
+        remaining = iter(shards)
+        pending = deque(executor.submit(extract_shard, filename, shard) for shard in islice(remaining, 2 * jobs))
+        while pending:
+            result = pending.popleft().result()
+            pending.extend(executor.submit(extract_shard, filename, shard) for shard in islice(remaining, 1))
+            yield result
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from merge_shards(results(executor), tracker)
+
+
+def read_packets(frames: Iterable[tuple[int, float, bytes]]) -> Iterator[USB_URB]:
+    skipped = set()
+    for linktype, ts, data in frames:
+        parser = PARSERS.get(linktype)
+        if parser is None:
+            if linktype not in skipped:
+                print(f'Skipping frames with unsupported link type {linktype}')
+                skipped.add(linktype)
+            continue
+
+        try:
+            packet = parser(data)
+        except struct.error:
+            continue  # Truncated frame
 
-    return {addr: info for addr, info in devices.items() if len(info['data']) > 0}
+        if packet is not None:
+            packet.ts = ts
+            yield packet
 
 
-def extract_data(filename: str) -> dict:
+def read_capture_scapy(filename: str) -> Iterator[tuple[int, float, bytes]] | None:
+    '''
+    Fallback for capture formats not handled by the built-in reader, requires scapy
+    '''
+    try:
+        from scapy.error import Scapy_Exception
+        from scapy.utils import RawPcapReader, RawPcapNgReader
+    except ModuleNotFoundError:
+        return None
+
     try:
-        pcap = rdpcap(filename)
+        pcap = RawPcapReader(filename)
     except Scapy_Exception:
-        print('File is not in PCAP format, assuming raw hex data..')
-        try:
-            with open(filename) as f:
-                return {
-                    '0.0.0': {
-                        'device': 'unknown',
-                        'data': [bytes.fromhex(line) for line in f]
-                    }
-                }
-        except ValueError:
-            print('File is not in hex format, exiting...')
-            exit()
+        return None
 
-    usb_packets = []
-    for packet in pcap:
-        data = bytes(packet)
+    def frames():
+        with pcap:
+            for data, meta in pcap:
+                if isinstance(pcap, RawPcapNgReader):
+                    yield meta.linktype, ((meta.tshigh << 32) | meta.tslow) / meta.tsresol, data
+                else:
+                    yield pcap.linktype, meta.sec + meta.usec / 1e6, data
+    return frames()
+
+
+def read_hex(filename: str) -> Iterator[tuple[str, float, bytes]]:
+    with open(filename) as f:
         try:
-            if len(data) >= 64:
-                try:
-                    usb_packets.append(USB_URB_2(data))
-                except ValueError:
-                    usb_packets.append(USB_URB_1(data))
-            else:
-                usb_packets.append(USB_URB_1(data))
+            for line in f:
+                yield '0.0.0', None, bytes.fromhex(line)
         except ValueError:
-            continue
+            raise CaptureFormatError(f'{filename} is not in hex format')
 
-    devices = get_devices(usb_packets)
-    return extract_hid_data(usb_packets, devices)
 
+def extract_data(filename: str, jobs: int = 1, tracker: DeviceTracker = None, shard_size: int = SHARD_SIZE) -> tuple[dict, Iterator[tuple[str, float, bytes]]]:
+    '''
+    Returns the device table and a lazy stream of (address, timestamp, data) HID reports.
+    The device table (and the report descriptors of a given tracker) is only complete once the stream is exhausted.
+    With jobs > 1, pcap/pcapng files are split into shards of shard_size bytes parsed in parallel.
+    '''
+    tracker = tracker or DeviceTracker()
+    try:
+        if jobs > 1 and (shards := shard_capture(filename, shard_size)) and len(shards) > 1:
+            return tracker.devices, extract_sharded(filename, shards, tracker, jobs)
+        frames = read_capture(filename)
+    except CaptureFormatError:
+        frames = read_capture_scapy(filename)
+        if frames is None:
+            print('File is not in PCAP format, assuming raw hex data..')
+            return {'0.0.0': 'unknown'}, read_hex(filename)
+
+    return tracker.devices, extract_hid_data(read_packets(frames), tracker)
 
-def write_results(hid_data: dict, output_folder: str):
+
+def write_results(devices: dict, hid_data: Iterable[tuple[str, float, bytes]], output_folder: str, binary: bool = False, timestamps: bool = False, descriptors: dict = None):
     out = Path(output_folder)
     if not out.exists():
-        out.mkdir()
+        out.mkdir(parents=True)
     elif not out.is_dir():
         print(f'Output path {output_folder} exists but is not a directory, exiting...')
         exit()
 
-    for addr, info in hid_data.items():
-        print(f'Found HID data for {info["device"]} device at {addr}, writing to {output_folder}...')
-        with open(f'{output_folder}/{info["device"]}-{addr}.txt', 'w') as f:
-            for line in info['data']:
-                f.write(line.hex() + '\n')
+    # Stream reports to one file per endpoint, named once the device type is final
+    writers = {}
+    counts = {}
+    try:
+        for addr, ts, data in hid_data:
+            if addr not in writers:
+                extension = BinaryReportWriter.extension if binary else HexReportWriter.extension
+                path = out / f'{addr}{extension}.part'
+                writers[addr] = BinaryReportWriter(path, addr) if binary else HexReportWriter(path, timestamps)
+                counts[addr] = 0
+            writers[addr].write(ts, data)
+            counts[addr] += 1
+    except BaseException:
+        # Leave no partial files behind
+        for writer in writers.values():
+            writer.discard()
+        raise
+    for addr, writer in writers.items():
+        writer.close(devices[addr])
+
+    results = {}
+    for addr, writer in writers.items():
+        print(f'Found HID data for {devices[addr]} device at {addr}, writing to {output_folder}...')
+        writer.path.replace(out / f'{devices[addr]}-{addr}{writer.extension}')
+        results[addr] = {'device': devices[addr], 'reports': counts[addr]}
+        if descriptors and addr in descriptors:
+            # Report descriptors are written next to the reports, for the decoders to pick up
+            write_descriptor(out / f'{devices[addr]}-{addr}{DESCRIPTOR_EXTENSION}', descriptors[addr])
+            results[addr]['descriptor'] = f'{devices[addr]}-{addr}{DESCRIPTOR_EXTENSION}'
+
+    return results
+
+
+def extract_cached(filename: str, output_folder: str, binary: bool = False, timestamps: bool = False, jobs: int = 1, use_cache: bool = True) -> dict:
+    '''
+    Extract a capture and write the results, or copy them from the cache if the same capture
+    was extracted with the same options before. Returns the devices as write_results.
+    Parallel (jobs > 1) extraction and captures over CACHED_CAPTURE_SIZE bypass the cache.
+    '''
+    use_cache = use_cache and jobs == 1 and os.path.getsize(filename) <= CACHED_CAPTURE_SIZE
+    cache = Cache(filename, enabled=use_cache, sources=('extract_hid_data.py', 'hid_descriptor.py', 'pcap_reader.py'))
+    params = ('extract', binary, timestamps)
+    results = cache.get_files(output_folder, *params)
+    if results is not None:
+        for addr, entry in results.items():
+            print(f'Found HID data for {entry["device"]} device at {addr} in the cache, writing to {output_folder}...')
+        return results
+
+    tracker = DeviceTracker()
+    devices, hid_data = extract_data(filename, jobs, tracker)
+    results = write_results(devices, hid_data, output_folder, binary, timestamps, tracker.descriptors)
+
+    extension = BinaryReportWriter.extension if binary else HexReportWriter.extension
+    paths = [Path(output_folder) / f'{entry["device"]}-{addr}{extension}' for addr, entry in results.items()]
+    paths += [Path(output_folder) / entry['descriptor'] for entry in results.values() if 'descriptor' in entry]
+    cache.put_files(paths, results, *params)
+    return results
+
+
+def extract_capture(filename: str, output_folder: str, binary: bool = False, timestamps: bool = False, use_cache: bool = True) -> dict:
+    '''
+    Batch worker, extracts a single capture and returns its manifest entry
+    '''
+    start = time.perf_counter()
+    entry = {'capture': filename, 'output': output_folder}
+    try:
+        entry['devices'] = extract_cached(filename, output_folder, binary, timestamps, use_cache=use_cache)
+    except SystemExit:
+        entry['error'] = 'extraction failed'
+    except Exception as e:
+        entry['error'] = repr(e)
+    entry['seconds'] = round(time.perf_counter() - start, 3)
+    return entry
+
+
+def find_captures(inputs: list[str]) -> list[Path]:
+    captures = []
+    for pattern in inputs:
+        paths = [Path(p) for p in sorted(glob.glob(pattern, recursive=True))] or [Path(pattern)]
+        for path in paths:
+            if path.is_dir():
+                captures += sorted(p for p in path.rglob('*') if p.suffix.lower() in CAPTURE_EXTENSIONS)
+            else:
+                captures.append(path)
+    return list(dict.fromkeys(captures))
+
+
+def extract_batch(captures: list[Path], output_folder: str, workers: int = None, binary: bool = False, timestamps: bool = False, use_cache: bool = True):
+    '''
+    Extract captures in parallel, each into a subfolder mirroring its path relative to
+    the common parent folder, and write a JSON manifest of the results
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    root = Path(os.path.commonpath([c.resolve().parent for c in captures]))
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(extract_capture, str(c), str(Path(output_folder) / c.resolve().relative_to(root).with_suffix('')), binary, timestamps, use_cache)
+            for c in captures
+        ]
+        entries = [f.result() for f in futures]
+
+    manifest = {
+        'captures': entries,
+        'workers': workers or os.cpu_count(),
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+    Path(output_folder).mkdir(parents=True, exist_ok=True)
+    with open(Path(output_folder) / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    failed = sum('error' in e for e in entries)
+    print(f'Extracted {len(entries) - failed}/{len(entries)} captures in {manifest["seconds"]}s, manifest written to {output_folder}/manifest.json')
 
 
 def parse_args():
@@ -294,15 +771,49 @@ def parse_args():
         description='Extract and/or pre-process HID data',
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument('file', help='input file (pcap or hex data)')
+    parser.add_argument('file', nargs='*', help='input file (pcap or hex data)\nmultiple files, folders, or glob patterns are extracted in batch mode')
     parser.add_argument('-o', '--output', default='output', help='output folder (default \'%(default)s\')')
-    return parser.parse_args()
+    parser.add_argument('-f', '--format', choices=('hex', 'bin'), default='hex', help='''output format (default: %(default)s)
+    hex: one hex encoded report per line
+    bin: binary container with timestamps, memory-mapped by the decoders''')
+    parser.add_argument('-t', '--timestamps', action='store_true', help='prefix each hex report with its capture timestamp (\'<seconds>\\t<hex>\')')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='parse a single pcap/pcapng file in shards with N parallel workers (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int, help='worker processes in batch mode (default: CPU count)')
+    parser.add_argument('--no-cache', action='store_true', help='always extract, without reading or storing results in the cache')
+    parser.add_argument('-l', '--live', metavar='PATH', help='decode reports live from a usbmon device (e.g. /dev/usbmon1) or named pipe')
+    parser.add_argument('--header', type=int, choices=(48, 64), help='usbmon header length in live mode (default: 48 for devices, 64 for pipes)')
+    parser.add_argument('-d', '--device', action='append', default=[], metavar='ADDRESS=TYPE', help='decode the endpoint at ADDRESS as keyboard, mouse, or tablet in live mode,\nfor devices enumerated before the capture started')
+    parser.add_argument('--offset', type=int, help='byte offset of mouse and tablet data in live mode, for devices without a captured\nreport descriptor (default: 0 for mice, 1 for tablets)')
+    parser.add_argument('-b', '--bit-lengths', type=int, choices=[8, 12, 16], nargs=3, metavar=('CLICK', 'X', 'Y'), help='bit lengths of each mouse data field [click, x, y] in live mode, for mice without\na captured report descriptor (default: 8 8 8)')
+    args = parser.parse_args()
+    if not args.file and not args.live:
+        parser.error('a file or --live is required')
+    return args
 
 
 def main():
     args = parse_args()
-    hid_data = extract_data(args.file)
-    write_results(hid_data, args.output)
+    if args.live:
+        from live_capture import live_capture
+
+        devices = dict(d.split('=', 1) for d in args.device if '=' in d)
+        count = live_capture(args.live, args.header, devices, offset=args.offset, bit_lengths=args.bit_lengths)
+        print(f'Decoded {count} live reports')
+        return
+
+    if len(args.file) == 1 and Path(args.file[0]).is_file():
+        try:
+            extract_cached(args.file[0], args.output, args.format == 'bin', args.timestamps, args.jobs, not args.no_cache)
+        except CaptureFormatError as e:
+            print(f'{e}, exiting...')
+            exit()
+        return
+
+    captures = find_captures(args.file)
+    if not captures:
+        print('No capture files found, exiting...')
+        exit()
+    extract_batch(captures, args.output, args.workers, args.format == 'bin', args.timestamps, not args.no_cache)
 
 
 if __name__ == '__main__':
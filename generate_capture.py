@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+'''
+Generate synthetic USB captures of HID devices, for scale and stress testing
+
+Each simulated device is enumerated like a real one (SET_ADDRESS, device, configuration and
+HID report descriptors, SET_CONFIGURATION, SET_IDLE), then sends reports at its report rate:
+keyboards type random words, mice and tablet pens draw random strokes. Replugs re-enumerate a
+device at the same address, as extract_hid_data.py then splits its reports by version.
+
+Devices are generators of timestamped transfers merged by time, and frames are written as they
+are produced, so captures of any size are generated in constant memory. Frames are written as
+USBPcap or Linux usbmon (64 byte header) URBs, to pcap or pcapng depending on the extension.
+'''
+import argparse
+import heapq
+import math
+import random
+import struct
+
+from collections.abc import Iterator
+from pcap_reader import EPB, IDB, LINKTYPE_USB_LINUX_MMAPPED, LINKTYPE_USBPCAP, SHB
+
+
+SNAPLEN = 0x40000
+BUFFER_SIZE = 1 << 20
+UNPLUGGED_TIME = 0.1  # Seconds between a replug and the re-enumeration
+
+KEYBOARD_DESCRIPTOR = bytes.fromhex(
+    '05010906a101'  # Generic desktop, keyboard application
+    '050719e029e715002501750195088102950175088101'  # Modifier bits, reserved byte
+    '950575010508190129059102950175039101'  # LED output report
+    '95067508150025650507190029658100'  # Six key slots
+    'c0'
+)
+MOUSE_DESCRIPTOR = bytes.fromhex(
+    '05010902a1010901a100'  # Generic desktop, mouse application, pointer
+    '05091901290315002501750195038102750595018101'  # Three buttons and padding
+    '05010930093109381581257f750895038106'  # Relative x, y, wheel
+    'c0c0'
+)
+TABLET_DESCRIPTOR = bytes.fromhex(
+    '050d0902a1010920a100'  # Digitizer, pen application, stylus
+    '094209441500250175019502810295068103'  # Tip and barrel switches and padding
+    '050109300931150026ff7f751095028102'  # Absolute x and y
+    '050d0930150026ff7f751095018102'  # Tip pressure
+    'c0c0'
+)
+
+# Interface protocol, report descriptor, report length, and default report rate of each kind
+DEVICE_KINDS = {
+    'keyboard': (0x01, KEYBOARD_DESCRIPTOR, 8, 125),
+    'mouse': (0x02, MOUSE_DESCRIPTOR, 4, 125),
+    'tablet': (0x00, TABLET_DESCRIPTOR, 7, 200),
+}
+
+SCAN_CODES = {chr(ord('a') + i): 0x04 + i for i in range(26)} | {' ': 0x2C}
+LEFT_SHIFT = 0x02
+
+# USBPcap
+USBPCAP_HEADER = struct.Struct('<HQIHBHHBBI')
+USBPCAP_CONTROL_STAGE = struct.Struct('<B')
+URB_FUNCTION_CONTROL_TRANSFER = 0x0008
+URB_FUNCTION_BULK_OR_INTERRUPT_TRANSFER = 0x0009
+STAGE_SETUP, STAGE_COMPLETE = 0, 3
+
+# usbmon
+USBMON_HEADER = struct.Struct('<QBBBBHBBqiiII8siiII')
+USBMON_ID_BASE = 0xFFFF888000000000
+
+
+class Device:
+    '''
+    Simulated HID device with a single interface and interrupt IN endpoint 1
+    '''
+    def __init__(self, kind: str, address: int, rate: float, rng: random.Random):
+        self.kind = kind
+        self.address = address
+        self.rate = rate
+        self.rng = rng
+        self.protocol, self.descriptor, self.report_length, _ = DEVICE_KINDS[kind]
+
+    def enumeration(self) -> list[tuple[bytes, bytes]]:
+        '''
+        Control transfers of an enumeration as (setup, response) at the device address,
+        except SET_ADDRESS which goes to address 0
+        '''
+        device_descriptor = struct.pack('<BBHBBBBHHHBBBB', 18, 0x01, 0x0200, 0, 0, 0, 8, 0x1234, 0x5678 + self.protocol, 0x0100, 1, 2, 0, 1)
+        interface = struct.pack('<BBBBBBBBB', 9, 0x04, 0, 0, 1, 0x03, 1 if self.protocol else 0, self.protocol, 0)
+        hid = struct.pack('<BBHBBBH', 9, 0x21, 0x0111, 0, 1, 0x22, len(self.descriptor))
+        endpoint = struct.pack('<BBBBHB', 7, 0x05, 0x81, 0x03, self.report_length, max(1, round(1000 / self.rate)))
+        body = interface + hid + endpoint
+        configuration = struct.pack('<BBHBBBBB', 9, 0x02, 9 + len(body), 1, 1, 0, 0xA0, 50) + body
+
+        def setup(request_type, request, value, index, length):
+            return struct.pack('<BBHHH', request_type, request, value, index, length)
+
+        return [
+            (setup(0x00, 0x05, self.address, 0, 0), b''),  # SET_ADDRESS
+            (setup(0x80, 0x06, 0x0100, 0, 18), device_descriptor),
+            (setup(0x80, 0x06, 0x0200, 0, 9), configuration[:9]),
+            (setup(0x80, 0x06, 0x0200, 0, len(configuration)), configuration),
+            (setup(0x00, 0x09, 1, 0, 0), b''),  # SET_CONFIGURATION
+            (setup(0x21, 0x0A, 0, 0, 0), b''),  # SET_IDLE
+            (setup(0x81, 0x06, 0x2200, 0, len(self.descriptor) + 0x40), self.descriptor),
+        ]
+
+    def reports(self) -> Iterator[bytes]:
+        return {'keyboard': self.keyboard_reports, 'mouse': self.mouse_reports, 'tablet': self.tablet_reports}[self.kind]()
+
+    def keyboard_reports(self) -> Iterator[bytes]:
+        # Each key is pressed for one report and released in the next, some words are capitalized
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        while True:
+            word = ''.join(self.rng.choice(letters) for _ in range(self.rng.randint(2, 10))) + ' '
+            shift = self.rng.random() < 0.2
+            for i, char in enumerate(word):
+                modifier = LEFT_SHIFT if shift and i == 0 else 0
+                yield bytes((modifier, 0, SCAN_CODES[char], 0, 0, 0, 0, 0))
+                yield bytes(8)
+
+    def mouse_reports(self) -> Iterator[bytes]:
+        # Strokes of smoothly turning movement, with the left button held for about half of them
+        while True:
+            buttons = 1 if self.rng.random() < 0.5 else 0
+            heading = self.rng.uniform(0, math.tau)
+            speed = self.rng.uniform(1, 8)
+            for _ in range(self.rng.randint(20, 200)):
+                heading += self.rng.uniform(-0.2, 0.2)
+                dx = max(-127, min(127, round(speed * math.cos(heading))))
+                dy = max(-127, min(127, round(speed * math.sin(heading))))
+                yield struct.pack('<Bbbb', buttons, dx, dy, 0)
+            yield struct.pack('<Bbbb', 0, 0, 0, 0)
+
+    def tablet_reports(self) -> Iterator[bytes]:
+        # Pen strokes within the tablet area, pressure rising and falling over each stroke
+        x, y = 16384.0, 16384.0
+        while True:
+            heading = self.rng.uniform(0, math.tau)
+            length = self.rng.randint(20, 200)
+            for i in range(length):
+                heading += self.rng.uniform(-0.15, 0.15)
+                x = min(32767.0, max(0.0, x + 40 * math.cos(heading)))
+                y = min(32767.0, max(0.0, y + 40 * math.sin(heading)))
+                pressure = round(32767 * math.sin(math.pi * i / length))
+                yield struct.pack('<Bhhh', 1 if pressure > 0 else 0, round(x), round(y), pressure)
+            for _ in range(self.rng.randint(5, 50)):
+                yield struct.pack('<Bhhh', 0, round(x), round(y), 0)
+
+    def transfers(self, start: float, duration: float, replugs: list[float]) -> Iterator[tuple[float, int, str, bytes, bytes]]:
+        '''
+        Transfers in time order as (timestamp, device address, kind, setup or None, data),
+        re-enumerating at each replug time
+        '''
+        interval = 1 / self.rate
+        ts = start
+        reports = self.reports()
+        for replug in replugs + [start + duration]:
+            for setup, response in self.enumeration():
+                ts += 0.001
+                yield ts, 0 if setup[1] == 0x05 else self.address, 'control', setup, response
+            ts += 0.01
+            while ts < replug:
+                yield ts, self.address, 'interrupt', None, next(reports)
+                # A few percent of jitter, as on a real bus
+                ts += interval * self.rng.uniform(0.95, 1.05)
+            ts = replug + UNPLUGGED_TIME
+
+
+class UsbPcapFrames:
+    linktype = LINKTYPE_USBPCAP
+
+    def __init__(self, bus: int):
+        self.bus = bus
+        self.irp_id = 0
+
+    def control(self, address, setup, response):
+        self.irp_id += 1
+        endpoint = setup[0] & 0x80  # Direction of the data stage
+        request = USBPCAP_HEADER.pack(28, self.irp_id, 0, URB_FUNCTION_CONTROL_TRANSFER, 0, self.bus, address, endpoint, 2, 8)
+        completion = USBPCAP_HEADER.pack(28, self.irp_id, 0, URB_FUNCTION_CONTROL_TRANSFER, 1, self.bus, address, endpoint, 2, len(response))
+        return (
+            request + USBPCAP_CONTROL_STAGE.pack(STAGE_SETUP) + setup,
+            completion + USBPCAP_CONTROL_STAGE.pack(STAGE_COMPLETE) + response,
+        )
+
+    def interrupt(self, address, data):
+        self.irp_id += 1
+        return (
+            USBPCAP_HEADER.pack(27, self.irp_id, 0, URB_FUNCTION_BULK_OR_INTERRUPT_TRANSFER, 0, self.bus, address, 0x81, 1, 0),
+            USBPCAP_HEADER.pack(27, self.irp_id, 0, URB_FUNCTION_BULK_OR_INTERRUPT_TRANSFER, 1, self.bus, address, 0x81, 1, len(data)) + data,
+        )
+
+
+class UsbmonFrames:
+    linktype = LINKTYPE_USB_LINUX_MMAPPED
+
+    def __init__(self, bus: int):
+        self.bus = bus
+        self.urb_id = 0
+
+    def header(self, event, transfer_type, endpoint, address, setup, data, length, ts):
+        seconds, microseconds = divmod(round(ts * 1e6), 1_000_000)
+        return USBMON_HEADER.pack(
+            USBMON_ID_BASE + self.urb_id * 0xC0, ord(event), transfer_type, endpoint, address, self.bus,
+            0 if setup else ord('-'), 0 if data else ord('<' if event == 'S' else '>'),
+            seconds, microseconds, 0, length, len(data), setup or bytes(8), 0, -1, 0, 0
+        )
+
+    def control(self, address, setup, response, ts=0.0):
+        self.urb_id += 1
+        length = struct.unpack_from('<H', setup, 6)[0]
+        endpoint = setup[0] & 0x80
+        return (
+            self.header('S', 2, endpoint, address, setup, b'', length, ts),
+            self.header('C', 2, endpoint, address, None, response, len(response), ts) + response,
+        )
+
+    def interrupt(self, address, data, ts=0.0):
+        self.urb_id += 1
+        return (
+            self.header('S', 1, 0x81, address, None, b'', len(data), ts),
+            self.header('C', 1, 0x81, address, None, data, len(data), ts) + data,
+        )
+
+
+class PcapWriter:
+    def __init__(self, path: str, linktype: int):
+        self.file = open(path, 'wb', buffering=BUFFER_SIZE)
+        self.file.write(struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, SNAPLEN, linktype))
+        self.record = struct.Struct('<IIII')
+
+    def write(self, ts: float, frame: bytes):
+        seconds, microseconds = divmod(round(ts * 1e6), 1_000_000)
+        self.file.write(self.record.pack(seconds, microseconds, len(frame), len(frame)))
+        self.file.write(frame)
+
+    def close(self):
+        self.file.close()
+
+
+class PcapngWriter:
+    def __init__(self, path: str, linktype: int):
+        self.file = open(path, 'wb', buffering=BUFFER_SIZE)
+        # Section header and one interface with the default microsecond resolution
+        self.file.write(struct.pack('<IIIHHqI', SHB, 28, 0x1A2B3C4D, 1, 0, -1, 28))
+        self.file.write(struct.pack('<IIHHII', IDB, 20, linktype, 0, SNAPLEN, 20))
+        self.block = struct.Struct('<IIIIIII')
+
+    def write(self, ts: float, frame: bytes):
+        padding = -len(frame) % 4
+        length = 32 + len(frame) + padding
+        timestamp = round(ts * 1e6)
+        self.file.write(self.block.pack(EPB, length, 0, timestamp >> 32, timestamp & 0xFFFFFFFF, len(frame), len(frame)))
+        self.file.write(frame)
+        self.file.write(bytes(padding) + struct.pack('<I', length))
+
+    def close(self):
+        self.file.close()
+
+
+def create_devices(keyboards=1, mice=1, tablets=0, rate=None, seed=0) -> list[Device]:
+    '''
+    Devices at consecutive addresses from 2, each with its own random stream
+    '''
+    devices = []
+    kinds = ['keyboard'] * keyboards + ['mouse'] * mice + ['tablet'] * tablets
+    for address, kind in enumerate(kinds, 2):
+        devices.append(Device(kind, address, rate or DEVICE_KINDS[kind][3], random.Random(f'{seed}-{address}')))
+    return devices
+
+
+def generate_capture(path: str, devices: list[Device], duration: float = 10.0, replugs: int = 0, usbmon: bool = False, bus: int = 1, start: float = 1_700_000_000.0) -> dict:
+    '''
+    Write a capture of the devices sending reports for duration seconds, each replugged replugs
+    times at evenly spaced moments. Returns the number of reports sent per versioned address.
+    '''
+    frames = UsbmonFrames(bus) if usbmon else UsbPcapFrames(bus)
+    writer = (PcapngWriter if path.endswith('.pcapng') else PcapWriter)(path, frames.linktype)
+    counts = {}
+
+    # Devices start a few milliseconds apart, and are replugged one after the other
+    streams = []
+    for i, device in enumerate(devices):
+        offset = start + i * 0.05
+        replug_times = [offset + duration * (n + 1) / (replugs + 1) for n in range(replugs)]
+        streams.append(device.transfers(offset, duration, replug_times))
+
+    versions = {}
+    pending = None
+    try:
+        for ts, address, transfer, setup, data in heapq.merge(*streams, key=lambda transfer: transfer[0]):
+            extra = (ts,) if usbmon else ()
+            if transfer == 'control':
+                if setup[1] == 0x05:
+                    versions[setup[2]] = versions.get(setup[2], -1) + 1
+                request, completion = frames.control(address, setup, data, *extra)
+            else:
+                request, completion = frames.interrupt(address, data, *extra)
+                version = versions.get(address, 0)
+                addr = f'{bus}.{address}.1' + (f'_{version}' if version else '')
+                counts[addr] = counts.get(addr, 0) + 1
+            # Completions follow their request within the same millisecond, but never after the
+            # next request, so that the timestamps stay in order at any report rate
+            if pending:
+                writer.write(min(pending[0], ts), pending[1])
+            writer.write(ts, request)
+            pending = (ts + 0.0001, completion)
+        if pending:
+            writer.write(*pending)
+    finally:
+        writer.close()
+    return counts
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic USB capture of HID devices for scale and stress testing',
+        epilog='Example:\n  python generate_capture.py big.pcapng --keyboards 2 --mice 2 --tablets 1 --duration 3600 --replugs 2',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('file', help='output capture, pcapng if it ends in .pcapng, pcap otherwise')
+    parser.add_argument('-f', '--format', choices=('usbpcap', 'usbmon'), default='usbpcap', help='''frame format (default: %(default)s)
+    usbpcap: Windows USBPcap URBs
+    usbmon: Linux usbmon URBs with the 64 byte header''')
+    parser.add_argument('-k', '--keyboards', type=int, default=1, help='number of keyboards (default: %(default)s)')
+    parser.add_argument('-m', '--mice', type=int, default=1, help='number of mice (default: %(default)s)')
+    parser.add_argument('-t', '--tablets', type=int, default=0, help='number of tablets (default: %(default)s)')
+    parser.add_argument('-r', '--rate', type=float, help='reports per second of every device\n(default: 125 for keyboards and mice, 200 for tablets)')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds of capture, replugs included (default: %(default)s)')
+    parser.add_argument('--replugs', type=int, default=0, help='times each device is unplugged and re-enumerated at the same address (default: %(default)s)')
+    parser.add_argument('--bus', type=int, default=1, help='bus number of the devices (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed gives the same capture (default: %(default)s)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    devices = create_devices(args.keyboards, args.mice, args.tablets, args.rate, args.seed)
+    if not devices:
+        print('No devices to generate, exiting...')
+        exit()
+
+    counts = generate_capture(args.file, devices, args.duration, args.replugs, args.format == 'usbmon', args.bus)
+    kinds = {f'{args.bus}.{device.address}': device.kind for device in devices}
+    for addr, count in counts.items():
+        print(f'{kinds[addr.rsplit(".", 1)[0]]:>8} at {addr}: {count} reports')
+    print(f'Wrote {sum(counts.values())} reports to {args.file}')
+
+
+if __name__ == '__main__':
+    main()
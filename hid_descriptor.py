@@ -0,0 +1,345 @@
+'''
+HID report descriptors
+
+A report descriptor is a stream of short items describing every field of the reports a device
+sends: global items (usage page, logical range, report size/count/ID) carry over from one field
+to the next, local items (usages) apply to the next main item only, and Input main items add
+fields to the input report of the current report ID. Descriptors are extracted alongside the
+reports by extract_hid_data.py, as a hex '.desc' file next to each report file.
+
+parse_descriptor turns the item stream into a layout of fields per report, and compile_extractor
+turns the layout into an extractor for one kind of device. The extractor holds the byte range,
+shift and mask of each field it needs, and slices them out of a whole (count, width) uint8
+report array at once. Extractors are cached per descriptor, so a layout is only compiled once.
+'''
+from functools import lru_cache
+from typing import NamedTuple
+
+
+# Item types
+MAIN, GLOBAL, LOCAL = 0, 1, 2
+
+# Main item tags
+INPUT = 0x8
+COLLECTION = 0xA
+END_COLLECTION = 0xC
+
+# Global item tags
+USAGE_PAGE = 0x0
+LOGICAL_MINIMUM = 0x1
+LOGICAL_MAXIMUM = 0x2
+REPORT_SIZE = 0x7
+REPORT_ID = 0x8
+REPORT_COUNT = 0x9
+PUSH = 0xA
+POP = 0xB
+
+# Local item tags
+USAGE = 0x0
+USAGE_MINIMUM = 0x1
+USAGE_MAXIMUM = 0x2
+
+# Input item flags
+CONSTANT = 0b001
+VARIABLE = 0b010
+RELATIVE = 0b100
+
+COLLECTION_APPLICATION = 0x01
+
+MAX_REPORT_BITS = 8 * 0xFFFF  # Reports are at most wMaxPacketSize (16 bits) bytes long
+MAX_FIELD_BITS = 32
+
+# Usage pages and usages
+GENERIC_DESKTOP = 0x01
+KEYBOARD_PAGE = 0x07
+BUTTON_PAGE = 0x09
+DIGITIZER_PAGE = 0x0D
+
+MOUSE = (GENERIC_DESKTOP, 0x02)
+KEYBOARD = (GENERIC_DESKTOP, 0x06)
+X = (GENERIC_DESKTOP, 0x30)
+Y = (GENERIC_DESKTOP, 0x31)
+TIP_PRESSURE = (DIGITIZER_PAGE, 0x30)
+TIP_SWITCH = (DIGITIZER_PAGE, 0x42)
+MODIFIERS = range(0xE0, 0xE8)  # Keyboard page usages of LeftControl to RightGUI
+
+# Applications (top-level collections) decoded as each kind of device
+APPLICATIONS = {
+    'keyboard': [KEYBOARD],
+    'mouse': [MOUSE],
+    'tablet': [(DIGITIZER_PAGE, usage) for usage in range(0x01, 0x06)],  # Digitizer, pen, light pen, touch screen, touch pad
+}
+
+
+class DescriptorError(Exception):
+    pass
+
+
+class Field(NamedTuple):
+    '''
+    An Input field, bit_offset counts from the start of the report including its report ID byte.
+    Array fields have count elements holding usages between usage and usage_maximum.
+    '''
+    bit_offset: int
+    size: int
+    usage_page: int
+    usage: int
+    logical_minimum: int
+    logical_maximum: int
+    flags: int
+    count: int = 1
+    usage_maximum: int = 0
+
+    @property
+    def variable(self):
+        return bool(self.flags & VARIABLE)
+
+    @property
+    def relative(self):
+        return bool(self.flags & RELATIVE)
+
+
+class Report(NamedTuple):
+    report_id: int  # 0 if the device uses no report IDs
+    application: tuple  # (usage page, usage) of the top-level collection
+    fields: tuple
+
+
+def items(descriptor: bytes):
+    '''
+    Short items of a descriptor as (type, tag, data, size), long items are skipped
+    '''
+    i = 0
+    while i < len(descriptor):
+        prefix = descriptor[i]
+        if prefix == 0xFE:  # Long item
+            if i + 1 >= len(descriptor):
+                break
+            i += 3 + descriptor[i + 1]
+            continue
+
+        size = (0, 1, 2, 4)[prefix & 0b11]
+        if i + 1 + size > len(descriptor):
+            raise DescriptorError(f'Report descriptor truncated at byte {i}')
+        yield (prefix >> 2) & 0b11, prefix >> 4, int.from_bytes(descriptor[i + 1:i + 1 + size], 'little'), size
+        i += 1 + size
+
+
+def signed(value: int, size: int) -> int:
+    return value - (1 << 8 * size) if size and value >= 1 << (8 * size - 1) else value
+
+
+def parse_descriptor(descriptor: bytes) -> dict[int, Report]:
+    '''
+    Input reports of a descriptor by report ID
+    '''
+    state = {'page': 0, 'minimum': 0, 'maximum': 0, 'maximum_size': 0, 'size': 0, 'count': 0, 'report_id': 0}
+    stack = []
+    usages, usage_minimum, usage_maximum = [], None, None
+    collections = []
+    application = (0, 0)
+    reports = {}  # Report ID -> (application, fields)
+    offsets = {}  # Report ID -> next bit offset
+
+    for kind, tag, data, size in items(descriptor):
+        if kind == GLOBAL:
+            if tag == USAGE_PAGE:
+                state['page'] = data
+            elif tag == LOGICAL_MINIMUM:
+                state['minimum'] = signed(data, size)
+            elif tag == LOGICAL_MAXIMUM:
+                state['maximum'], state['maximum_size'] = data, size
+            elif tag == REPORT_SIZE:
+                state['size'] = data
+            elif tag == REPORT_ID:
+                state['report_id'] = data
+            elif tag == REPORT_COUNT:
+                state['count'] = data
+            elif tag == PUSH:
+                stack.append(dict(state))
+            elif tag == POP and stack:
+                state = stack.pop()
+
+        elif kind == LOCAL:
+            # Four byte usages include their usage page
+            usage = data if size == 4 else state['page'] << 16 | data
+            if tag == USAGE:
+                usages.append(usage)
+            elif tag == USAGE_MINIMUM:
+                usage_minimum = usage
+            elif tag == USAGE_MAXIMUM:
+                usage_maximum = usage
+
+        elif kind == MAIN:
+            if tag == COLLECTION:
+                usage = usages[0] if usages else usage_minimum or 0
+                if not collections and data == COLLECTION_APPLICATION:
+                    application = (usage >> 16, usage & 0xFFFF)
+                collections.append(data)
+            elif tag == END_COLLECTION and collections:
+                collections.pop()
+            elif tag == INPUT:
+                report_id = state['report_id']
+                offset = offsets.get(report_id, 8 if report_id else 0)
+                bits, count = state['size'], state['count']
+                if offset + bits * count > MAX_REPORT_BITS or count > MAX_REPORT_BITS:
+                    raise DescriptorError(f'Report descriptor has a report longer than {MAX_REPORT_BITS // 8} bytes')
+                # Logical maxima are signed too, but often written unsigned (e.g. 255 as 0xFF)
+                minimum = state['minimum']
+                maximum = signed(state['maximum'], state['maximum_size'])
+                if maximum < minimum:
+                    maximum = state['maximum']
+
+                if not data & CONSTANT and bits:
+                    fields = reports.setdefault(report_id, (application, []))[1]
+                    if data & VARIABLE:
+                        # One field per usage, the last usage repeats if there are fewer usages than fields
+                        for i in range(count):
+                            if usage_minimum is not None and usage_maximum is not None:
+                                usage = usage_minimum + min(i, max(usage_maximum - usage_minimum, 0))
+                            else:
+                                usage = usages[min(i, len(usages) - 1)] if usages else 0
+                            fields.append(Field(offset + i * bits, bits, usage >> 16, usage & 0xFFFF, minimum, maximum, data))
+                    elif count:
+                        first = usage_minimum if usage_minimum is not None else usages[0] if usages else 0
+                        last = usage_maximum if usage_maximum is not None else usages[-1] if usages else 0
+                        fields.append(Field(offset, bits, first >> 16, first & 0xFFFF, minimum, maximum, data, count, last & 0xFFFF))
+                offsets[report_id] = offset + bits * count
+
+            usages, usage_minimum, usage_maximum = [], None, None
+
+    return {report_id: Report(report_id, application, tuple(fields)) for report_id, (application, fields) in reports.items()}
+
+
+def find_report(reports: dict[int, Report], device: str) -> Report | None:
+    '''
+    The input report of a device kind, by its application or else by the fields it needs
+    '''
+    for report in reports.values():
+        if report.application in APPLICATIONS[device]:
+            return report
+
+    for report in reports.values():
+        usages = {(field.usage_page, field.usage) for field in report.fields}
+        if device == 'keyboard' and any(page == KEYBOARD_PAGE for page, _ in usages):
+            return report
+        if device == 'mouse' and X in usages or device == 'tablet' and TIP_SWITCH in usages:
+            return report
+    return None
+
+
+def device_kind(descriptor: bytes) -> str | None:
+    '''
+    Kind of device ('keyboard', 'mouse' or 'tablet') of the first known application in a descriptor
+    '''
+    try:
+        reports = parse_descriptor(descriptor)
+    except DescriptorError:
+        return None
+    for report in reports.values():
+        for kind, applications in APPLICATIONS.items():
+            if report.application in applications:
+                return kind
+    return None
+
+
+class Extractor:
+    '''
+    Extracts named values of a device kind from a (count, width) uint8 array of reports, compiled from a Report.
+    Values are returned with the indices of the reports they were taken from, as reports with
+    other report IDs are skipped.
+
+        keyboard: modifiers (bit mask), keys (count, slots) scan codes of the pressed keys
+        mouse: buttons (bit mask), x, y
+        tablet: buttons (tip switch), x, y, pressure
+    '''
+    def __init__(self, report: Report, device: str):
+        self.report_id = report.report_id
+        self.device = device
+        # Name -> [(first byte, byte count, shift, mask, sign bit, value)], where value is
+        # None for the field value itself, or the bit mask or usage to return if it is set
+        self.plan = {}
+        self.relative = False
+
+        for field in report.fields:
+            usage = (field.usage_page, field.usage)
+            if device == 'keyboard' and field.usage_page == KEYBOARD_PAGE:
+                if field.usage in MODIFIERS and field.variable:
+                    self.add('modifiers', field, 0, 1 << (field.usage - MODIFIERS[0]))
+                elif field.variable:
+                    # Bitmap of keys (n-key rollover), each pressed key returns its usage
+                    self.add('keys', field, 0, field.usage)
+                else:
+                    for i in range(field.count):
+                        self.add('keys', field, i)
+            elif field.usage_page == BUTTON_PAGE and field.variable and device != 'keyboard' and field.usage:
+                # Tablets only draw with their first button
+                if device == 'mouse' or field.usage == 1:
+                    self.add('buttons', field, 0, 1 << (field.usage - 1))
+            elif usage == TIP_SWITCH and device == 'tablet':
+                self.add('tip', field, 0, 1)
+            elif usage in (X, Y) and device != 'keyboard':
+                self.add('x' if usage == X else 'y', field)
+                self.relative = field.relative
+            elif usage == TIP_PRESSURE and device == 'tablet':
+                self.add('pressure', field)
+
+        if 'tip' in self.plan:
+            # The tip switch takes the place of the first button when present
+            self.plan['buttons'] = self.plan.pop('tip')
+
+        names = {'keyboard': ('modifiers', 'keys'), 'mouse': ('buttons', 'x', 'y'), 'tablet': ('buttons', 'x', 'y', 'pressure')}[device]
+        missing = [name for name in names if name not in self.plan and name not in ('modifiers', 'buttons', 'pressure')]
+        if missing:
+            raise DescriptorError(f'Report descriptor has no {", ".join(missing)} field for a {device}')
+        self.names = names
+
+    def add(self, name, field, element=0, value=None):
+        if field.size > MAX_FIELD_BITS:
+            raise DescriptorError(f'Report descriptor has a {field.size} bit {name} field, at most {MAX_FIELD_BITS} bits are supported')
+        bit_offset = field.bit_offset + element * field.size
+        first, last = bit_offset // 8, (bit_offset + field.size - 1) // 8
+        sign = field.size - 1 if field.logical_minimum < 0 else None
+        self.plan.setdefault(name, []).append((first, last - first + 1, bit_offset % 8, (1 << field.size) - 1, sign, value))
+
+    def __call__(self, reports):
+        import numpy as np
+
+        indices = np.arange(len(reports))
+        if self.report_id:
+            indices = np.flatnonzero(reports[:, 0] == self.report_id) if reports.shape[1] else indices[:0]
+            reports = reports[indices]
+
+        def extract(first, length, shift, mask, sign, value):
+            combined = np.zeros(len(reports), dtype=np.uint64)
+            for i in range(length):
+                if first + i < reports.shape[1]:
+                    combined |= reports[:, first + i].astype(np.uint64) << np.uint64(8 * i)
+            values = ((combined >> np.uint64(shift)) & np.uint64(mask)).astype(np.int64)
+            if sign is not None:
+                values[values >= 1 << sign] -= 1 << (sign + 1)
+            if value is not None:
+                values = np.where(values != 0, value, 0)
+            return values
+
+        values = {}
+        for name in self.names:
+            steps = self.plan.get(name, [])
+            if name == 'keys':
+                values[name] = np.column_stack([extract(*step) for step in steps]) if steps else np.zeros((len(reports), 0), dtype=np.int64)
+            elif name in ('modifiers', 'buttons'):
+                values[name] = np.bitwise_or.reduce([extract(*step) for step in steps]) if steps else np.zeros(len(reports), dtype=np.int64)
+            else:
+                values[name] = extract(*steps[0]) if steps else np.zeros(len(reports), dtype=np.int64)
+        return indices, values
+
+
+@lru_cache(maxsize=None)
+def compile_extractor(descriptor: bytes, device: str) -> Extractor:
+    '''
+    Extractor for the report of a device kind ('keyboard', 'mouse' or 'tablet') in a report descriptor
+    '''
+    report = find_report(parse_descriptor(descriptor), device)
+    if report is None:
+        raise DescriptorError(f'Report descriptor has no {device} report')
+    return Extractor(report, device)
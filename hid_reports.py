@@ -0,0 +1,225 @@
+'''
+Reading and writing HID report files
+
+Reports are stored as hex text with one report per line (the default, same as tshark
+output), optionally preceded by a timestamp column ('<seconds>\t<hex>', as in tshark's
+'-T fields -e frame.time_epoch -e usbhid.data'), or in a binary container that the
+decoders can memory-map without parsing:
+
+    header      64 bytes: magic 'HIDR', version u8, reserved u8, width u16, count u64,
+                device type (16 bytes), address (32 bytes), both null padded
+    timestamps  count x float64, seconds (NaN if unknown)
+    lengths     count x uint16, original report lengths
+    reports     count x width uint8, zero padded to the longest report
+
+All fields are little-endian.
+
+When the capture contains the device's HID report descriptor, it is written next to the
+reports with the same name and a '.desc' extension, as a single hex line.
+'''
+import math
+import os
+import shutil
+import struct
+
+from array import array
+
+
+MAGIC = b'HIDR'
+VERSION = 1
+HEADER = struct.Struct('<4sBxHQ16s32s')
+DESCRIPTOR_EXTENSION = '.desc'
+
+
+class HexReportWriter:
+    extension = '.txt'
+
+    def __init__(self, path, timestamps=False):
+        self.path = path
+        self.timestamps = timestamps
+        self.file = open(path, 'w')
+
+    def write(self, timestamp, data):
+        if self.timestamps:
+            self.file.write(f'{math.nan if timestamp is None else timestamp:.6f}\t')
+        self.file.write(data.hex() + '\n')
+
+    def close(self, device):
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class BinaryReportWriter:
+    '''
+    Streams the columns to temporary files next to the output and assembles the
+    container on close, once the report width and device type are known
+    '''
+    extension = '.bin'
+
+    def __init__(self, path, address):
+        self.path = path
+        self.address = address
+        self.count = 0
+        self.width = 0
+        self.fixed_width = True
+        self.timestamps = open(f'{path}.ts', 'wb')
+        self.lengths = open(f'{path}.len', 'wb')
+        self.reports = open(f'{path}.data', 'wb')
+
+    def write(self, timestamp, data):
+        length = len(data)
+        if self.count > 0 and length != self.width:
+            self.fixed_width = False
+        self.width = max(self.width, length)
+        self.count += 1
+        self.timestamps.write(struct.pack('<d', math.nan if timestamp is None else timestamp))
+        self.lengths.write(struct.pack('<H', length))
+        self.reports.write(data)
+
+    def close(self, device):
+        for f in (self.timestamps, self.lengths, self.reports):
+            f.close()
+
+        with open(self.path, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, VERSION, self.width, self.count, device.encode()[:16], self.address.encode()[:32]))
+            for column in ('ts', 'len'):
+                with open(f'{self.path}.{column}', 'rb') as f:
+                    shutil.copyfileobj(f, out)
+
+            with open(f'{self.path}.data', 'rb') as f:
+                if self.fixed_width:
+                    shutil.copyfileobj(f, out)
+                else:
+                    with open(f'{self.path}.len', 'rb') as g:
+                        lengths = array('H', g.read())
+                    for length in lengths:
+                        out.write(f.read(length).ljust(self.width, b'\x00'))
+
+        for column in ('ts', 'len', 'data'):
+            os.remove(f'{self.path}.{column}')
+
+    def discard(self):
+        for f in (self.timestamps, self.lengths, self.reports):
+            f.close()
+            os.remove(f.name)
+
+
+def is_binary(path) -> bool:
+    # Redirected stdin is seekable but named '<stdin>'
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(4) == MAGIC
+
+
+def load_binary(path):
+    '''
+    Memory-map a binary report file, returns (device, address, timestamps, lengths, reports)
+    with reports as a (count, width) uint8 array
+    '''
+    import numpy as np
+
+    with open(path, 'rb') as f:
+        magic, version, width, count, device, address = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a binary HID report file')
+    device, address = device.rstrip(b'\x00').decode(), address.rstrip(b'\x00').decode()
+
+    if count == 0:
+        return device, address, np.zeros(0), np.zeros(0, np.uint16), np.zeros((0, width), np.uint8)
+
+    offset = HEADER.size
+    timestamps = np.memmap(path, dtype='<f8', mode='r', offset=offset, shape=(count,))
+    offset += 8 * count
+    lengths = np.memmap(path, dtype='<u2', mode='r', offset=offset, shape=(count,))
+    offset += 2 * count
+    reports = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(count, width))
+    return device, address, timestamps, lengths, reports
+
+
+def read_reports(file, timestamps=False):
+    '''
+    Read a report file opened in text mode. Hex files are returned as text,
+    binary files as a memory-mapped (count, width) uint8 array.
+    With timestamps, returns (reports, timestamps) where timestamps are None if the file has none.
+    '''
+    if file.seekable() and is_binary(file.name):
+        _, _, times, _, reports = load_binary(file.name)
+        return (reports, times.tolist()) if timestamps else reports
+
+    raw_data = file.read()
+    return (raw_data, parse_timestamps(raw_data)) if timestamps else raw_data
+
+
+def parse_reports(raw_data, offset=0):
+    '''
+    Split hex text (one report per line, optionally ':' separated and after a timestamp column)
+    or a report array into reports
+    '''
+    if isinstance(raw_data, str):
+        return [
+            bytes.fromhex(''.join(d.split('\t')[-1].strip().split(':')))[offset:]
+            for d in raw_data.split('\n') if d
+        ]
+    return [bytes(row[offset:]) for row in raw_data]
+
+
+def report_array(raw_data, offset=0, width=None):
+    '''
+    Reports as a (count, width) uint8 NumPy array from hex text or a report array, starting at
+    offset and truncated or zero padded to width bytes (default: the longest report)
+    '''
+    import numpy as np
+
+    if not isinstance(raw_data, str):
+        reports = np.asarray(raw_data, dtype=np.uint8)[:, offset:]
+    else:
+        if '\t' in raw_data:
+            raw_data = '\n'.join(d.split('\t')[-1] for d in raw_data.split('\n'))
+        lines = raw_data.replace(':', '').split()
+        if len(set(map(len, lines))) == 1:
+            # Fixed-width reports (the common case) are decoded in one go
+            reports = np.frombuffer(bytes.fromhex(''.join(lines)), dtype=np.uint8).reshape(len(lines), -1)[:, offset:]
+        else:
+            reports = parse_reports(raw_data, offset)
+            longest = max((len(r) for r in reports), default=0)
+            reports = np.frombuffer(b''.join(r.ljust(longest, b'\x00') for r in reports), dtype=np.uint8).reshape(len(reports), longest)
+
+    if width is not None:
+        reports = reports[:, :width]
+        if reports.shape[1] < width:
+            reports = np.pad(reports, ((0, 0), (0, width - reports.shape[1])))
+    return reports
+
+
+def write_descriptor(path, data):
+    with open(path, 'w') as f:
+        f.write(bytes(data).hex() + '\n')
+
+
+def read_descriptor(report_file, path=None):
+    '''
+    HID report descriptor from path, or else from the descriptor file extracted next to
+    report_file. Returns None if there is none or path is 'none'.
+    '''
+    if path is None:
+        path = os.path.splitext(report_file.name if hasattr(report_file, 'read') else report_file)[0] + DESCRIPTOR_EXTENSION
+        if not os.path.isfile(path):
+            return None
+    elif path == 'none':
+        return None
+    with open(path) as f:
+        return bytes.fromhex(f.read().replace(':', '').strip())
+
+
+def parse_timestamps(raw_data):
+    '''
+    Timestamp column of hex text, None if the reports have no timestamps
+    '''
+    lines = [d for d in raw_data.split('\n') if d]
+    if not lines or any('\t' not in d for d in lines):
+        return None
+    return [float(d.split('\t')[0]) for d in lines]
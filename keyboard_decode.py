@@ -5,6 +5,13 @@ import signal
 import sys
 import time
 
+from cache import Cache
+from collections import deque
+from contextlib import nullcontext
+from hid_descriptor import DescriptorError, compile_extractor
+from hid_reports import parse_reports, read_descriptor, report_array
+from playback import Playback, has_timestamps
+
 
 SCAN_CODES = {
     # Letters
@@ -123,8 +130,18 @@ MODIFIER_CODES = {
     0x80: 'WIN'
 }
 
+# Modifier set of every possible modifier byte
+MODIFIER_TABLE = [
+    frozenset(m for code, m in MODIFIER_CODES.items() if modifier & code == code)
+    for modifier in range(256)
+]
+
 
-def replay_keypresses(keypresses, delay=20):
+def replay_keypresses(keypresses, delay=20, timestamps=None, speed=1.0):
+    '''
+    Replay keypresses in the active window, either with a fixed delay between keystrokes,
+    or at their original pace (scaled by speed) given the timestamp of each keypress
+    '''
     try:
         import keyboard
     except ModuleNotFoundError:
@@ -140,7 +157,11 @@ def replay_keypresses(keypresses, delay=20):
     keyboard.wait('space', suppress=True)
     time.sleep(0.1)
 
-    for modifiers, keypress in keypresses:
+    playback = Playback(timestamps, speed) if has_timestamps(timestamps) else None
+    for step, (modifiers, keypress) in enumerate(keypresses):
+        if playback:
+            playback.wait(step)
+
         shift = modifiers == {'Shift'}
         key = k if (k := keypress[0]).isalnum() else keypress[-shift]  # Shouldn't be necessary to manually select shifted/not, but keyboard library has bugs
 
@@ -152,106 +173,206 @@ def replay_keypresses(keypresses, delay=20):
         if shift and key in {'RIGHT', 'LEFT', 'DOWN', 'UP'}:
             print(f'Please press <Shift+{key}> manually...')
             hotkey = keyboard.get_hotkey_name([*modifiers, key])
-            keyboard.wait(f'shift+{key.lower()} arrow')
-            time.sleep(1)
+            with playback.paused() if playback else nullcontext():
+                keyboard.wait(f'shift+{key.lower()} arrow')
+                time.sleep(1)
         else:
             hotkey = keyboard.get_hotkey_name([*modifiers, key])
             keyboard.send(hotkey)
-            time.sleep(delay / 1000)
-
+            if not playback:
+                time.sleep(delay / 1000)
+
+
+class GapLine:
+    '''
+    Line of text split at the gap, tokens before it in left and tokens after it in right (reversed),
+    so edits at the gap are O(1) and moving the gap costs the distance moved
+    '''
+    __slots__ = ('left', 'right')
+
+    def __init__(self, left=None, right=None):
+        self.left = left if left is not None else []
+        self.right = right if right is not None else []
+
+    def __len__(self):
+        return len(self.left) + len(self.right)
+
+    def move(self, pos):
+        left, right = self.left, self.right
+        if pos < len(left):
+            right.extend(reversed(left[pos:]))
+            del left[pos:]
+        elif pos > len(left):
+            n = min(pos - len(left), len(right))
+            left.extend(reversed(right[-n:]))
+            del right[-n:]
+
+    def text(self):
+        return ''.join(self.left) + ''.join(reversed(self.right))
+
+
+class TextBuffer:
+    '''
+    Editor buffer for simulate mode. The cursor line is a gap buffer at the cursor, with the
+    lines above and below it on two stacks, so typing, deleting, line breaks, and cursor moves
+    are O(1) amortized and never shift the rest of the document.
+    '''
+    def __init__(self):
+        self.above = deque()
+        self.line = GapLine()
+        self.below = []  # Nearest line last
+
+    def insert(self, token):
+        self.line.left.append(token)
+
+    def newline(self, split=True):
+        '''Start a new line below, moving the text after the cursor down with it if split'''
+        self.above.append(self.line)
+        if split:
+            self.line, self.above[-1].right = GapLine([], self.line.right), []
+        else:
+            self.line = GapLine()
+
+    def backspace(self):
+        if self.line.left:
+            self.line.left.pop()
+        elif self.above:
+            # Join with the line above, cursor at the end of the joined line
+            previous = self.above.pop()
+            previous.move(len(previous))
+            previous.left.extend(reversed(self.line.right))
+            self.line = previous
+
+    def delete(self):
+        if self.line.right:
+            self.line.right.pop()
+        elif self.below:
+            # Join with the line below, cursor at the join
+            following = self.below.pop()
+            following.move(0)
+            self.line.right = following.right
+
+    def home(self):
+        self.line.move(0)
+
+    def end(self):
+        self.line.move(len(self.line))
+
+    def right(self):
+        if self.line.right:
+            self.line.left.append(self.line.right.pop())
+        elif self.below:
+            self.above.append(self.line)
+            self.line = self.below.pop()
+            self.line.move(0)
+
+    def left(self):
+        if self.line.left:
+            self.line.right.append(self.line.left.pop())
+        elif self.above:
+            self.below.append(self.line)
+            self.line = self.above.pop()
+            self.line.move(len(self.line))
+
+    def down(self):
+        if self.below:
+            pos = len(self.line.left)
+            self.above.append(self.line)
+            self.line = self.below.pop()
+            self.line.move(pos)
+
+    def up(self):
+        if self.above:
+            pos = len(self.line.left)
+            self.below.append(self.line)
+            self.line = self.above.pop()
+            self.line.move(pos)
+
+    def flush(self, keep=0):
+        '''
+        Remove and return the lines more than keep lines above the cursor.
+        They can no longer be edited, the cursor stops at the first kept line.
+        '''
+        return [self.above.popleft().text() for _ in range(len(self.above) - keep)]
+
+    def text(self):
+        return '\n'.join(line.text() for line in [*self.above, self.line, *reversed(self.below)])
+
+
+class KeyboardSimulator:
+    '''
+    Stateful simulate mode, keypresses can be fed as they arrive and finished lines flushed
+    '''
+    def __init__(self, text_mode=True):
+        self.text_mode = text_mode
+        self.output = TextBuffer()
+        self.capslock = False
+
+    def feed(self, keypresses):
+        output = self.output
+        text_mode = self.text_mode
+
+        for modifiers, key in keypresses:
+            # Write out shortcut keypresses explicitly
+            if len(modifiers - {'Shift', 'AltGr'}) > 0:
+                ordered_modifiers = list(sorted(modifiers, key=lambda m: ['Ctrl', 'Shift', 'Alt', 'AltGr', 'WIN'].index(m)))
+                output.insert(f'<{"+".join(ordered_modifiers + [key[0]])}>')
+                continue
+            elif modifiers == {'Shift'} and key[0] in ('RIGHT', 'LEFT', 'DOWN', 'UP'):
+                output.insert(f'<Shift+{key[0]}>')
+                continue
 
-def simulate_keypresses(keypresses, text_mode=True):
-    output = [[]]
-    capslock = False
-    pos = 0
-    line = 0
+            # Shift pressed? AltGr is used on many European keyboard layouts for some of the same symbols SHIFT is on US layout (e.g. @, $)
+            shift = len(modifiers & {'Shift', 'AltGr'}) > 0
+
+            match key[0]:
+                case 'SPACE':
+                    output.insert(' ')
+                case 'ENTER':
+                    # In text mode, move remainder of line down to start of new line
+                    output.newline(split=text_mode)
+                case 'BACKSPACE':
+                    output.backspace()
+                case 'TAB':
+                    output.insert('\t' if text_mode else '<TAB>')
+                case 'CAPS LOCK':
+                    self.capslock = not self.capslock
+                case 'HOME':
+                    output.home()
+                case 'DELETE':
+                    output.delete()
+                case 'END':
+                    output.end()
+                case 'RIGHT':
+                    output.right()
+                case 'LEFT':
+                    output.left()
+                case 'DOWN':
+                    if text_mode:
+                        output.down()
+                    else:
+                        output.insert('<DOWN>')
+                case 'UP':
+                    if text_mode:
+                        output.up()
+                    else:
+                        output.insert('<UP>')
+                case _:
+                    if key[0].isalpha():
+                        shift ^= self.capslock
+                    output.insert(key[-shift] if len(key) == 2 else f'<{key[0]}>')
+
+    def flush(self, keep=0):
+        return self.output.flush(keep)
+
+    def text(self):
+        return self.output.text()
 
-    for modifiers, key in keypresses:
-        # Write out shortcut keypresses explicitly
-        if len(modifiers - {'Shift', 'AltGr'}) > 0:
-            ordered_modifiers = list(sorted(modifiers, key=lambda m: ['Ctrl', 'Shift', 'Alt', 'AltGr', 'WIN'].index(m)))
-            output[line].insert(pos, f'<{"+".join(ordered_modifiers + [key[0]])}>')
-            pos += 1
-            continue
-        elif modifiers == {'Shift'} and key[0] in ('RIGHT', 'LEFT', 'DOWN', 'UP'):
-            output[line].insert(pos, f'<Shift+{key[0]}>')
-            pos += 1
-            continue
 
-        # Shift pressed? AltGr is used on many European keyboard layouts for some of the same symbols SHIFT is on US layout (e.g. @, $)
-        shift = len(modifiers & {'Shift', 'AltGr'}) > 0
-
-        match key[0]:
-            case 'SPACE':
-                output[line].insert(pos, ' ')
-                pos += 1
-            case 'ENTER':
-                output.insert(line + 1, [])
-
-                # In text mode, move remainder of line down to start of new line
-                if text_mode:
-                    output[line + 1].extend(output[line][pos:])
-                    del output[line][pos:]
-
-                line += 1
-                pos = 0
-            case 'BACKSPACE':
-                if pos > 0:
-                    pos -= 1
-                    output[line].pop(pos)
-                elif line > 0:
-                    output[line - 1].extend(output[line])
-                    output.pop(line)
-                    line -= 1
-                    pos = len(output[line])
-            case 'TAB':
-                output[line].insert(pos, '\t' if text_mode else '<TAB>')
-                pos += 1
-            case 'CAPS LOCK':
-                capslock = not capslock
-            case 'HOME':
-                pos = 0
-            case 'DELETE':
-                if pos < len(output[line]):
-                    output[line].pop(pos)
-                elif line < len(output) - 1:
-                    output[line].extend(output[line + 1])
-                    output.pop(line)
-            case 'END':
-                pos = len(output[line])
-            case 'RIGHT':
-                if pos < len(output[line]):
-                    pos += 1
-                elif line < len(output) - 1:
-                    line += 1
-                    pos = 0
-            case 'LEFT':
-                if pos > 0:
-                    pos -= 1
-                elif line > 0:
-                    line -= 1
-                    pos = len(output[line])
-            case 'DOWN':
-                if text_mode:
-                    line = min(line + 1, len(output) - 1)
-                    pos = min(pos, len(output[line]))
-                else:
-                    output[line].insert(pos, '<DOWN>')
-                    pos += 1
-            case 'UP':
-                if text_mode:
-                    line = max(line - 1, 0)
-                    pos = min(pos, len(output[line]))
-                else:
-                    output[line].insert(pos, '<UP>')
-                    pos += 1
-            case _:
-                if key[0].isalpha():
-                    shift ^= capslock
-                output[line].insert(pos, key[-shift] if len(key) == 2 else f'<{key[0]}>')
-                pos += 1
-
-    return '\n'.join([''.join(line) for line in output])
+def simulate_keypresses(keypresses, text_mode=True):
+    simulator = KeyboardSimulator(text_mode)
+    simulator.feed(keypresses)
+    return simulator.text()
 
 
 def format_raw_keypresses(keypresses):
@@ -267,31 +388,146 @@ def format_raw_keypresses(keypresses):
     return '\n'.join(keys)
 
 
+def follow_keypresses(file, output, mode='simulate', offset=0, reserved=True, text_mode=True, keep=0):
+    '''
+    Decode a live feed of hex reports line by line (e.g. stdin, a FIFO, or tail -f), writing raw
+    keypresses or finished simulated lines as they arrive. Only the current line and the keep lines
+    above it are held in memory and can still be edited, on a terminal the current line is shown live.
+    '''
+    decoder = KeyboardDecoder(offset, reserved)
+    simulator = KeyboardSimulator(text_mode)
+    live = mode == 'simulate' and output.isatty()
+
+    try:
+        for line in file:
+            keypresses = [keypress for _, keypress in decoder.feed(line)]
+            if not keypresses:
+                continue
+
+            if mode == 'raw':
+                output.write(format_raw_keypresses(keypresses) + '\n')
+            else:
+                simulator.feed(keypresses)
+                if live:
+                    output.write('\r\033[K')
+                for finished in simulator.flush(keep):
+                    output.write(finished + '\n')
+                if live:
+                    output.write(simulator.output.line.text())
+            output.flush()
+    except KeyboardInterrupt:
+        pass
+
+    if mode == 'simulate':
+        if live:
+            output.write('\r\033[K')
+        output.write(simulator.text() + '\n')
+        output.flush()
+
+
 def decode_keypresses(raw_data, offset=0, reserved=True):
-    keyboard_data = [
-        bytes.fromhex(''.join(d.strip().split(':')))[offset:]
-        for d in raw_data.split('\n') if d
-    ]
+    return [keypress for _, keypress in decode_timed_keypresses(raw_data, offset, reserved)]
 
-    keypresses = []
-    pressed_keys = set()
 
-    for line in keyboard_data:
-        modifier = line[0]
-        key_offset = 2 if reserved else 1
-        scan_codes = set(line[key_offset:]) - {0}
+def decode_timed_keypresses(raw_data, offset=0, reserved=True):
+    '''
+    Same as decode_keypresses, but each keypress is paired with the index of the report it was pressed in
+    '''
+    return KeyboardDecoder(offset, reserved).feed(raw_data)
 
-        new_keys = scan_codes - pressed_keys
-        pressed_keys = scan_codes
 
-        for scan_code in sorted(new_keys, reverse=True):
-            if scan_code not in SCAN_CODES:
-                print(f'Unrecognized scan code: {hex(scan_code)}, please lookup USB HID keyboard scan codes!')
-                continue
+class KeyboardDecoder:
+    '''
+    Stateful keypress decoder, reports can be fed one at a time or in chunks as they arrive
+    '''
+    def __init__(self, offset=0, reserved=True):
+        self.offset = offset
+        self.key_offset = 2 if reserved else 1
+        self.pressed_keys = set()
+        self.count = 0
+
+    def feed(self, raw_data):
+        '''
+        Decode hex text or a list of reports, returns the new (report index, keypress) pairs
+        '''
+        keypresses = []
+        key_offset = self.key_offset
 
-            modifiers = {m for code, m in MODIFIER_CODES.items() if modifier & code == code}
+        for index, line in enumerate(parse_reports(raw_data, self.offset), self.count):
+            modifier = line[0]
+            scan_codes = set(line[key_offset:]) - {0}
+
+            new_keys = scan_codes - self.pressed_keys
+            self.pressed_keys = scan_codes
+
+            for scan_code in sorted(new_keys, reverse=True):
+                if scan_code not in SCAN_CODES:
+                    print(f'Unrecognized scan code: {hex(scan_code)}, please lookup USB HID keyboard scan codes!')
+                    continue
+
+                keypresses.append((index, (MODIFIER_TABLE[modifier], SCAN_CODES[scan_code])))
+            self.count = index + 1
+
+        return keypresses
+
+
+def decode_keypresses_numpy(raw_data, offset=0, reserved=True):
+    return [keypress for _, keypress in decode_timed_keypresses_numpy(raw_data, offset, reserved)]
+
+
+def decode_timed_keypresses_numpy(raw_data, offset=0, reserved=True):
+    '''
+    Vectorized decode_timed_keypresses, finds the newly pressed keys of all reports at once
+    '''
+    import numpy as np
+
+    key_offset = 2 if reserved else 1
+    reports = report_array(raw_data, offset)
+    if reports.shape[1] <= key_offset:
+        return []
+    return decode_keyboard_array(reports[:, 0], reports[:, key_offset:])
+
+
+def decode_timed_keypresses_descriptor(raw_data, descriptor):
+    '''
+    Same as decode_timed_keypresses, with the report layout taken from the device's HID report descriptor
+    '''
+    indices, values = compile_extractor(descriptor, 'keyboard')(report_array(raw_data))
+    indices = indices.tolist()
+    return [(indices[index], keypress) for index, keypress in decode_keyboard_array(values['modifiers'], values['keys'])]
+
+
+def decode_keyboard_array(modifiers, keys):
+    '''
+    Keypresses of the modifier bit masks and (count, slots) scan codes of the pressed keys of each report,
+    paired with the index of the report
+    '''
+    import numpy as np
+
+    # Rollover slots that are never used (usually most of them) can be skipped
+    keys = keys[:, keys.any(axis=0)]
+
+    # Keys held in the previous report, the first report starts with nothing pressed
+    previous = np.zeros_like(keys)
+    previous[1:] = keys[:-1]
+
+    # A key is new if it is not held in the previous report, and not a repeat within its own report
+    held = (keys[:, :, None] == previous[:, None, :]).any(axis=2)
+    repeated = np.triu(np.ones((keys.shape[1], keys.shape[1]), dtype=bool), 1)
+    repeated = ((keys[:, :, None] == keys[:, None, :]) & repeated.T).any(axis=2)
+    new_keys = np.where(held | repeated, 0, keys)
+
+    # Within a report, new keys are handled from highest to lowest scan code
+    new_keys = -np.sort(-new_keys.astype(np.int16), axis=1)
+
+    keypresses = []
+    rows, _ = np.nonzero(new_keys)
+    for index, modifier, scan_code in zip(rows.tolist(), modifiers[rows].tolist(), new_keys[new_keys != 0].tolist()):
+        if (key := SCAN_CODES.get(scan_code)) is None:
+            print(f'Unrecognized scan code: {hex(scan_code)}, please lookup USB HID keyboard scan codes!')
+            continue
 
-            keypresses.append((modifiers, SCAN_CODES[scan_code]))
+        keypresses.append((index, (MODIFIER_TABLE[modifier], key)))
 
     return keypresses
 
@@ -318,7 +554,7 @@ Limitations:
 '''.strip(),
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument('file', type=argparse.FileType('r'), help='keyboard data file')
+    parser.add_argument('file', type=argparse.FileType('r'), help='keyboard data file (hex or binary)')
     parser.add_argument('-o', '--output', type=argparse.FileType('w'), help='output file', default=sys.stdout)
     parser.add_argument('--offset', type=int, default=0, help='byte offset of data (default: %(default)s)')
     parser.add_argument('--no-reserved', action='store_true', help='set if data has no reserved byte (e.g. from USBPcap)')
@@ -327,6 +563,11 @@ Limitations:
     simulate: output a simulation of the keystrokes (safe)
     replay: play back each keystroke directly on your machine (unsafe)''')
     parser.add_argument('-d', '--delay', type=int, default=50, help='delay in milliseconds between keystrokes for replay mode (default: %(default)s)')
+    parser.add_argument('-r', '--realtime', type=float, nargs='?', const=1.0, metavar='SPEED', help='replay keystrokes at their captured pace instead of a fixed delay,\noptionally sped up by a factor (requires timestamped reports)')
+    parser.add_argument('--descriptor', metavar='FILE', help='decode with the HID report descriptor in FILE instead of --offset and --no-reserved\n(default: the .desc file extracted next to the reports, \'none\' to ignore it;\nnot used in follow mode)')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or store parsed reports and decoded keypresses in the cache')
+    parser.add_argument('-f', '--follow', action='store_true', help='decode hex reports as they are appended to file (e.g. - for stdin, a FIFO)\nand write output incrementally')
+    parser.add_argument('-k', '--keep', type=int, default=0, help='lines above the cursor kept editable in follow mode, output is delayed until\na line is this far above the cursor (default: %(default)s)')
     parser.add_argument('-e', '--env', choices=('txt', 'cmd'), default='txt', help='''assumed environment for simulation mode (default: %(default)s)
     txt: multi-line text editor environment. Arrow keys move the cursor and <ENTER> inserts a line break.
     cmd: assume single-line interactive environment, i.e. terminal, browser, etc.
@@ -336,7 +577,33 @@ Limitations:
 
 def main():
     args = parse_args()
-    keypresses = decode_keypresses(args.file.read(), offset=args.offset, reserved=not args.no_reserved)
+    if args.follow:
+        if args.mode == 'replay':
+            print('Follow mode only supports raw and simulate output')
+            exit()
+        return follow_keypresses(args.file, args.output, args.mode, args.offset, not args.no_reserved, args.env == 'txt', args.keep)
+
+    cache = Cache(args.file.name, enabled=not args.no_cache, sources=('hid_descriptor.py', 'keyboard_decode.py'))
+    raw_data, timestamps = cache.reports(args.file)
+    timed_keypresses = None
+    if (descriptor := read_descriptor(args.file, args.descriptor)) is not None:
+        try:
+            timed_keypresses = cache.cached(lambda: decode_timed_keypresses_descriptor(raw_data, descriptor), 'keyboard', descriptor)
+            print('Decoding with the report descriptor of the device', file=sys.stderr)
+        except DescriptorError as e:
+            print(f'{e}, falling back to --offset and --no-reserved', file=sys.stderr)
+        except ModuleNotFoundError:
+            print('Module \'numpy\' not found, required for --descriptor, falling back to --offset and --no-reserved', file=sys.stderr)
+
+    if timed_keypresses is None:
+        try:
+            timed_keypresses = cache.cached(
+                lambda: decode_timed_keypresses_numpy(raw_data, offset=args.offset, reserved=not args.no_reserved),
+                'keyboard', args.offset, not args.no_reserved
+            )
+        except ModuleNotFoundError:
+            timed_keypresses = decode_timed_keypresses(raw_data, offset=args.offset, reserved=not args.no_reserved)
+    keypresses = [keypress for _, keypress in timed_keypresses]
 
     if args.mode == 'raw':
         output = format_raw_keypresses(keypresses)
@@ -345,7 +612,12 @@ def main():
         output = simulate_keypresses(keypresses, text_mode=args.env == 'txt')
         args.output.write(output) if args.output else print(output)
     elif args.mode == 'replay':
-        return replay_keypresses(keypresses, args.delay)
+        if args.realtime is None:
+            return replay_keypresses(keypresses, args.delay)
+        if not has_timestamps(timestamps):
+            print('Realtime replay requires timestamped reports (extract with --timestamps or --format bin)')
+            exit()
+        return replay_keypresses(keypresses, args.delay, [timestamps[i] for i, _ in timed_keypresses], args.realtime)
 
 
 if __name__ == '__main__':
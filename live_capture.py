@@ -0,0 +1,253 @@
+'''
+Live HID capture from the Linux usbmon binary interface
+
+Events are read from a usbmon character device (/dev/usbmonN, 48 byte headers) or a named
+pipe (64 byte headers by default, e.g. written by replay_capture.py) and decoded as they arrive:
+
+    reader -> frames queue -> demultiplexer -> one queue per endpoint -> decoder -> output
+
+All queues are bounded, so a slow decoder stalls the demultiplexer and then the reader instead of
+buffering without limit, leaving the backlog to the kernel or the process writing the pipe.
+'''
+import asyncio
+import os
+import signal
+import stat
+import struct
+import sys
+
+from extract_hid_data import DeviceTracker, extract_hid_data, read_packets
+from hid_descriptor import DescriptorError, compile_extractor
+from keyboard_decode import KeyboardDecoder, KeyboardSimulator
+from pcap_reader import LINKTYPE_USB_LINUX, LINKTYPE_USB_LINUX_MMAPPED
+
+
+# Timestamp and captured length fields, shared by the 48 and 64 byte headers
+USBMON_FIELDS = struct.Struct('<16xqi8xI')
+QUEUE_SIZE = 256
+
+
+def descriptor_extractor(descriptor: bytes | None, device: str):
+    '''
+    Extractor for the report layout of a captured report descriptor, None without one (or NumPy)
+    '''
+    if descriptor is None:
+        return None
+    try:
+        import numpy  # Required by the extractor, checked here rather than on the first report
+        return compile_extractor(descriptor, device)
+    except (DescriptorError, ModuleNotFoundError):
+        return None
+
+
+def extract_report(extractor, data) -> dict | None:
+    '''
+    Values of a single report, None if it has another report ID
+    '''
+    import numpy as np
+
+    indices, values = extractor(np.frombuffer(data, dtype=np.uint8).reshape(1, -1))
+    return {name: int(value[0]) for name, value in values.items()} if len(indices) else None
+
+
+class KeyboardSink:
+    '''
+    Simulated text, written a line at a time
+    '''
+    def __init__(self):
+        self.decoder = KeyboardDecoder()
+        self.simulator = KeyboardSimulator()
+
+    def feed(self, ts, data):
+        self.simulator.feed([keypress for _, keypress in self.decoder.feed([data])])
+        return self.simulator.flush()
+
+    def close(self):
+        text = self.simulator.text()
+        return [text] if text else []
+
+
+class MouseSink:
+    '''
+    Pointer position at each button press and release, with the layout of the report descriptor
+    if one was captured, else with the given offset and bit lengths
+    '''
+    def __init__(self, descriptor=None, offset=0, bit_lengths=(8, 8, 8)):
+        from mouse_decode import decode_line
+
+        self.decode_line = decode_line
+        self.extractor = descriptor_extractor(descriptor, 'mouse')
+        self.offset = offset
+        self.bit_lengths = bit_lengths
+        self.click = 0
+        self.x = self.y = 0
+
+    def feed(self, ts, data):
+        if self.extractor is None:
+            click, dx, dy = self.decode_line(data[self.offset:], self.bit_lengths)
+        elif (values := extract_report(self.extractor, data)) is None:
+            return []
+        elif self.extractor.relative:
+            click, dx, dy = values['buttons'], values['x'], values['y']
+        else:
+            click, dx, dy = values['buttons'], values['x'] - self.x, self.y - values['y']
+        self.x += dx
+        self.y -= dy
+        if click == self.click:
+            return []
+        self.click = click
+        return [f'{"down" if click else "up"} {click:#04x} at ({self.x}, {self.y})']
+
+    def close(self):
+        return []
+
+
+class TabletSink:
+    '''
+    Pen position and pressure when touching down and lifting, with the layout of the report descriptor
+    if one was captured, else at the given offset
+    '''
+    report = struct.Struct('<Bhhh')
+
+    def __init__(self, descriptor=None, offset=1):
+        self.extractor = descriptor_extractor(descriptor, 'tablet')
+        self.offset = offset
+        self.click = 0
+
+    def feed(self, ts, data):
+        if self.extractor is None:
+            click, x, y, pressure = self.report.unpack_from(data.ljust(self.offset + self.report.size, b'\x00'), self.offset)
+        elif (values := extract_report(self.extractor, data)) is None:
+            return []
+        else:
+            click, x, y, pressure = values['buttons'], values['x'], values['y'], values['pressure']
+        click &= 0b1
+        if click == self.click:
+            return []
+        self.click = click
+        return [f'{"down" if click else "up"} at ({x}, {-y}) pressure {pressure}']
+
+    def close(self):
+        return []
+
+
+class HexSink:
+    '''
+    Undecoded reports
+    '''
+    def feed(self, ts, data):
+        return [data.hex()]
+
+    def close(self):
+        return []
+
+
+def create_sink(device: str, descriptor: bytes = None, offset: int = None, bit_lengths=None):
+    '''
+    Decoder for a kind of device. Mice and tablets use the captured report descriptor when there is one,
+    otherwise offset (default 0 for mice, 1 for tablets) and bit_lengths (mice only, default 8 8 8)
+    '''
+    match device:
+        case 'keyboard':
+            return KeyboardSink()
+        case 'mouse':
+            return MouseSink(descriptor, offset or 0, bit_lengths or (8, 8, 8))
+        case 'tablet':
+            return TabletSink(descriptor, 1 if offset is None else offset)
+        case _:
+            return HexSink()
+
+
+def header_length(path: str) -> int:
+    # read(2) on a usbmon device returns the original 48 byte header, pcap tools use the 64 byte one
+    return 48 if stat.S_ISCHR(os.stat(path).st_mode) else 64
+
+
+async def read_usbmon(path: str, header_len: int, frames: asyncio.Queue):
+    '''
+    Read usbmon events and queue them as (linktype, timestamp, frame), ends with None
+    '''
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2**20)
+    linktype = LINKTYPE_USB_LINUX_MMAPPED if header_len == 64 else LINKTYPE_USB_LINUX
+
+    try:
+        pipe = open(path, 'rb', buffering=0)  # Blocks until a FIFO has a writer
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+
+        while True:
+            header = await reader.readexactly(header_len)
+            ts_sec, ts_usec, len_cap = USBMON_FIELDS.unpack_from(header)
+            data = await reader.readexactly(len_cap)
+            await frames.put((linktype, ts_sec + ts_usec * 1e-6, header + data))
+    except asyncio.IncompleteReadError:
+        pass  # Writer closed the pipe
+    except asyncio.CancelledError:
+        pass  # Interrupted
+    finally:
+        await frames.put(None)
+
+
+async def demultiplex(frames: asyncio.Queue, tracker: DeviceTracker, start_decoder) -> int:
+    '''
+    Resolve frames to HID reports and route them to one queue per endpoint, returns the report count
+    '''
+    queues = {}
+    count = 0
+    while (frame := await frames.get()) is not None:
+        for addr, ts, data in extract_hid_data(read_packets([frame]), tracker):
+            if addr not in queues:
+                queues[addr] = start_decoder(addr)
+            await queues[addr].put((ts, data))
+            count += 1
+
+    for queue in queues.values():
+        await queue.put(None)
+    return count
+
+
+async def decode(addr: str, sink, device: str, queue: asyncio.Queue, output):
+    write = lambda lines: [output.write(f'[{addr} {device}] {line}\n') for line in lines]
+
+    while (report := await queue.get()) is not None:
+        try:
+            write(sink.feed(*report))
+        except (IndexError, struct.error):
+            write([f'undecodable report {report[1].hex()}'])
+        output.flush()
+    write(sink.close())
+    output.flush()
+
+
+async def run_live_capture(path: str, header_len: int = None, devices: dict = None, output=sys.stdout, queue_size: int = QUEUE_SIZE, offset: int = None, bit_lengths=None):
+    tracker = DeviceTracker()
+    frames = asyncio.Queue(queue_size)
+    decoders = []
+
+    def start_decoder(addr):
+        # Device types given explicitly take precedence over the ones found in descriptors
+        device = (devices or {}).get(addr, tracker.devices.get(addr, 'unknown'))
+        sink = create_sink(device, tracker.descriptors.get(addr), offset, bit_lengths)
+        queue = asyncio.Queue(queue_size)
+        decoders.append(asyncio.create_task(decode(addr, sink, device, queue, output)))
+        return queue
+
+    reader = asyncio.create_task(read_usbmon(path, header_len or header_length(path), frames))
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, reader.cancel)
+    except (NotImplementedError, RuntimeError):
+        pass  # Not on the main thread or not supported, Ctrl+C interrupts immediately
+
+    count = await demultiplex(frames, tracker, start_decoder)
+    await asyncio.gather(reader, *decoders)
+    return count
+
+
+def live_capture(path: str, header_len: int = None, devices: dict = None, output=sys.stdout, queue_size: int = QUEUE_SIZE, offset: int = None, bit_lengths=None) -> int:
+    '''
+    Decode HID reports from a usbmon device or pipe until it is closed or interrupted (Ctrl+C),
+    returns the number of reports decoded. Mice and tablets enumerated during the capture are decoded
+    with their report descriptor, others with offset and bit_lengths (see create_sink).
+    '''
+    return asyncio.run(run_live_capture(path, header_len, devices, output, queue_size, offset, bit_lengths))
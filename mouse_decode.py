@@ -1,6 +1,15 @@
 #!/usr/bin/env python3
 import argparse
+import itertools
+import os
+import sys
+
+from cache import Cache
 from draw import draw_movement
+from hid_descriptor import DescriptorError, compile_extractor
+from hid_reports import parse_reports, read_descriptor, report_array
+from playback import has_timestamps
+from simplify import TOLERANCE
 
 
 def to_signed_int(n, bitlength):
@@ -25,10 +34,7 @@ def decode_line(line, bit_lengths):
 
 
 def decode_mouse_data(raw_data, bit_lengths, offset=0, absolute=False):
-    mouse_data = [
-        bytes.fromhex(''.join(d.strip().split(':')))[offset:]
-        for d in raw_data.split('\n') if d
-    ]
+    mouse_data = parse_reports(raw_data, offset)
 
     clicks, xs, ys = [], [0], [0]
     for line in mouse_data:
@@ -46,13 +52,141 @@ def decode_mouse_data(raw_data, bit_lengths, offset=0, absolute=False):
     return clicks, xs[1:], ys[1:]
 
 
+def decode_mouse_array(reports, bit_lengths, absolute=False):
+    '''
+    Vectorized decode_mouse_data for a (count, width) uint8 array of reports, returns NumPy arrays
+    '''
+    import numpy as np
+
+    # Little-endian integer of the first nbytes of each report (at most 48 bits)
+    nbytes = sum(bit_lengths) // 8
+    n = np.zeros(len(reports), dtype=np.uint64)
+    for i in range(min(nbytes, reports.shape[1])):
+        n |= reports[:, i].astype(np.uint64) << np.uint64(8 * i)
+
+    fields = []
+    shift = 0
+    for bitlength in bit_lengths:
+        fields.append(((n >> np.uint64(shift)) & np.uint64(2**bitlength - 1)).astype(np.int64))
+        shift += bitlength
+    clicks, xs, ys = fields
+
+    # Sign-extend displacements
+    for field, bitlength in ((xs, bit_lengths[1]), (ys, bit_lengths[2])):
+        field[field >= 2 ** (bitlength - 1)] -= 2 ** bitlength
+
+    if not absolute:
+        # Relative coordinates
+        xs = np.cumsum(xs)
+        ys = -np.cumsum(ys)
+
+    return clicks, xs, ys
+
+
+def decode_mouse_data_numpy(raw_data, bit_lengths, offset=0, absolute=False):
+    return decode_mouse_array(report_array(raw_data, offset), bit_lengths, absolute)
+
+
+def decode_mouse_descriptor(raw_data, descriptor):
+    '''
+    Decode reports with the layout of the device's HID report descriptor instead of --offset and --bit-lengths,
+    returns the indices of the decoded reports (others have different report IDs) and NumPy arrays
+    '''
+    import numpy as np
+
+    extractor = compile_extractor(descriptor, 'mouse')
+    indices, values = extractor(report_array(raw_data))
+    clicks, xs, ys = values['buttons'], values['x'], values['y']
+    if extractor.relative:
+        # Same y direction as decode_mouse_data for relative and absolute reports
+        xs, ys = np.cumsum(xs), -np.cumsum(ys)
+    return indices, clicks, xs, ys
+
+
+# Reports sampled for layout detection, as blocks of consecutive reports spread over the capture
+LAYOUT_BLOCKS = 8
+LAYOUT_BLOCK_SIZE = 1000
+THUMBNAIL_SIZE = 400
+
+
+def layout_candidates(width):
+    '''
+    All (offset, bit_lengths) layouts of byte-aligned 8, 12 or 16 bit fields fitting in reports of width bytes
+    '''
+    for bit_lengths in itertools.product((8, 12, 16), repeat=3):
+        if sum(bit_lengths) % 8 == 0:
+            for offset in range(width - sum(bit_lengths) // 8 + 1):
+                yield offset, bit_lengths
+
+
+def score_layout(reports, offset, bit_lengths, absolute=False):
+    '''
+    Implausibility of decoding reports with a layout, lower is more plausible (inf if nothing would be drawn)
+    '''
+    import numpy as np
+
+    clicks, dxs, dys = decode_mouse_array(reports[:, offset:], bit_lengths, absolute=True)
+    if absolute:
+        dxs, dys = np.diff(dxs), np.diff(dys)
+    distances = np.abs(dxs) + np.abs(dys)
+    if not distances.any():
+        return float('inf')
+
+    # Hand movement is smooth, displacements change little from report to report
+    roughness = (np.abs(np.diff(dxs)) + np.abs(np.diff(dys))).mean() / distances.mean()
+    # Drawings double back, misread fields drift off or jump around
+    spread = max(np.ptp(np.cumsum(dxs)), np.ptp(np.cumsum(dys))) / distances.sum()
+    # Small displacements per report
+    magnitude = np.log2(1 + np.median(distances))
+
+    # Few button states, changing rarely, mostly low bits, released at some point
+    _, counts = np.unique(clicks, return_counts=True)
+    p = counts / counts.sum()
+    entropy = -(p * np.log2(p)).sum()
+    changes = (clicks[1:] != clicks[:-1]).mean()
+    high_bits = (clicks >= 32).mean()
+    degenerate = (len(counts) == 1) + (not (clicks == 0).any()) + (not dxs.any() or not dys.any())
+
+    return float(roughness + spread + 0.1 * magnitude + 0.5 * entropy + 5 * changes + 2 * high_bits + degenerate)
+
+
+def score_layouts(reports, layouts, absolute=False):
+    return [(score_layout(reports, offset, bit_lengths, absolute), offset, bit_lengths) for offset, bit_lengths in layouts]
+
+
+def detect_layouts(reports, top=5, absolute=False, workers=None):
+    '''
+    Score every candidate layout on a sample of a (count, width) uint8 report array in parallel,
+    returns the top most plausible as (score, offset, bit_lengths)
+    '''
+    import numpy as np
+
+    if len(reports) > LAYOUT_BLOCKS * LAYOUT_BLOCK_SIZE:
+        starts = np.linspace(0, len(reports) - LAYOUT_BLOCK_SIZE, LAYOUT_BLOCKS).astype(int)
+        reports = np.concatenate([reports[start:start + LAYOUT_BLOCK_SIZE] for start in starts])
+
+    candidates = list(layout_candidates(reports.shape[1]))
+    workers = min(workers or os.cpu_count(), len(candidates))
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        chunks = [candidates[i::workers] for i in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            scores = [score for chunk in executor.map(score_layouts, itertools.repeat(reports), chunks, itertools.repeat(absolute)) for score in chunk]
+    else:
+        scores = score_layouts(reports, candidates, absolute)
+
+    scores = sorted(score for score in scores if score[0] != float('inf'))
+    return scores[:top]
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description='Visualize USB Mouse data',
         epilog='Keyboard commands:\n  <SPACE>: pause/resume animation\n  c: clear screen during animation\n  q: quit', 
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument('file', type=argparse.FileType('r'), help='mouse data file')
+    parser.add_argument('file', type=argparse.FileType('r'), help='mouse data file (hex or binary)')
     parser.add_argument('--offset', type=int, default=0, help='byte offset of data (default: %(default)s)')
     parser.add_argument('-b', '--bit-lengths', type=int, choices=[8, 12, 16], default=[8, 8, 8], nargs='+', help='bit lengths of each data field [click, x, y] (default: 8 8 8)')
     parser.add_argument('-m', '--mode', type=int, choices=range(3), default=1, metavar='0-2', help='''display mode for mouse movement, from less to more verbose (default: %(default)s)
@@ -61,7 +195,15 @@ def parse_args():
   2: show all mouse movements''')
     parser.add_argument('-c', '--clicks', action='store_true', help='show mouse clicks explicitly')
     parser.add_argument('-s', '--speed', type=int, choices=range(0, 11), default=0, metavar='0, 1-10', help='animation speed, 0 for no animation (default: %(default)s)')
+    parser.add_argument('-r', '--realtime', type=float, nargs='?', const=1.0, metavar='SPEED', help='animate at the captured pace, optionally sped up by a factor\n(requires timestamped reports, overrides --speed)')
+    parser.add_argument('--fps', type=int, default=30, help='frame rate of realtime animation (default: %(default)s)')
+    parser.add_argument('-t', '--tolerance', type=float, default=TOLERANCE, metavar='PIXELS', help='skip points closer than this to the previous one as drawn,\n0 to draw every report (default: %(default)s)')
+    parser.add_argument('-o', '--output', metavar='FILE', help='render the drawing to a PNG file instead of showing it, without a GUI\n(ignores animation options)')
     parser.add_argument('-a', '--absolute', action='store_true', help='interpret mouse coordinates as absolute')
+    parser.add_argument('--descriptor', metavar='FILE', help='decode with the HID report descriptor in FILE instead of --offset and --bit-lengths\n(default: the .desc file extracted next to the reports, \'none\' to ignore it)')
+    parser.add_argument('--auto', type=int, nargs='?', const=5, metavar='TOP', help='detect --offset and --bit-lengths, print the TOP most plausible layouts (default: 5)\nand draw the best one, with --output also rendering each as FILE-<rank>.png')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or store parsed reports and decoded results in the cache')
+    parser.add_argument('-w', '--workers', type=int, help='worker processes scoring layouts with --auto (default: CPU count)')
     return parser.parse_args()
 
 
@@ -77,8 +219,66 @@ def main():
         print('Total bit length must be a multiple of 8')
         exit()
 
-    clicks, xs, ys = decode_mouse_data(args.file.read(), bit_lengths=args.bit_lengths, offset=args.offset, absolute=args.absolute)
-    draw_movement(clicks, xs, ys, draw_mode=args.mode, draw_clicks=args.clicks, speed=args.speed)
+    cache = Cache(args.file.name, enabled=not args.no_cache, sources=('hid_descriptor.py', 'mouse_decode.py'))
+    raw_data, timestamps = cache.reports(args.file)
+    if args.realtime is not None and not args.output and not has_timestamps(timestamps):
+        print('Realtime animation requires timestamped reports (extract with --timestamps or --format bin)')
+        exit()
+
+    descriptor = None if args.auto else read_descriptor(args.file, args.descriptor)
+    if descriptor is not None:
+        try:
+            indices, clicks, xs, ys = cache.cached(lambda: decode_mouse_descriptor(raw_data, descriptor), 'mouse', descriptor)
+            print('Decoding with the report descriptor of the device', file=sys.stderr)
+            timestamps = None if timestamps is None else [timestamps[i] for i in indices.tolist()]
+        except DescriptorError as e:
+            print(f'{e}, falling back to --offset and --bit-lengths', file=sys.stderr)
+            descriptor = None
+        except ModuleNotFoundError:
+            print('Module \'numpy\' not found, required for --descriptor, falling back to --offset and --bit-lengths', file=sys.stderr)
+            descriptor = None
+
+    if args.auto:
+        try:
+            layouts = cache.cached(lambda: detect_layouts(report_array(raw_data), args.auto, args.absolute, args.workers), 'mouse-layouts', args.auto, args.absolute)
+        except ModuleNotFoundError:
+            print('Module \'numpy\' not found, required for --auto')
+            exit()
+        if not layouts:
+            print('No layout decodes to any movement')
+            exit()
+
+        print('Most plausible layouts (lower scores are better):')
+        for rank, (score, offset, bit_lengths) in enumerate(layouts, 1):
+            print(f'  {rank}. --offset {offset} --bit-lengths {" ".join(map(str, bit_lengths))}  (score {score:.3f})')
+            if args.output:
+                # Thumbnails to compare the candidates
+                from raster import render_png
+                stem, ext = os.path.splitext(args.output)
+                clicks, xs, ys = decode_mouse_data_numpy(raw_data, bit_lengths=bit_lengths, offset=offset, absolute=args.absolute)
+                render_png(f'{stem}-{rank}{ext or ".png"}', clicks, xs, ys, draw_mode=args.mode, draw_clicks=args.clicks, size=THUMBNAIL_SIZE, tolerance=args.tolerance)
+        _, args.offset, args.bit_lengths = layouts[0]
+
+    if descriptor is None:
+        try:
+            clicks, xs, ys = cache.cached(
+                lambda: decode_mouse_data_numpy(raw_data, bit_lengths=args.bit_lengths, offset=args.offset, absolute=args.absolute),
+                'mouse', args.offset, tuple(args.bit_lengths), args.absolute
+            )
+        except ModuleNotFoundError:
+            print('Module \'numpy\' not found, falling back to slower decoding')
+            clicks, xs, ys = decode_mouse_data(raw_data, bit_lengths=args.bit_lengths, offset=args.offset, absolute=args.absolute)
+
+    if args.output:
+        try:
+            from raster import render_png
+            render_png(args.output, clicks, xs, ys, draw_mode=args.mode, draw_clicks=args.clicks, tolerance=args.tolerance)
+        except ModuleNotFoundError:
+            print('Module \'numpy\' not found, required for --output')
+            exit()
+        return
+
+    draw_movement(clicks, xs, ys, draw_mode=args.mode, draw_clicks=args.clicks, speed=args.speed, timestamps=timestamps, realtime=args.realtime, fps=args.fps, tolerance=args.tolerance)
 
 
 if __name__ == '__main__':
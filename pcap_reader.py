@@ -0,0 +1,294 @@
+'''
+Minimal pcap, pcapng, and btsnoop reader
+
+Files are memory-mapped and each frame is returned as a zero-copy memoryview
+slice together with its link type and timestamp. Only the container formats
+are parsed, dissecting the frames is left to the caller.
+'''
+import mmap
+import struct
+
+from collections.abc import Iterator
+from typing import NamedTuple
+
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_BLUETOOTH_HCI_H4 = 187
+LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR = 201
+LINKTYPE_USB_LINUX_MMAPPED = 220
+LINKTYPE_USBPCAP = 249
+
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+BTSNOOP_MAGIC = b'btsnoop\x00'
+
+# pcapng block types
+SHB = 0x0A0D0D0A
+IDB = 0x00000001
+PB = 0x00000002
+SPB = 0x00000003
+EPB = 0x00000006
+
+# btsnoop datalink types
+BTSNOOP_HCI_UN_ENCAP = 1001
+BTSNOOP_HCI_UART = 1002
+BTSNOOP_MONITOR = 2001
+BTSNOOP_EPOCH_DELTA = 0x00E03AB44A676000  # Microseconds between year 0 and 1970
+
+# H4 packet type for each Linux monitor opcode (command, event, ACL TX/RX, SCO TX/RX)
+MONITOR_H4_TYPES = {2: b'\x01', 3: b'\x04', 4: b'\x02', 5: b'\x02', 6: b'\x03', 7: b'\x03'}
+
+SHARD_SIZE = 64 << 20  # Bytes
+
+
+class CaptureFormatError(Exception):
+    pass
+
+
+class Shard(NamedTuple):
+    '''
+    Byte range of a capture starting at a record/block boundary, with the pcapng
+    section state (byte order and interfaces) in effect at its start
+    '''
+    start: int
+    end: int
+    byteorder: str = '<'
+    interfaces: tuple = ()
+
+
+def open_capture(filename: str) -> mmap.mmap:
+    with open(filename, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty file
+            raise CaptureFormatError(f'{filename} is empty')
+
+
+def capture_format(mm: mmap.mmap) -> str | None:
+    if mm[:4] in PCAP_MAGIC and len(mm) >= 24:
+        return 'pcap'
+    if mm[:4] == PCAPNG_MAGIC and len(mm) >= 12:
+        return 'pcapng'
+    if mm[:8] == BTSNOOP_MAGIC and len(mm) >= 16:
+        return 'btsnoop'
+    return None
+
+
+def read_capture(filename: str, shard: Shard = None) -> Iterator[tuple[int, float, memoryview]]:
+    '''
+    Open a capture file and return a lazy stream of (linktype, timestamp, data) frames,
+    optionally only those in a shard from shard_capture().
+    Raises CaptureFormatError immediately if the file is not a supported capture.
+    '''
+    mm = open_capture(filename)
+    match capture_format(mm):
+        case 'pcap':
+            reader = read_pcap(mm, *shard[:2]) if shard else read_pcap(mm)
+        case 'pcapng':
+            reader = read_pcapng(mm, *shard) if shard else read_pcapng(mm)
+        case 'btsnoop' if shard is None:
+            reader = read_btsnoop(mm)
+        case _:
+            mm.close()
+            raise CaptureFormatError(f'{filename} is not a pcap, pcapng, or btsnoop file')
+
+    return closing_mmap(mm, reader)
+
+
+def shard_capture(filename: str, shard_size: int = SHARD_SIZE) -> list[Shard] | None:
+    '''
+    Split a pcap or pcapng file into shards of about shard_size bytes, aligned to
+    record/block boundaries, by walking the record headers once.
+    Returns None for formats that cannot be sharded.
+    '''
+    mm = open_capture(filename)
+    try:
+        match capture_format(mm):
+            case 'pcap':
+                headers = walk_pcap(mm)
+            case 'pcapng':
+                headers = walk_pcapng(mm)
+            case _:
+                return None
+
+        size = len(mm)
+        shards = []
+        boundary = 0
+        for offset, state in headers:
+            if offset >= boundary:
+                shards.append(Shard(offset, size, *state))
+                boundary = offset + shard_size
+        return [shard._replace(end=next_shard.start) for shard, next_shard in zip(shards, shards[1:])] + shards[-1:]
+    finally:
+        mm.close()
+
+
+def walk_pcap(mm: mmap.mmap) -> Iterator[tuple[int, tuple]]:
+    byteorder, _ = PCAP_MAGIC[mm[:4]]
+    incl_len = struct.Struct(byteorder + 'I')
+    size = len(mm)
+    i = 24
+    while i + 16 <= size:
+        yield i, ()
+        i += 16 + incl_len.unpack_from(mm, i + 8)[0]
+
+
+def walk_pcapng(mm: mmap.mmap) -> Iterator[tuple[int, tuple]]:
+    size = len(mm)
+    byteorder = '<'
+    interfaces = []
+    block_header = struct.Struct('<II')
+
+    i = 0
+    while i + 12 <= size:
+        if mm[i:i + 4] == PCAPNG_MAGIC:
+            byteorder = '<' if mm[i + 8:i + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+            block_header = struct.Struct(byteorder + 'II')
+            interfaces = []
+
+        yield i, (byteorder, tuple(interfaces))
+
+        block_type, block_len = block_header.unpack_from(mm, i)
+        if block_len < 12:
+            break
+        if block_type == IDB:
+            interfaces.append(parse_idb(memoryview(mm)[i:i + block_len], byteorder))
+        i += block_len
+
+
+def closing_mmap(mm: mmap.mmap, reader: Iterator) -> Iterator:
+    try:
+        yield from reader
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            pass  # Frames still referenced by the caller, the map is released once they are
+
+
+def read_pcap(mm: mmap.mmap, start: int = 24, end: int = None) -> Iterator[tuple[int, float, memoryview]]:
+    byteorder, resolution = PCAP_MAGIC[mm[:4]]
+    linktype = struct.unpack_from(byteorder + 'I', mm, 20)[0] & 0xFFFF
+    record_header = struct.Struct(byteorder + 'IIII')
+
+    buf = memoryview(mm)
+    size = len(buf) if end is None else end
+    i = start
+    while i + 16 <= size:
+        ts_sec, ts_frac, incl_len, _ = record_header.unpack_from(buf, i)
+        i += 16
+        if i + incl_len > size:
+            break  # Truncated capture
+        yield linktype, ts_sec + ts_frac * resolution, buf[i:i + incl_len]
+        i += incl_len
+
+
+def parse_tsresol(options: memoryview, byteorder: str) -> float:
+    i = 0
+    while i + 4 <= len(options):
+        code, length = struct.unpack_from(byteorder + 'HH', options, i)
+        if code == 0:  # opt_endofopt
+            break
+        if code == 9 and length >= 1:  # if_tsresol
+            value = options[i + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        i += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def parse_idb(block: memoryview, byteorder: str) -> tuple[int, int, float]:
+    linktype, _, snaplen = struct.unpack_from(byteorder + 'HHI', block, 8)
+    return linktype, snaplen, parse_tsresol(block[16:-4], byteorder)
+
+
+def read_pcapng(mm: mmap.mmap, start: int = 0, end: int = None, byteorder: str = '<', interfaces: tuple = ()) -> Iterator[tuple[int, float, memoryview]]:
+    buf = memoryview(mm)
+    size = len(buf) if end is None else end
+    interfaces = list(interfaces)  # (linktype, snaplen, tsresol) per interface in the current section
+    block_header = struct.Struct(byteorder + 'II')
+    epb = struct.Struct(byteorder + 'IIIII')
+
+    def interface(interface_id):
+        if interface_id >= len(interfaces):
+            raise CaptureFormatError(f'Packet block at offset {i} refers to undefined interface {interface_id}')
+        return interfaces[interface_id]
+
+    i = start
+    while i + 12 <= size:
+        if buf[i:i + 4] == PCAPNG_MAGIC:
+            # New section, byte order may change and interfaces are reset
+            byteorder = '<' if buf[i + 8:i + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+            block_header = struct.Struct(byteorder + 'II')
+            epb = struct.Struct(byteorder + 'IIIII')
+            interfaces = []
+
+        block_type, block_len = block_header.unpack_from(buf, i)
+        if block_len < 12 or i + block_len > len(buf):
+            break  # Corrupt or truncated block
+        body = i + 8
+
+        if block_type == EPB:
+            interface_id, ts_high, ts_low, cap_len, _ = epb.unpack_from(buf, body)
+            linktype, _, tsresol = interface(interface_id)
+            data = body + 20
+            yield linktype, ((ts_high << 32) | ts_low) * tsresol, buf[data:data + cap_len]
+        elif block_type == SPB:
+            orig_len = struct.unpack_from(byteorder + 'I', buf, body)[0]
+            linktype, snaplen, _ = interface(0)
+            cap_len = min(orig_len, block_len - 16, snaplen or orig_len)
+            yield linktype, None, buf[body + 4:body + 4 + cap_len]
+        elif block_type == PB:
+            interface_id, _, ts_high, ts_low, cap_len, _ = struct.unpack_from(byteorder + 'HHIIII', buf, body)
+            linktype, _, tsresol = interface(interface_id)
+            data = body + 20
+            yield linktype, ((ts_high << 32) | ts_low) * tsresol, buf[data:data + cap_len]
+        elif block_type == IDB:
+            interfaces.append(parse_idb(buf[i:i + block_len], byteorder))
+
+        i += block_len
+
+
+def h4_type(datalink: int, flags: int) -> bytes | None:
+    if datalink == BTSNOOP_MONITOR:
+        return MONITOR_H4_TYPES.get(flags & 0xFFFF)
+
+    # Un-encapsulated HCI: bit 1 set for commands/events, bit 0 set for received packets
+    if flags & 0b10:
+        return b'\x04' if flags & 0b01 else b'\x01'
+    return b'\x02'
+
+
+def read_btsnoop(mm: mmap.mmap) -> Iterator[tuple[int, float, memoryview]]:
+    '''
+    Frames are returned as HCI H4, other datalinks are converted by prepending the H4 packet type
+    '''
+    datalink = struct.unpack_from('>I', mm, 12)[0]
+    if datalink not in (BTSNOOP_HCI_UN_ENCAP, BTSNOOP_HCI_UART, BTSNOOP_MONITOR):
+        print(f'Unsupported btsnoop datalink type {datalink}')
+        return
+    record_header = struct.Struct('>IIIIq')
+
+    buf = memoryview(mm)
+    size = len(buf)
+    i = 16
+    while i + 24 <= size:
+        _, incl_len, flags, _, ts = record_header.unpack_from(buf, i)
+        i += 24
+        if i + incl_len > size:
+            break
+
+        data = buf[i:i + incl_len]
+        i += incl_len
+        if datalink != BTSNOOP_HCI_UART:
+            packet_type = h4_type(datalink, flags)
+            if packet_type is None:
+                continue
+            data = packet_type + data
+
+        yield LINKTYPE_BLUETOOTH_HCI_H4, (ts - BTSNOOP_EPOCH_DELTA) / 1e6, data
@@ -0,0 +1,89 @@
+'''
+Timing for replaying captured reports at their original pace
+
+Every report is scheduled against a fixed origin (first timestamp <-> start of playback)
+instead of sleeping for the gap since the previous report, so time spent sending keys
+or rendering never accumulates as drift. Animations render in fixed frames and skip the
+frames they have fallen behind on rather than slowing down the whole timeline.
+'''
+import math
+import time
+
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+
+
+def has_timestamps(timestamps: Sequence[float] | None) -> bool:
+    return timestamps is not None and len(timestamps) > 0 and not any(math.isnan(ts) for ts in timestamps)
+
+
+class Playback:
+    def __init__(self, timestamps: Sequence[float], speed: float = 1.0, clock=time.perf_counter, sleep=time.sleep):
+        if speed <= 0:
+            raise ValueError('Playback speed must be positive')
+        self.timestamps = timestamps
+        self.speed = speed
+        self.clock = clock
+        self.sleep = sleep
+        self.origin = timestamps[0] if len(timestamps) else 0.0
+        self.start = clock()
+
+    def due(self, index: int) -> float:
+        '''Clock time at which report index should be played'''
+        return self.start + (self.timestamps[index] - self.origin) / self.speed
+
+    def wait(self, index: int) -> float:
+        '''
+        Sleep until report index is due, returns how many seconds playback is behind (0 if on time)
+        '''
+        return self.wait_until(self.timestamps[index])
+
+    def wait_until(self, timestamp: float) -> float:
+        '''
+        Same as wait for a report timestamp, for streams where only the first timestamp is known up front
+        '''
+        delay = self.start + (timestamp - self.origin) / self.speed - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+            return 0.0
+        return -delay
+
+    @contextmanager
+    def paused(self):
+        '''Exclude the time spent inside the block (e.g. waiting for user input) from the timeline'''
+        paused_at = self.clock()
+        try:
+            yield
+        finally:
+            self.start += self.clock() - paused_at
+
+    def frames(self, fps: float = 30) -> Iterator[tuple[int, int]]:
+        '''
+        Group reports into animation frames, yielding (start, end) index ranges of the reports
+        due by each frame. The caller renders the range, and the next frame waits for its tick.
+        Ticks that passed while rendering are dropped and their reports folded into the next frame.
+        '''
+        interval = 1 / fps
+        count = len(self.timestamps)
+        i = 0
+        tick = 0
+        while i < count:
+            deadline = self.start + tick * interval
+            delay = deadline - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+            else:
+                # Behind schedule, skip straight to the current tick
+                tick = int((self.clock() - self.start) / interval)
+                deadline = self.start + tick * interval
+
+            end = i
+            while end < count and self.due(end) <= deadline:
+                end += 1
+            if end > i:
+                yield i, end
+                i = end
+                tick += 1
+            else:
+                # Nothing due yet, jump to the tick of the next report
+                tick = max(tick + 1, math.ceil((self.due(i) - self.start) / interval))
@@ -0,0 +1,157 @@
+'''
+Headless rendering of mouse and tablet movement straight to PNG
+
+Movement is rasterized into a NumPy pixel buffer without matplotlib, for batch use where only
+the final image is needed. Lines are antialiased in the manner of Xiaolin Wu's algorithm, all
+segments at once: each segment is sampled once per pixel along its major axis, and every sample
+covers the pixels across the line by how much of them the line's width overlaps.
+Colors and line widths follow draw_movement, drawn on a white background without axes.
+'''
+import math
+import struct
+import zlib
+
+from simplify import TOLERANCE, simplify_movement
+
+
+SIZE = 1600  # Longest image side in pixels
+MARGIN = 50  # Around the movement, in movement units as in draw_movement
+PIXELS_PER_POINT = 100 / 72  # Line widths are given in points, as in matplotlib at 100 dpi
+CLICK_MARKER_SIZE = 8  # Points
+
+
+def click_color(click):
+    left, right, middle = click & 0b1, (click & 0b10) >> 1, (click & 0b100) >> 2
+    return (left * 0.8, middle * 0.8, right * 0.8) if click else (0.827, 0.827, 0.827)  # lightgray
+
+
+def line_coverage(coverage, x0, y0, x1, y1, widths, alphas):
+    '''
+    Draw antialiased lines from (x0, y0) to (x1, y1) into a 2D coverage buffer, keeping the
+    highest coverage of each pixel. Coordinates are in pixels, widths and alphas per line.
+    '''
+    import numpy as np
+
+    height, width = coverage.shape
+    dx, dy = x1 - x0, y1 - y0
+    steep = np.abs(dy) > np.abs(dx)
+    major0, minor0 = np.where(steep, y0, x0), np.where(steep, x0, y0)
+    major_delta, minor_delta = np.where(steep, dy, dx), np.where(steep, dx, dy)
+    slope = np.divide(minor_delta, major_delta, out=np.zeros_like(minor_delta), where=major_delta != 0)
+    direction = np.where(major_delta < 0, -1.0, 1.0)
+    # Width across the minor axis grows with the slope
+    half_widths = widths / 2 * np.sqrt(1 + slope ** 2)
+
+    # One sample per pixel along the major axis
+    counts = np.floor(np.abs(major_delta)).astype(np.int64) + 1
+    lines = np.repeat(np.arange(len(counts)), counts)
+    steps = np.arange(len(lines)) - np.repeat(np.cumsum(counts) - counts, counts)
+    major = np.rint(major0[lines] + steps * direction[lines]).astype(np.int64)
+    center = minor0[lines] + steps * direction[lines] * slope[lines]
+    half_width = half_widths[lines]
+
+    # Pixels across the line covering [center - half_width, center + half_width], pixel p spanning [p - 0.5, p + 0.5]
+    first = np.floor(center - half_width + 0.5).astype(np.int64)
+    span = int(math.ceil(2 * half_widths.max())) + 1 if len(half_widths) else 0
+    minor = first[:, None] + np.arange(span)
+    overlap = np.minimum(minor + 0.5, (center + half_width)[:, None]) - np.maximum(minor - 0.5, (center - half_width)[:, None])
+    values = np.clip(overlap, 0, 1) * alphas[lines][:, None]
+
+    major = np.broadcast_to(major[:, None], minor.shape)
+    steep = np.broadcast_to(steep[lines][:, None], minor.shape)
+    rows, cols = np.where(steep, major, minor), np.where(steep, minor, major)
+    inside = (values > 0) & (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    np.maximum.at(coverage.reshape(-1), rows[inside] * width + cols[inside], values[inside].astype(coverage.dtype))
+
+
+def rasterize(clicks, xs, ys, draw_mode=1, draw_clicks=False, pressures=None, pressure_style='width', size=SIZE, tolerance=TOLERANCE):
+    '''
+    Render movement as an RGB uint8 image with its longest side size pixels long,
+    skipping points closer than tolerance pixels (0 to draw every point)
+    '''
+    import numpy as np
+
+    clicks, xs, ys = np.asarray(clicks), np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    if len(clicks) == 0:
+        return np.full((size, size, 3), 255, dtype=np.uint8)
+
+    left, top = xs.min() - MARGIN, ys.max() + MARGIN
+    scale = size / max(xs.max() + MARGIN - left, top - (ys.min() - MARGIN))
+    width = int(math.ceil((xs.max() + MARGIN - left) * scale))
+    height = int(math.ceil((top - (ys.min() - MARGIN)) * scale))
+    max_pressure = max(np.max(pressures), 1) if pressures is not None else 1
+    if tolerance:
+        keep = simplify_movement(clicks, xs, ys, (tolerance / scale, tolerance / scale), pressures)
+        clicks, xs, ys = clicks[keep], xs[keep], ys[keep]
+        pressures = None if pressures is None else np.asarray(pressures)[keep]
+    # Pixel centers are at integer coordinates, y increases downwards
+    px, py = (xs - left) * scale - 0.5, (top - ys) * scale - 0.5
+
+    image = np.ones((height, width, 3), dtype=np.float32)
+    coverage = np.zeros((height, width), dtype=np.float32)
+
+    def composite(color):
+        # Blend the drawn pixels with the color over the image so far
+        drawn = np.flatnonzero(coverage)
+        alpha = coverage.reshape(-1)[drawn, None]
+        pixels = image.reshape(-1, 3)
+        pixels[drawn] = pixels[drawn] * (1 - alpha) + np.asarray(color, dtype=np.float32) * alpha
+        coverage.fill(0)
+
+    if draw_mode:
+        # Step i moves from point i - 1 to point i, drawn per button state in order of appearance as in draw_movement
+        start_x, start_y = np.concatenate((px[:1], px[:-1])), np.concatenate((py[:1], py[:-1]))
+        drawn = np.ones(len(clicks), dtype=bool) if draw_mode == 2 else clicks != 0
+        states, first = np.unique(clicks[drawn], return_index=True)
+
+        for click in states[np.argsort(first)].tolist():
+            steps = np.flatnonzero(drawn & (clicks == click))
+            widths = np.full(len(steps), 2.0 if click else 1.0)
+            alphas = np.ones(len(steps))
+            if pressures is not None and click:
+                # Scale width or opacity of each clicked step by pressure
+                level = np.maximum(np.asarray(pressures)[steps], 0) / max_pressure
+                if pressure_style == 'alpha':
+                    alphas = 0.1 + 0.9 * level
+                else:
+                    widths = 0.2 + 4 * level
+            line_coverage(coverage, start_x[steps], start_y[steps], px[steps], py[steps], widths * PIXELS_PER_POINT, alphas)
+            composite(click_color(click))
+
+    if draw_clicks:
+        # Clicks are marked with a '+' where a button is first pressed
+        pressed = np.flatnonzero((clicks != 0) & (np.concatenate(([0], clicks[:-1])) == 0))
+        arm = CLICK_MARKER_SIZE * PIXELS_PER_POINT / 2
+        for click in np.unique(clicks[pressed]).tolist():
+            x, y = px[pressed[clicks[pressed] == click]], py[pressed[clicks[pressed] == click]]
+            x0, y0 = np.concatenate((x - arm, x)), np.concatenate((y, y - arm))
+            x1, y1 = np.concatenate((x + arm, x)), np.concatenate((y, y + arm))
+            line_coverage(coverage, x0, y0, x1, y1, np.full(len(x0), PIXELS_PER_POINT), np.ones(len(x0)))
+            composite(click_color(click))
+
+    return np.rint(image * 255).astype(np.uint8)
+
+
+def write_png(path, image):
+    '''
+    Write an RGB uint8 image as an 8-bit truecolor PNG
+    '''
+    import numpy as np
+
+    height, width = image.shape[:2]
+    # Every scanline starts with its filter type, 0 for none
+    scanlines = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = image.reshape(height, -1)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def render_png(path, clicks, xs, ys, draw_mode=1, draw_clicks=False, pressures=None, pressure_style='width', size=SIZE, tolerance=TOLERANCE):
+    write_png(path, rasterize(clicks, xs, ys, draw_mode, draw_clicks, pressures, pressure_style, size, tolerance))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+'''
+Replay a recorded usbmon capture into a named pipe, as a stand-in for a live usbmon device
+'''
+import argparse
+import os
+import struct
+
+from collections.abc import Iterator
+from pcap_reader import LINKTYPE_USB_LINUX, LINKTYPE_USB_LINUX_MMAPPED, CaptureFormatError, read_capture
+from playback import Playback
+
+
+LEN_CAP = struct.Struct('<I')
+LEN_CAP_OFFSET = 36
+
+
+def usbmon_events(filename: str) -> Iterator[tuple[float, bytes]]:
+    '''
+    Events of a usbmon capture with 64 byte headers, with the captured length set to the data actually present
+    '''
+    skipped = False
+    for linktype, ts, frame in read_capture(filename):
+        if linktype == LINKTYPE_USB_LINUX_MMAPPED:
+            header, data = frame[:64], frame[64:]
+        elif linktype == LINKTYPE_USB_LINUX:
+            header, data = bytes(frame[:48]) + bytes(16), frame[48:]
+        else:
+            if not skipped:
+                print(f'Skipping frames with link type {linktype}, only usbmon captures can be replayed')
+                skipped = True
+            continue
+
+        if len(header) < 64:
+            continue  # Truncated frame
+        header = bytearray(header)
+        LEN_CAP.pack_into(header, LEN_CAP_OFFSET, len(data))
+        yield ts, bytes(header) + bytes(data)
+
+
+def replay_capture(filename: str, pipe: str, speed: float = 1.0) -> int:
+    '''
+    Write the events to pipe at their original pace scaled by speed (0 for as fast as the reader consumes them),
+    returns the number of events written
+    '''
+    if not os.path.exists(pipe):
+        os.mkfifo(pipe)
+
+    events = usbmon_events(filename)
+    count = 0
+    with open(pipe, 'wb', buffering=0) as f:  # Blocks until the reader opens the pipe
+        playback = None
+        for ts, event in events:
+            if speed > 0:
+                playback = playback or Playback([ts], speed)
+                playback.wait_until(ts)
+            f.write(event)
+            count += 1
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Replay a usbmon capture into a named pipe for extract_hid_data.py --live',
+        epilog='Example:\n  python replay_capture.py capture.pcapng /tmp/usbmon --speed 10 &\n  python extract_hid_data.py --live /tmp/usbmon',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('file', help='usbmon capture (pcap or pcapng)')
+    parser.add_argument('pipe', help='named pipe to write to, created if missing')
+    parser.add_argument('-s', '--speed', type=float, default=1.0, help='playback speed factor, 0 for no delays (default: %(default)s)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        count = replay_capture(args.file, args.pipe, args.speed)
+    except CaptureFormatError as e:
+        print(e)
+        exit()
+    except BrokenPipeError:
+        print('Reader closed the pipe, stopping...')
+        exit()
+    print(f'Replayed {count} events into {args.pipe}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+'''
+Level of detail for large mouse and tablet traces
+
+Most consecutive reports of a long capture end up on the same screen pixel. Movement is
+decimated on a grid of cells of the tolerance size (a fraction of a pixel at the target
+resolution): of every run of consecutive reports within the same cell, button state and
+pressure level, only the last point is kept, as the path between the kept points deviates
+from the original by less than a cell. Points where buttons change are always kept, so colors
+and click markers stay exactly in place.
+'''
+
+
+TOLERANCE = 0.5  # Pixels
+PRESSURE_LEVELS = 64  # Pressure steps too small to see in line width or opacity
+
+
+def simplify_movement(clicks, xs, ys, cell, pressures=None):
+    '''
+    Indices of the points to draw, for a cell size (width, height) in movement units
+    '''
+    import numpy as np
+
+    cell_width, cell_height = cell
+    count = len(clicks)
+    if count < 3 or cell_width <= 0 or cell_height <= 0:
+        return np.arange(count)
+
+    clicks = np.asarray(clicks)
+    cells_x = np.floor(np.asarray(xs) / cell_width)
+    cells_y = np.floor(np.asarray(ys) / cell_height)
+    changes = (cells_x[1:] != cells_x[:-1]) | (cells_y[1:] != cells_y[:-1])
+    clicked = clicks[1:] != clicks[:-1]
+    if pressures is not None:
+        pressures = np.asarray(pressures)
+        levels = np.floor(np.maximum(pressures, 0) / max(np.max(pressures), 1) * PRESSURE_LEVELS)
+        changes |= levels[1:] != levels[:-1]
+
+    # Last point of each run, and the first point after a button change
+    keep = np.zeros(count, dtype=bool)
+    keep[:-1] = changes | clicked
+    keep[1:] |= clicked
+    keep[0] = keep[-1] = True
+    return np.flatnonzero(keep)
+
+
+def cell_size(extents, resolution, tolerance=TOLERANCE):
+    '''
+    Cell size in movement units for extents (width, height) drawn at resolution (width, height) in pixels
+    '''
+    return tuple(extent / pixels * tolerance for extent, pixels in zip(extents, resolution))
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 import argparse
 import struct
+import sys
 
+from cache import Cache
 from draw import draw_movement
+from hid_descriptor import DescriptorError, compile_extractor
+from hid_reports import parse_reports, read_descriptor, report_array
+from playback import has_timestamps
+from simplify import TOLERANCE
 
 
 def to_signed_int(n, bitlength):
@@ -12,10 +18,7 @@ def to_signed_int(n, bitlength):
 
 
 def decode_tablet_data(raw_data, offset=0):
-    tablet_data = [
-        bytes.fromhex(''.join(d.strip().split(':')))[offset:]
-        for d in raw_data.split('\n') if d
-    ]
+    tablet_data = parse_reports(raw_data, offset)
 
     clicks, xs, ys, pressures = [], [], [], []
     for line in tablet_data:
@@ -28,25 +31,114 @@ def decode_tablet_data(raw_data, offset=0):
     return clicks, xs, ys, pressures
 
 
+def decode_tablet_array(reports, offset=0):
+    '''
+    Vectorized decode_tablet_data for a (count, width) uint8 array of reports, viewing each report
+    as a structured (button, x, y, pressure) record at offset, returns NumPy arrays
+    '''
+    import numpy as np
+
+    if len(reports) == 0:
+        # An empty buffer has no room for a view at offset
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(4))
+
+    dtype = np.dtype([('button', 'u1'), ('x', '<i2'), ('y', '<i2'), ('pressure', '<i2')])
+    if reports.shape[1] < offset + dtype.itemsize:
+        reports = np.pad(reports, ((0, 0), (0, offset + dtype.itemsize - reports.shape[1])))
+    reports = np.ascontiguousarray(reports)
+
+    # Strided view over the report buffer, no copy
+    records = np.ndarray((len(reports),), dtype=dtype, buffer=reports, offset=offset, strides=(reports.shape[1],))
+    return (
+        (records['button'] & 0b1).astype(np.int64),
+        records['x'].astype(np.int64),
+        -records['y'].astype(np.int64),
+        records['pressure'].astype(np.int64),
+    )
+
+
+def decode_tablet_data_numpy(raw_data, offset=0):
+    return decode_tablet_array(report_array(raw_data), offset)
+
+
+def decode_tablet_descriptor(raw_data, descriptor):
+    '''
+    Decode reports with the layout of the device's HID report descriptor instead of --offset,
+    returns the indices of the decoded reports (others have different report IDs) and NumPy arrays
+    '''
+    import numpy as np
+
+    extractor = compile_extractor(descriptor, 'tablet')
+    indices, values = extractor(report_array(raw_data))
+    xs, ys = values['x'], values['y']
+    if extractor.relative:
+        xs, ys = np.cumsum(xs), np.cumsum(ys)
+    return indices, values['buttons'], xs, -ys, values['pressure']
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description='Visualize USB Tablet Data',
         epilog='Keyboard commands:\n  <SPACE>: pause/resume animation\n  c: clear screen during animation\n  q: quit', 
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument('file', type=argparse.FileType('r'), help='tablet data file')
+    parser.add_argument('file', type=argparse.FileType('r'), help='tablet data file (hex or binary)')
     parser.add_argument('--offset', type=int, default=0, help='byte offset of data (default: %(default)s)')
+    parser.add_argument('--descriptor', metavar='FILE', help='decode with the HID report descriptor in FILE instead of --offset\n(default: the .desc file extracted next to the reports, \'none\' to ignore it)')
     parser.add_argument('-m', '--mode', type=int, choices=range(3), default=1, metavar='1-2', help='''display mode for pen movement, from less to more verbose (default: %(default)s)
   1: show pen movements only while clicked
   2: show all pen movements''')
+    parser.add_argument('-p', '--pressure', choices=('width', 'alpha'), help='draw pen pressure as line width or opacity')
     parser.add_argument('-s', '--speed', type=int, choices=range(0, 11), default=0, metavar='0, 1-10', help='animation speed, 0 for no animation (default: %(default)s)')
+    parser.add_argument('-r', '--realtime', type=float, nargs='?', const=1.0, metavar='SPEED', help='animate at the captured pace, optionally sped up by a factor\n(requires timestamped reports, overrides --speed)')
+    parser.add_argument('--fps', type=int, default=30, help='frame rate of realtime animation (default: %(default)s)')
+    parser.add_argument('-t', '--tolerance', type=float, default=TOLERANCE, metavar='PIXELS', help='skip points closer than this to the previous one as drawn,\n0 to draw every report (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or store parsed reports and decoded results in the cache')
+    parser.add_argument('-o', '--output', metavar='FILE', help='render the drawing to a PNG file instead of showing it, without a GUI\n(ignores animation options)')
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    clicks, xs, ys, _ = decode_tablet_data(args.file.read(), offset=args.offset)  # ignore pressure for now
-    draw_movement(clicks, xs, ys, draw_mode=args.mode, draw_clicks=False, speed=args.speed)
+    cache = Cache(args.file.name, enabled=not args.no_cache, sources=('hid_descriptor.py', 'tablet_decode.py'))
+    raw_data, timestamps = cache.reports(args.file)
+    if args.realtime is not None and not args.output and not has_timestamps(timestamps):
+        print('Realtime animation requires timestamped reports (extract with --timestamps or --format bin)')
+        exit()
+
+    descriptor = read_descriptor(args.file, args.descriptor)
+    if descriptor is not None:
+        try:
+            indices, clicks, xs, ys, pressures = cache.cached(lambda: decode_tablet_descriptor(raw_data, descriptor), 'tablet', descriptor)
+            print('Decoding with the report descriptor of the device', file=sys.stderr)
+            timestamps = None if timestamps is None else [timestamps[i] for i in indices.tolist()]
+        except DescriptorError as e:
+            print(f'{e}, falling back to --offset', file=sys.stderr)
+            descriptor = None
+        except ModuleNotFoundError:
+            print('Module \'numpy\' not found, required for --descriptor, falling back to --offset', file=sys.stderr)
+            descriptor = None
+
+    if descriptor is None:
+        try:
+            clicks, xs, ys, pressures = cache.cached(lambda: decode_tablet_data_numpy(raw_data, offset=args.offset), 'tablet', args.offset)
+        except ModuleNotFoundError:
+            print('Module \'numpy\' not found, falling back to slower decoding')
+            clicks, xs, ys, pressures = decode_tablet_data(raw_data, offset=args.offset)
+
+    if args.output:
+        try:
+            from raster import render_png
+            render_png(args.output, clicks, xs, ys, draw_mode=args.mode, pressures=pressures if args.pressure else None, pressure_style=args.pressure, tolerance=args.tolerance)
+        except ModuleNotFoundError:
+            print('Module \'numpy\' not found, required for --output')
+            exit()
+        return
+
+    draw_movement(
+        clicks, xs, ys, draw_mode=args.mode, draw_clicks=False, speed=args.speed, timestamps=timestamps, realtime=args.realtime, fps=args.fps,
+        pressures=pressures if args.pressure else None, pressure_style=args.pressure, tolerance=args.tolerance
+    )
 
 
 if __name__ == '__main__':
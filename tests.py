@@ -1,10 +1,37 @@
 '''
 Test decoding scripts against expected output
 '''
+import contextlib
+import io
+import os
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import signal
+import threading
+import types
 import unittest
+import unittest.mock
 from pathlib import Path
-from keyboard_decode import decode_keypresses, format_raw_keypresses, simulate_keypresses
-from mouse_decode import to_signed_int
+from benchmark import compare, run_benchmarks, scale_capture
+from cache import Cache
+import draw
+from draw import draw_static
+from extract_hid_data import extract_data, extract_hid_data, read_packets, write_results, DeviceTracker
+from generate_capture import create_devices, generate_capture
+from hid_descriptor import DescriptorError, device_kind, parse_descriptor
+from hid_reports import load_binary, parse_reports, parse_timestamps, read_descriptor, report_array
+from pcap_reader import LINKTYPE_USBPCAP, CaptureFormatError, read_capture
+from keyboard_decode import decode_keypresses, decode_keypresses_numpy, decode_timed_keypresses_descriptor, format_raw_keypresses, simulate_keypresses, KeyboardDecoder, KeyboardSimulator
+from mouse_decode import decode_mouse_data, decode_mouse_data_numpy, decode_mouse_descriptor, detect_layouts, to_signed_int
+from live_capture import create_sink, live_capture
+from playback import Playback
+from raster import rasterize, write_png
+from simplify import simplify_movement
+from replay_capture import replay_capture
+from tablet_decode import decode_tablet_array, decode_tablet_data, decode_tablet_data_numpy, decode_tablet_descriptor
 
 
 root = Path('.')
@@ -70,6 +97,59 @@ class KeyboardTest(unittest.TestCase):
                     output = simulate_keypresses(keypresses, text_mode=False)
                     self.assertEqual(expected, output, f'Decoded keypresses do not match expected output\n{error_message.format(expected=expected, output=output)}')
 
+    def test_simulated_editing(self):
+        keys = {k: (set(), (k,)) for k in ('ENTER', 'BACKSPACE', 'DELETE', 'HOME', 'END', 'LEFT', 'RIGHT', 'UP', 'DOWN')}
+        type_text = lambda text: [(set(), (c, c.upper())) for c in text]
+
+        # DELETE at the end of a line joins the next line onto it
+        keypresses = type_text('ab') + [keys['ENTER']] + type_text('cd') + [keys['UP'], keys['END'], keys['DELETE']] + type_text('x')
+        self.assertEqual('abxcd', simulate_keypresses(keypresses))
+
+        # Vertical moves keep the column where possible
+        keypresses = type_text('abcd') + [keys['ENTER']] + type_text('e') + [keys['UP'], keys['RIGHT'], keys['RIGHT'], keys['DOWN']] + type_text('f')
+        self.assertEqual('abcd\nef', simulate_keypresses(keypresses))
+
+    def test_streaming_output(self):
+        for ctf in (root / 'samples' / 'keyboard').iterdir():
+            with self.subTest(ctf.name):
+                with open(ctf / 'usbdata.txt') as f, open(ctf / 'output-sim-txt.txt') as g:
+                    expected = g.read()
+                    offset, reserved = self.parse_args(ctf)
+                    decoder = KeyboardDecoder(offset, reserved)
+                    simulator = KeyboardSimulator()
+
+                    # Feed reports one line at a time and flush lines far enough above the cursor
+                    lines = []
+                    for line in f:
+                        simulator.feed([keypress for _, keypress in decoder.feed(line)])
+                        lines += simulator.flush(keep=100)
+                    output = '\n'.join(lines + [simulator.text()])
+                    self.assertEqual(expected, output, f'Decoded keypresses do not match expected output\n{error_message.format(expected=expected, output=output)}')
+
+    def test_stdin(self):
+        # Redirected stdin is seekable, but has no file to memory-map or look up a descriptor next to
+        path = root / 'samples' / 'keyboard' / 'CSAW-2012-Net300' / 'usbdata.txt'
+        command = [sys.executable, 'keyboard_decode.py', '--no-cache']
+        expected = subprocess.run(command + [str(path)], cwd=root, capture_output=True, text=True, check=True).stdout
+        with open(path) as f:
+            output = subprocess.run(command + ['-'], cwd=root, stdin=f, capture_output=True, text=True, check=True).stdout
+        self.assertEqual(expected, output)
+
+    def test_vectorized_raw_output(self):
+        for ctf in (root / 'samples' / 'keyboard').iterdir():
+            with self.subTest(ctf.name):
+                with open(ctf / 'usbdata.txt') as f, open(ctf / 'output-raw.txt') as g:
+                    expected = g.read()
+                    offset, reserved = self.parse_args(ctf)
+                    keypresses = decode_keypresses_numpy(f.read(), offset, reserved)
+                    output = format_raw_keypresses(keypresses)
+                    self.assertEqual(expected, output, f'Decoded keypresses do not match expected output\n{error_message.format(expected=expected, output=output)}')
+
+    def test_vectorized_rollover(self):
+        # Keys held across reports, released and pressed again, repeated in a report, and in varying slots
+        raw_data = '\n'.join(['0000040000000000', '0200040500000000', '0000050400000000', '0000000000000000', '0100040404000000', '000006000007'])
+        self.assertEqual(decode_keypresses(raw_data), decode_keypresses_numpy(raw_data))
+
 class MouseTest(unittest.TestCase):
     def test_to_signed_int(self):
         self.assertEqual(to_signed_int(0, 8), 0)
@@ -78,5 +158,555 @@ class MouseTest(unittest.TestCase):
         self.assertEqual(to_signed_int(255, 8), -1)
         self.assertEqual(to_signed_int(1023, 10), -1)
 
+    def test_vectorized_decoding(self):
+        for path in sorted((root / 'samples' / 'mouse').glob('*')):
+            args = (path / 'draw.sh').read_text().split()
+            offset = int(args[args.index('--offset') + 1]) if '--offset' in args else 0
+            bit_lengths = [int(n) for n in args[args.index('--bit-lengths') + 1:][:3]]
+            raw_data = (path / 'usbdata.txt').read_text()
+
+            for absolute in (False, True):
+                with self.subTest(path.name, absolute=absolute):
+                    expected = decode_mouse_data(raw_data, bit_lengths, offset, absolute)
+                    decoded = decode_mouse_data_numpy(raw_data, bit_lengths, offset, absolute)
+                    self.assertEqual(expected, tuple(field.tolist() for field in decoded))
+
+    def test_vectorized_bit_lengths(self):
+        # Unaligned fields, negative extremes, and reports of varying length
+        raw_data = '\n'.join(['ffffffffffff', '008000800080', '0102', 'ff7fff7fff7f00', '123456789abc'])
+        for bit_lengths in ([8, 8, 8], [8, 12, 12], [16, 12, 12], [16, 16, 16], [12, 16, 12]):
+            with self.subTest(bit_lengths=bit_lengths):
+                expected = decode_mouse_data(raw_data, bit_lengths)
+                decoded = decode_mouse_data_numpy(raw_data, bit_lengths)
+                self.assertEqual(expected, tuple(field.tolist() for field in decoded))
+
+    def test_layout_detection(self):
+        # The hand-tuned layouts of the samples are the most plausible ones
+        for path in sorted((root / 'samples' / 'mouse').glob('*')):
+            args = (path / 'draw.sh').read_text().split()
+            offset = int(args[args.index('--offset') + 1]) if '--offset' in args else 0
+            bit_lengths = tuple(int(n) for n in args[args.index('--bit-lengths') + 1:][:3])
+            reports = report_array((path / 'usbdata.txt').read_text())
+
+            with self.subTest(path.name):
+                _, detected_offset, detected_bit_lengths = detect_layouts(reports, top=1, workers=2)[0]
+                self.assertEqual((offset, bit_lengths), (detected_offset, detected_bit_lengths))
+
+
+class TabletTest(unittest.TestCase):
+    def test_vectorized_decoding(self):
+        for path in sorted((root / 'samples' / 'tablet').glob('*')):
+            args = (path / 'draw.sh').read_text().split()
+            offset = int(args[args.index('--offset') + 1]) if '--offset' in args else 0
+            raw_data = (path / 'usbdata.txt').read_text()
+
+            with self.subTest(path.name):
+                expected = decode_tablet_data(raw_data, offset)
+                decoded = decode_tablet_data_numpy(raw_data, offset)
+                self.assertEqual(expected, tuple(field.tolist() for field in decoded))
+
+    def test_vectorized_extremes(self):
+        # Short reports are zero padded
+        raw_data = '0100800080ff7f\n00ffff0000\n'
+        self.assertEqual(([1, 0], [-32768, -1], [32768, 0], [32767, 0]), tuple(f.tolist() for f in decode_tablet_data_numpy(raw_data)))
+        self.assertEqual(([], [], [], []), tuple(f.tolist() for f in decode_tablet_array(report_array('', 1), 1)))
+
+
+class DescriptorTest(unittest.TestCase):
+    def test_sample_descriptors(self):
+        # Decoding with the captured report descriptor needs none of the per-sample arguments
+        for ctf in sorted((root / 'samples').glob('*/*')):
+            captures = list(ctf.glob('capture.*'))
+            match = re.search(r'usb\.src == "([\d.]+)"', (ctf / 'extract.sh').read_text())
+            if not captures or not match:
+                continue
+
+            tracker = DeviceTracker()
+            for _ in extract_data(str(captures[0]), tracker=tracker)[1]:
+                pass
+            if match.group(1) not in tracker.descriptors:
+                continue
+
+            with self.subTest(ctf.name):
+                descriptor = tracker.descriptors[match.group(1)]
+                raw_data = (ctf / 'usbdata.txt').read_text()
+                if ctf.parent.name == 'keyboard':
+                    output = format_raw_keypresses([keypress for _, keypress in decode_timed_keypresses_descriptor(raw_data, descriptor)])
+                    self.assertEqual((ctf / 'output-raw.txt').read_text(), output)
+                else:
+                    _, clicks, xs, ys = decode_mouse_descriptor(raw_data, descriptor)
+                    self.assertEqual(decode_mouse_data(raw_data, [8, 8, 8]), (clicks.tolist(), xs.tolist(), ys.tolist()))
+
+    def test_tablet_descriptor(self):
+        # Pen with report ID 8: tip and barrel switches, 6 bits padding, signed 16 bit x and y, 16 bit pressure
+        descriptor = bytes.fromhex(
+            '050d0902a1018508 0920a100 09420944150025017501950281029506 8103'
+            '0501 09300931160080 26ff7f 7510 9502 8102 050d 0930 1500 26ff7f 7510 9501 8102 c0c0'
+        )
+        (report,) = parse_descriptor(descriptor).values()
+        self.assertEqual((8, (0x0d, 0x02)), report[:2])
+        self.assertEqual([8, 9, 16, 32, 48], [field.bit_offset for field in report.fields])
+
+        raw_data = '\n'.join(['0801d204d2040010', '09ffffffffffffff', '0802ffff00802000', '0803010002000300'])
+        indices, clicks, xs, ys, pressures = decode_tablet_descriptor(raw_data, descriptor)
+        expected = decode_tablet_data_numpy('\n'.join(raw_data.split('\n')[::2] + raw_data.split('\n')[3:]), offset=1)
+        self.assertEqual([0, 2, 3], indices.tolist())
+        self.assertEqual([field.tolist() for field in expected], [clicks.tolist(), xs.tolist(), ys.tolist(), pressures.tolist()])
+
+    def test_absolute_mouse_descriptor(self):
+        # Three buttons and padding, absolute 16 bit x and y: y is kept as is, like --absolute
+        descriptor = bytes.fromhex(
+            '05010902a1010901a100 05091901290315002501750195038102 750595018101'
+            '050109300931150026ff7f75109502 8102 c0c0'
+        )
+        raw_data = '\n'.join(['0010002000', '0111002100', '0112002200', '0013002300'])
+        _, clicks, xs, ys = decode_mouse_descriptor(raw_data, descriptor)
+        self.assertEqual(decode_mouse_data(raw_data, [8, 16, 16], absolute=True), (clicks.tolist(), xs.tolist(), ys.tolist()))
+        sink = create_sink('mouse', descriptor)
+        self.assertEqual(['down 0x01 at (17, 33)', 'up 0x00 at (19, 35)'], [line for report in raw_data.split('\n') for line in sink.feed(0, bytes.fromhex(report))])
+
+    def test_generated_tablet_descriptor(self):
+        # The generated tablet has no report ID, so its reports are at offset 0
+        with tempfile.TemporaryDirectory() as tmp:
+            capture = os.path.join(tmp, 'capture.pcap')
+            generate_capture(capture, create_devices(keyboards=0, mice=0, tablets=1), duration=1)
+            tracker = DeviceTracker()
+            raw_data = '\n'.join(bytes(data).hex() for _, _, data in extract_data(capture, tracker=tracker)[1])
+
+        _, *values = decode_tablet_descriptor(raw_data, tracker.descriptors['1.2.1'])
+        self.assertEqual([field.tolist() for field in decode_tablet_data_numpy(raw_data)], [field.tolist() for field in values])
+
+    def test_malformed_descriptors(self):
+        # Huge report counts and usage ranges are rejected or bounded instead of expanded
+        huge_count = bytes.fromhex('05010902a101 7501 97ffffffff 8102 c0')
+        self.assertRaises(DescriptorError, parse_descriptor, huge_count)
+        zero_size = bytes.fromhex('05010902a101 7500 9600ff 8102 c0')
+        self.assertEqual({}, parse_descriptor(zero_size))
+        huge_range = bytes.fromhex('05010902a101 0509 1b00000000 2bffffffff 7501 9508 8102 c0')
+        self.assertEqual(8, len(parse_descriptor(huge_range)[0].fields))
+        self.assertRaises(DescriptorError, parse_descriptor, bytes.fromhex('05010902a101 26ff'))
+
+    def test_device_kind(self):
+        self.assertEqual('keyboard', device_kind(bytes.fromhex('05010906a101050719e029e71500250175019508810295067508150025650507190029658100c0')))
+        self.assertIsNone(device_kind(bytes.fromhex('050c0901a101c0')))  # Consumer control
+        self.assertIsNone(device_kind(bytes.fromhex('0501')))
+
+        # Endpoints without a boot interface protocol are classified from their descriptor
+        devices, hid_data = extract_data(str(root / 'samples' / 'keyboard' / 'CSAW-2012-Net300' / 'capture.pcap'))
+        for _ in hid_data:
+            pass
+        self.assertEqual('keyboard', devices['2.26.3'])
+        self.assertEqual('mouse', devices['2.26.4'])
+
+    def test_descriptor_file(self):
+        capture = root / 'samples' / 'mouse' / 'GoogleCTF-2016-For2' / 'capture.pcapng'
+        with tempfile.TemporaryDirectory() as tmp:
+            tracker = DeviceTracker()
+            devices, hid_data = extract_data(str(capture), tracker=tracker)
+            entries = write_results(devices, hid_data, tmp, descriptors=tracker.descriptors)
+            self.assertEqual('mouse-1.3.1.desc', entries['1.3.1']['descriptor'])
+            self.assertEqual(tracker.descriptors['1.3.1'], read_descriptor(Path(tmp) / 'mouse-1.3.1.txt'))
+            self.assertIsNone(read_descriptor(Path(tmp) / 'unknown-1.1.1.txt'))
+
+
+class CacheTest(unittest.TestCase):
+    def test_lookup(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'usbdata.txt'
+            path.write_text('01020300\n00ff0100\n')
+            cache = Cache(path, directory=Path(tmp) / 'cache')
+            with open(path) as f:
+                reports, timestamps = cache.reports(f)
+            self.assertEqual([[1, 2, 3, 0], [0, 255, 1, 0]], reports.tolist())
+            self.assertIsNone(timestamps)
+
+            self.assertEqual([1], cache.cached(lambda: [1], 'mouse', 0))
+            self.assertEqual([1], cache.cached(lambda: [2], 'mouse', 0))
+            self.assertEqual([3], cache.cached(lambda: [3], 'mouse', 1))
+            # Results of other code miss
+            self.assertIsNone(Cache(path, directory=cache.directory, sources=('mouse_decode.py',)).get('mouse', 0))
+            # Renamed files hit, modified files miss
+            path.rename(Path(tmp) / 'renamed.txt')
+            self.assertEqual([1], Cache(Path(tmp) / 'renamed.txt', directory=cache.directory).get('mouse', 0))
+            (Path(tmp) / 'renamed.txt').write_text('01020300\n')
+            self.assertIsNone(Cache(Path(tmp) / 'renamed.txt', directory=cache.directory).get('mouse', 0))
+            self.assertIsNone(Cache(path, enabled=False, directory=cache.directory).get('mouse', 0))
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'usbdata.txt'
+            path.write_text('01020300\n')
+            cache = Cache(path, directory=Path(tmp) / 'cache', max_size=2500)
+            for i in range(3):
+                cache.put(bytes(1000), 'value', i)
+                os.utime(cache.directory / f'{cache.key("value", i)}.pickle', (i, i))
+            # The oldest entry is evicted, and hits count as use
+            self.assertIsNone(cache.get('value', 0))
+            self.assertIsNotNone(cache.get('value', 1))
+            cache.put(bytes(1000), 'value', 3)
+            self.assertIsNone(cache.get('value', 2))
+            self.assertIsNotNone(cache.get('value', 1))
+
+            cache.put_files([path], {'count': 1}, 'files')
+            self.assertEqual({'count': 1}, cache.get_files(Path(tmp) / 'out', 'files'))
+            self.assertEqual(path.read_text(), (Path(tmp) / 'out' / 'usbdata.txt').read_text())
+
+            # Files that would fill the cache on their own are not copied into it
+            path.write_bytes(bytes(3000))
+            cache.put_files([path], {'count': 2}, 'large')
+            self.assertIsNone(cache.get_files(Path(tmp) / 'out', 'large'))
+
+
+class DrawTest(unittest.TestCase):
+    def test_static_runs(self):
+        import matplotlib.pyplot as plt
+
+        plt.figure()
+        draw_static([0, 1, 1, 0, 2, 2, 1], [0, 1, 2, 3, 4, 5, 6], [0, 1, 0, 1, 0, 1, 0], draw_mode=1, draw_clicks=True)
+        lines, clicks = plt.gca().collections[:-1], plt.gca().collections[-1]
+        plt.close()
+
+        # One collection per button state, one polyline per run, each starting at the point before the run
+        polylines = [[segment.tolist() for segment in collection.get_segments()] for collection in lines]
+        self.assertEqual([[[[0, 0], [1, 1], [2, 0]], [[5, 1], [6, 0]]], [[[3, 1], [4, 0], [5, 1]]]], polylines)
+
+        # Clicks are only marked when pressed from no buttons held
+        self.assertEqual([[1, 1], [4, 0]], clicks.get_offsets().tolist())
+
+
+    def test_keyboard_hooks(self):
+        import matplotlib.pyplot as plt
+
+        # Shortcuts are registered once, however many drawings are shown
+        keys = []
+        keyboard = types.SimpleNamespace(unhook_all=lambda: None, on_press_key=lambda key, callback: keys.append(key))
+        handler = signal.getsignal(signal.SIGINT)
+        draw.hook_keyboard.cache_clear()
+        try:
+            with unittest.mock.patch.dict(sys.modules, keyboard=keyboard), unittest.mock.patch('draw.shows_window', return_value=True):
+                for _ in range(2):
+                    draw.draw_movement([0, 1, 1], [0, 1, 2], [0, 1, 0], speed=10)
+                    plt.close('all')
+        finally:
+            signal.signal(signal.SIGINT, handler)
+            draw.hook_keyboard.cache_clear()
+        self.assertEqual(['q', 'space', 'c'], keys)
+
+    def test_lazy_imports(self):
+        # Decoding, extraction, and --help do not load matplotlib, the keyboard hooks, or process pools
+        code = (
+            'import signal, sys, extract_hid_data, keyboard_decode, mouse_decode, tablet_decode\n'
+            'print(signal.getsignal(signal.SIGINT) is signal.default_int_handler, *(m for m in sys.modules if m.split(".")[0] in ("matplotlib", "keyboard", "concurrent", "scapy")))'
+        )
+        output = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True).stdout
+        self.assertEqual('True\n', output)
+
+
+class RasterTest(unittest.TestCase):
+    def test_png_output(self):
+        import matplotlib.pyplot as plt
+
+        # Held movement only, a horizontal stroke across the middle of a 300x100 unit area
+        image = rasterize([0, 1, 1], [0, 100, 200], [0, 0, 0], draw_mode=1, size=300)
+        self.assertEqual((100, 300, 3), image.shape)
+        self.assertEqual([204, 0, 0], image[50, 150].tolist())
+        self.assertEqual([255, 255, 255], image[10, 150].tolist())
+        self.assertEqual([255, 255, 255], image[50, 10].tolist())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'output.png')
+            write_png(path, image)
+            self.assertEqual(image.tolist(), (plt.imread(path) * 255).round().astype(int).tolist())
+
+
+class SimplifyTest(unittest.TestCase):
+    def test_grid_decimation(self):
+        # Jitter within a 10x10 cell collapses to the last point of each run, points around button changes are kept
+        clicks = [0, 0, 1, 1, 1, 1, 1, 1, 0, 0]
+        xs = [0, 1, 2, 3, 4, 15, 16, 17, 18, 19]
+        ys = [0, 1, 2, 1, 2, 2, 1, 2, 1, 2]
+        self.assertEqual([0, 1, 2, 4, 7, 8, 9], simplify_movement(clicks, xs, ys, (10, 10)).tolist())
+        self.assertEqual(list(range(10)), simplify_movement(clicks, xs, ys, (0, 0)).tolist())
+
+        # Pressure changes split runs as well
+        pressures = [0, 0, 100, 100, 500, 500, 500, 1000, 0, 0]
+        self.assertEqual([0, 1, 2, 3, 4, 6, 7, 8, 9], simplify_movement(clicks, xs, ys, (10, 10), pressures).tolist())
+
+
+def usbpcap_frame(irp_id, device, endpoint, transfer_type, completion, data, stage=None):
+    header_len = 27 if stage is None else 28
+    header = struct.pack('<HQIHBHHBBI', header_len, irp_id, 0, 0, completion, 1, device, endpoint, transfer_type, len(data))
+    if stage is not None:
+        header += bytes([stage])
+    return LINKTYPE_USBPCAP, 0.0, header + data
+
+
+class ExtractTest(unittest.TestCase):
+    def test_sample_extraction(self):
+        for ctf in sorted((root / 'samples').glob('*/*')):
+            captures = list(ctf.glob('capture.*'))
+            extract_cmd = (ctf / 'extract.sh').read_text()
+            if not captures or 'btl2cap' in extract_cmd:
+                continue
+
+            with self.subTest(ctf.name):
+                with open(ctf / 'usbdata.txt') as f:
+                    expected = [line.replace(':', '') for line in f.read().split('\n') if line]
+
+                _, hid_data = extract_data(str(captures[0]))
+                reports = {}
+                for addr, _, data in hid_data:
+                    reports.setdefault(addr, []).append(data.hex())
+
+                if match := re.search(r'usb\.src == "([\d.]+)"', extract_cmd):
+                    self.assertEqual(expected, reports.get(match.group(1)))
+                else:
+                    self.assertIn(expected, reports.values())
+
+    def test_sharded_extraction(self):
+        def extract(capture, jobs):
+            # Small shards, so there are more of them than fit in the window of pending shards
+            devices, hid_data = extract_data(str(capture), jobs, shard_size=4096)
+            reports = {}
+            for addr, _, data in hid_data:
+                reports.setdefault(addr, []).append(bytes(data))
+            return devices, reports
+
+        for capture in sorted((root / 'samples').glob('*/*/capture.pcap*')):
+            with self.subTest(capture.parent.name):
+                self.assertEqual(extract(capture, 1), extract(capture, 3))
+
+    def test_invalid_hex(self):
+        # Extraction stops with an error, without leaving partial files in the output folder
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'usbdata.txt'
+            path.write_text('00010200\n00020300\nnot hex\n')
+            for binary in (False, True):
+                with self.subTest(binary=binary), contextlib.redirect_stdout(io.StringIO()):
+                    with self.assertRaises(CaptureFormatError):
+                        write_results(*extract_data(str(path)), f'{tmp}/out', binary=binary)
+                    self.assertEqual([], os.listdir(f'{tmp}/out'))
+
+    def test_binary_format(self):
+        capture = root / 'samples/tablet/vsCTF-2022-Lets_Play_osu/capture.pcap'
+        with tempfile.TemporaryDirectory() as tmp:
+            hex_manifest = write_results(*extract_data(str(capture)), f'{tmp}/hex')
+            bin_manifest = write_results(*extract_data(str(capture)), f'{tmp}/bin', binary=True)
+            self.assertEqual(hex_manifest, bin_manifest)
+
+            for addr, entry in bin_manifest.items():
+                name = f'{entry["device"]}-{addr}'
+                device, address, timestamps, lengths, reports = load_binary(f'{tmp}/bin/{name}.bin')
+                self.assertEqual((entry['device'], addr), (device, address))
+                self.assertEqual(entry['reports'], len(timestamps))
+                expected = parse_reports((Path(tmp) / 'hex' / f'{name}.txt').read_text())
+                self.assertEqual(expected, [bytes(row[:n]) for row, n in zip(reports, lengths)])
+
+    def test_reenumeration(self):
+        set_address = bytes([0x00, 0x05, 0x05, 0x00, 0x00, 0x00, 0x00, 0x00])
+        get_configuration = bytes([0x80, 0x06, 0x00, 0x02, 0x00, 0x00, 0x22, 0x00])
+
+        def configuration(protocol):
+            interface = bytes([9, 0x04, 0, 0, 1, 0x03, 0x01, protocol, 0])
+            endpoint = bytes([7, 0x05, 0x81, 0x03, 8, 0, 10])
+            return bytes([9, 0x02, 25, 0, 1, 1, 0, 0xA0, 50]) + interface + endpoint
+
+        frames = []
+        for irp_id, protocol in ((1, 0x01), (2, 0x02)):
+            frames += [
+                usbpcap_frame(irp_id, 0, 0x00, 2, 0, set_address, stage=0),
+                usbpcap_frame(irp_id, 5, 0x80, 2, 0, get_configuration, stage=0),
+                usbpcap_frame(irp_id, 5, 0x80, 2, 1, configuration(protocol), stage=1),
+                usbpcap_frame(irp_id, 5, 0x81, 1, 1, bytes([protocol] * 8)),
+                usbpcap_frame(irp_id, 5, 0x81, 1, 1, bytes([protocol] * 8)),
+            ]
+
+        tracker = DeviceTracker()
+        addresses = [addr for addr, _, _ in extract_hid_data(read_packets(frames), tracker)]
+        self.assertEqual(['1.5.1', '1.5.1', '1.5.1_1', '1.5.1_1'], addresses)
+        self.assertEqual({'1.5.1': 'keyboard', '1.5.1_1': 'mouse'}, tracker.devices)
+
+    def test_undefined_interface(self):
+        # Packet blocks before any interface description block
+        shb = struct.pack('<IIIHHqI', 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28)
+        epb = struct.pack('<IIIIIII4sI', 0x00000006, 36, 0, 0, 0, 4, 4, b'\x00' * 4, 36)
+        spb = struct.pack('<III4sI', 0x00000003, 20, 4, b'\x00' * 4, 20)
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, block in (('epb', epb), ('spb', spb)):
+                with self.subTest(name):
+                    path = os.path.join(tmp, f'{name}.pcapng')
+                    Path(path).write_bytes(shb + block)
+                    with self.assertRaises(CaptureFormatError):
+                        list(read_capture(path))
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_scaled_capture(self):
+        capture = root / 'samples' / 'mouse' / 'GoogleCTF-2016-For2' / 'capture.pcapng'
+        with tempfile.TemporaryDirectory() as tmp:
+            scaled = os.path.join(tmp, 'capture.pcap')
+            self.assertTrue(scale_capture(str(capture), scaled, 3))
+            reports = [data for addr, _, data in extract_data(str(capture))[1] if addr == '1.3.1']
+            scaled_reports = [data for addr, _, data in extract_data(scaled)[1] if addr == '1.3.1']
+            self.assertEqual(reports * 3, scaled_reports)
+
+    def test_unscalable_capture(self):
+        workload = {'name': 'mouse/sample', 'device': 'mouse',
+                    'capture': str(root / 'samples' / 'mouse' / 'GoogleCTF-2016-For2' / 'capture.pcapng'),
+                    'reports': str(root / 'samples' / 'mouse' / 'GoogleCTF-2016-For2' / 'usbdata.txt')}
+        context = unittest.mock.MagicMock()
+        context.Pool.return_value.__enter__.return_value.apply.return_value = (0.001, 1.0)
+        # Scaling the capture fails at 2x only, which must not drop the capture stages at 3x
+        with unittest.mock.patch('benchmark.multiprocessing.get_context', return_value=context), \
+                unittest.mock.patch('benchmark.scale_capture', side_effect=[False, True]), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            results = run_benchmarks([workload], scales=(1, 2, 3), stages=('pcap_read', 'decode_mouse_data'))
+        self.assertEqual([(1, 'pcap_read'), (1, 'decode_mouse_data'), (2, 'decode_mouse_data'), (3, 'pcap_read'), (3, 'decode_mouse_data')],
+                         [(r['scale'], r['stage']) for r in results])
+        self.assertIn('skipped pcap_read', output.getvalue())
+
+    def test_compare(self):
+        def results(*seconds):
+            return {'results': [{'workload': 'mouse/sample', 'scale': 1, 'stage': stage, 'seconds': s} for stage, s in zip(('a', 'b', 'c'), seconds)]}
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            regressions = compare(results(1.0, 1.0, 0.001), results(1.1, 1.5, 0.004))
+        # Stage c is 4x slower but within noise
+        self.assertEqual(['b'], [r['stage'] for r in regressions])
+
+
+class GeneratorTest(unittest.TestCase):
+    def test_generated_captures(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, usbmon in (('usbpcap.pcapng', False), ('usbpcap.pcap', False), ('usbmon.pcapng', True), ('usbmon.pcap', True)):
+                with self.subTest(name):
+                    capture = os.path.join(tmp, name)
+                    devices = create_devices(keyboards=1, mice=1, tablets=1)
+                    counts = generate_capture(capture, devices, duration=1, replugs=1, usbmon=usbmon)
+                    tracker = DeviceTracker()
+                    device_table, hid_data = extract_data(capture, tracker=tracker)
+                    reports = {}
+                    for addr, _, data in hid_data:
+                        reports[addr] = reports.get(addr, 0) + 1
+
+                    self.assertEqual(counts, reports)
+                    self.assertEqual({'1.2.1': 'keyboard', '1.3.1': 'mouse', '1.4.1': 'tablet'}, {addr: kind for addr, kind in device_table.items() if '_' not in addr})
+                    self.assertEqual(device_table['1.4.1'], device_table['1.4.1_1'])
+                    self.assertEqual(set(counts), set(tracker.descriptors))
+                    timestamps = [ts for _, ts, _ in read_capture(capture)]
+                    self.assertEqual(sorted(timestamps), timestamps)
+
+    def test_high_rate_timestamps(self):
+        # Reports 50 µs apart, closer than a request and its completion
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, usbmon in (('usbpcap.pcapng', False), ('usbmon.pcap', True)):
+                with self.subTest(name):
+                    capture = os.path.join(tmp, name)
+                    devices = create_devices(keyboards=1, mice=1, tablets=1, rate=20000)
+                    counts = generate_capture(capture, devices, duration=0.2, replugs=1, usbmon=usbmon)
+                    timestamps = [ts for _, ts, _ in read_capture(capture)]
+                    self.assertEqual(sorted(timestamps), timestamps)
+                    reports = {}
+                    for addr, _, _ in extract_data(capture)[1]:
+                        reports[addr] = reports.get(addr, 0) + 1
+                    self.assertEqual(counts, reports)
+
+
+class LiveTest(unittest.TestCase):
+    def test_replayed_capture(self):
+        sample = root / 'samples' / 'keyboard' / 'CSAW-2012-Net300'
+        with tempfile.TemporaryDirectory() as tmp:
+            pipe = f'{tmp}/usbmon'
+            os.mkfifo(pipe)
+            writer = threading.Thread(target=replay_capture, args=(str(sample / 'capture.pcap'), pipe, 0))
+            writer.start()
+
+            # Small queues so the pipeline has to apply backpressure
+            output = io.StringIO()
+            count = live_capture(pipe, devices={'2.3.1': 'mouse'}, output=output, queue_size=4)
+            writer.join()
+
+        lines = output.getvalue().split('\n')
+        keyboard = [line.removeprefix('[2.26.3 keyboard] ') for line in lines if line.startswith('[2.26.3 keyboard] ')]
+        self.assertEqual((sample / 'output-sim-txt.txt').read_text().rstrip('\n'), '\n'.join(keyboard))
+        self.assertIn('[2.3.1 mouse] down 0x02 at (0, 0)', lines)
+        self.assertEqual(1343, count)
+
+
+    def test_sink_layouts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            capture = os.path.join(tmp, 'capture.pcap')
+            generate_capture(capture, create_devices(keyboards=0, mice=1, tablets=1), duration=2)
+            tracker = DeviceTracker()
+            reports = {}
+            for addr, _, data in extract_data(capture, tracker=tracker)[1]:
+                reports.setdefault(addr, []).append(bytes(data))
+
+        # Positions at the first press and release, as decoded with the report descriptor from files
+        for addr, decode in (('1.2.1', decode_mouse_descriptor), ('1.3.1', decode_tablet_descriptor)):
+            with self.subTest(addr):
+                device = tracker.devices[addr]
+                _, clicks, xs, ys, *_ = decode('\n'.join(r.hex() for r in reports[addr]), tracker.descriptors[addr])
+                changes = [i for i in range(len(clicks)) if clicks[i] != (clicks[i - 1] if i else 0)][:2]
+                sink = create_sink(device, tracker.descriptors[addr])
+                lines = [line for report in reports[addr] for line in sink.feed(0, report)][:2]
+                self.assertTrue(changes)
+                self.assertEqual([f'({xs[i]}, {ys[i]})' for i in changes], [re.search(r'\(.*\)', line).group(0) for line in lines])
+
+        # Without a descriptor, mice use the given offset and bit lengths
+        sink = create_sink('mouse', offset=1, bit_lengths=(8, 12, 12))
+        self.assertEqual(['down 0x01 at (-2, -3)'], sink.feed(0, bytes.fromhex('0101' 'fe3f00')))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class PlaybackTest(unittest.TestCase):
+    def test_no_drift(self):
+        # Each step takes 5ms of work, which must not push later reports back
+        clock = FakeClock()
+        timestamps = [100 + 0.01 * i for i in range(100)]
+        playback = Playback(timestamps, speed=2, clock=clock, sleep=clock.sleep)
+        for i in range(len(timestamps)):
+            self.assertEqual(0.0, playback.wait(i))
+            self.assertAlmostEqual(0.005 * i, clock.now)
+            clock.now += 0.004
+
+    def test_dropped_frames(self):
+        # Rendering takes 2.5 frames, so two of every three frames are dropped without slowing down
+        clock = FakeClock()
+        timestamps = [0.001 * i for i in range(1000)]
+        playback = Playback(timestamps, clock=clock, sleep=clock.sleep)
+        steps = []
+        for start, end in playback.frames(fps=100):
+            steps += range(start, end)
+            clock.now += 0.025
+
+        self.assertEqual(list(range(1000)), steps)
+        self.assertLess(clock.now, 1.05)
+
+    def test_pause(self):
+        clock = FakeClock()
+        playback = Playback([0.0, 1.0], clock=clock, sleep=clock.sleep)
+        with playback.paused():
+            clock.now += 10
+        playback.wait(1)
+        self.assertEqual(11.0, clock.now)
+
+    def test_timestamp_column(self):
+        raw_data = '1.5\t0102\n2.25\t03:04\n'
+        self.assertEqual([b'\x01\x02', b'\x03\x04'], parse_reports(raw_data))
+        self.assertEqual([1.5, 2.25], parse_timestamps(raw_data))
+        self.assertIsNone(parse_timestamps('0102\n0304\n'))
+
+
 if __name__ == '__main__':
     unittest.main()